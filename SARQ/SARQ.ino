@@ -7,6 +7,11 @@
 #include <esp_adc_cal.h>
 #include <SparkFun_u-blox_GNSS_Arduino_Library.h>
 
+// Per-board raw-code lookup table from adc_for_calib/adc_lut_codegen.py (only in board copies of the sketch)
+#if __has_include("vin_lut.h")
+#include "vin_lut.h"
+#endif
+
 // Define pins and constants
 #define LORA_CS 5
 #define LORA_RST 4
@@ -368,7 +373,11 @@ void printVoltage() {
     int rawADC = analogRead(VMON_PIN);
     uint32_t adcCalVoltage = esp_adc_cal_raw_to_voltage(rawADC, adc_chars);
     float VIN = calculateVIN(rawADC);
+#ifdef USE_VIN_LUT
+    float calibratedVIN = rawToVinMv(rawADC) / 1000.0;
+#else
     float calibratedVIN = calibrateVIN(VIN);
+#endif
     Serial.print("Raw ADC: ");
     Serial.print(rawADC);
     Serial.print(" | ESP ADC Cal Raw to Voltage: ");
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Apr 23 10:12:31 2025
+
+@author: nichm
+
+Benchmarks for the calibration pipeline.
+
+Each stage (parse, CSV sink, checkpoint, sample store, trace spans, fit,
+evaluation, per-board sketch update) runs the pipeline's own functions on
+the readings in tests/*.csv, replicated with a little jitter to --boards
+boards (the stages writing files use the first --io-boards of them).
+End-to-end sessions run main() of adc_dynamic_calibration_2.py against
+simulated boards from adc_board_simulator, with a simulated supply and a
+scripted operator (calibration sweep, provisioning, evaluation); their trace
+spans give the per-reading and per-point costs. Throughput and latency
+percentiles are compared against a stored baseline and regressions are
+flagged:
+
+    python adc_benchmarks.py --boards 1000
+    python adc_benchmarks.py --save-baseline
+"""
+
+import argparse
+import builtins
+import contextlib
+import csv
+import glob
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import adc_dynamic_calibration_2 as calib
+from adc_board_simulator import load_profiles, start_bench
+from adc_build_cache import board_sketch
+from adc_checkpoint import Checkpoint
+from adc_csv_sink import CsvSink
+from adc_firmware_emulator import arduino_float_str
+from adc_instruments import get_simulated_supply
+from adc_sample_store import SampleStore
+from adc_trace import TRACE_DIR, load_spans, span, tracer
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(SCRIPT_DIR, "bench_baseline.json")
+SWEEP_PLAN = [5.0, 6.0, 7.0, 8.0, 9.0, 10.0, 11.0, 12.0, 13.0, 14.0, 15.0]
+IO_BOARDS = 50
+# Trace spans of the end-to-end sessions reported as stages: span -> (stage, unit)
+SESSION_SPANS = {'serial_read': ('reading', "samples/s"), 'csv_log': ('point_log', "samples/s"),
+                 'provision': ('provision', "boards/s")}
+
+
+def load_readings():
+    """Eval rows (raw, cal V, calculated VIN, calibrated VIN, actual) from tests/*.csv."""
+    rows = []
+    for path in sorted(glob.glob(os.path.join(SCRIPT_DIR, "tests", "sarq_eval-*.csv"))):
+        with open(path, newline='') as file:
+            reader = csv.reader(file)
+            next(reader, None)
+            for row in reader:
+                try:
+                    rows.append([float(v) for v in row[:5]])
+                except (ValueError, IndexError):
+                    continue
+    return np.array(rows)
+
+
+def synthetic_boards(readings, count, seed=0):
+    """Replicate the reference readings into count boards with per-board gain/offset and noise."""
+    rng = np.random.default_rng(seed)
+    boards = []
+    for _ in range(count):
+        gain = rng.normal(1.0, 0.01)
+        offset = rng.normal(0.0, 0.05)
+        board = readings.copy()
+        board[:, 2] = board[:, 2] * gain + offset + rng.normal(0, 0.01, len(board))
+        boards.append(board)
+    return boards
+
+
+def serial_line(row):
+    """The text line the firmware prints for one reading."""
+    return (f"Raw ADC: {int(row[0])} | ESP ADC Cal Raw to Voltage: {arduino_float_str(row[1], 3)}"
+            f" | Calculated VIN: {arduino_float_str(row[2], 3)} | Calibrated VIN: {arduino_float_str(row[3], 3)}")
+
+
+def summarize(latencies, total_seconds, items, unit):
+    """Throughput and latency percentiles for one stage."""
+    latencies = np.asarray(latencies) * 1000.0
+    return {
+        'count': int(items),
+        'seconds': round(total_seconds, 6),
+        'throughput': round(items / total_seconds, 3) if total_seconds > 0 else float('inf'),
+        'unit': unit,
+        'p50_ms': round(float(np.percentile(latencies, 50)), 6),
+        'p90_ms': round(float(np.percentile(latencies, 90)), 6),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 6),
+    }
+
+
+def run_stage(func, inputs, unit, per_item=1):
+    """Time func(x) for every input; per_item is how many units one call handles."""
+    latencies = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        for x in inputs:
+            t0 = time.perf_counter()
+            func(x)
+            latencies.append(time.perf_counter() - t0)
+        total = time.perf_counter() - started
+    return summarize(latencies, total, len(inputs) * per_item, unit)
+
+
+def bench_stages(boards, work_dir, io_boards=IO_BOARDS):
+    """Benchmark every offline stage over the synthetic boards."""
+    results = {}
+    lines = [serial_line(row) for board in boards for row in board]
+    results['parse'] = run_stage(calib.parse_serial_data, lines, "samples/s")
+
+    # What log_point() in main() does for every sample, one component at a time
+    io_set = list(enumerate(boards[:io_boards], start=1))
+    samples_per_board = len(boards[0]) if boards else 0
+
+    def sink_board(indexed):
+        i, board = indexed
+        filename = os.path.join(work_dir, f"sarq_calib-{i:04d}.csv")
+        with CsvSink(filename, calib.CALIB_HEADERS, flush_every=calib.CSV_FLUSH_EVERY, fsync=calib.CSV_FSYNC) as sink:
+            for row in board:
+                sink.write([row[2], row[4]])
+
+    def checkpoint_board(indexed):
+        i, board = indexed
+        checkpoint = Checkpoint(f"{i:04d}", os.path.join(work_dir, "checkpoints"))
+        for row in board:
+            checkpoint.record_point(row[2], row[4])
+
+    store = SampleStore(os.path.join(work_dir, "sample_store"))
+
+    def store_board(indexed):
+        i, board = indexed
+        session_id = store.new_session(i, 'calib')
+        for row in board:
+            store.append(session_id, [[row[0], row[1], row[2], row[3], row[4]]])
+        store.close()
+
+    def trace_board(indexed):
+        for _ in indexed[1]:
+            with span("csv_log"):
+                pass
+
+    results['csv_sink'] = run_stage(sink_board, io_set, "samples/s", samples_per_board)
+    results['checkpoint'] = run_stage(checkpoint_board, io_set, "samples/s", samples_per_board)
+    results['store_append'] = run_stage(store_board, io_set, "samples/s", samples_per_board)
+    tracer.open(os.path.join(work_dir, "trace.jsonl"))
+    try:
+        results['trace_span'] = run_stage(trace_board, io_set, "samples/s", samples_per_board)
+    finally:
+        tracer.close()
+
+    fits = []
+    results['cubic_fit'] = run_stage(lambda board: fits.append(calib.cubic_fit(board[:, 2], board[:, 4])),
+                                     boards, "boards/s")
+    results['evaluate_fit'] = run_stage(lambda pair: calib.evaluate_fit(pair[0], pair[1][:, 2], pair[1][:, 4]),
+                                        list(zip(fits, boards)), "boards/s")
+
+    # Fallback when provisioning fails: the board's copy of the sketch with its coefficients as defaults
+    ino_filepath = os.path.join(SCRIPT_DIR, "adc_for_calib.ino")
+    sketch_root = os.path.join(work_dir, "board_sketches")
+    results['board_sketch'] = run_stage(
+        lambda pair: calib.update_ino_defaults(board_sketch(ino_filepath, f"{pair[0]:04d}", sketch_root), pair[1]),
+        list(enumerate(fits[:io_boards], start=1)), "boards/s")
+    return results
+
+
+def scripted_operator(board_no, supply, plan=SWEEP_PLAN):
+    """input() for one main() session: calibrate over the supply, provision, then evaluate at the plan's voltages."""
+    evaluation = iter(plan)
+
+    def answer(prompt):
+        if "Board no." in prompt:
+            return f"{board_no:04d}"
+        if "COM port" in prompt:
+            return "1"
+        if "Calibration (c) or Evaluation (e)" in prompt:
+            return "c"
+        if "Planned input voltages" in prompt:
+            return ",".join(f"{v:g}" for v in plan)
+        if "proceed with Evaluation" in prompt:
+            return "y"
+        if "Enter 'a'" in prompt:
+            setpoint = next(evaluation, None)
+            if setpoint is None:
+                return "q"
+            supply.set_voltage(setpoint)
+            return "a"
+        if "Actual Input Voltage" in prompt:
+            return f"{supply.measure_voltage():.4f}"
+        raise RuntimeError(f"Unexpected prompt: {prompt!r}")
+    return answer
+
+
+def session_worker(count, latency, reference_dir):
+    """Child side of bench_sessions(): run main() once per simulated board and print the times and trace spans."""
+    profiles = load_profiles([os.path.join(reference_dir, "tests", "sarq_eval-*.csv"),
+                              os.path.join(reference_dir, "..", "adc_read_2", "tests", "sarq-*.csv")])
+    supply = get_simulated_supply()
+    boards = start_bench(count, supply=supply, profiles=profiles, seed=0, latency=latency)
+    calib.SUPPLY = "sim"
+    session_times = []
+    real_input = builtins.input
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for board_no, board in enumerate(boards, start=1):
+                calib.detect_serial_ports = lambda port=board.port: [port]
+                builtins.input = scripted_operator(board_no, supply)
+                t0 = time.perf_counter()
+                calib.main()
+                session_times.append(time.perf_counter() - t0)
+    finally:
+        builtins.input = real_input
+        for board in boards:
+            board.stop()
+
+    spans = load_spans([TRACE_DIR])
+    failed = sorted({r['stage'] for r in spans if r.get('ok') is False})
+    if failed:
+        raise RuntimeError(f"Failed spans in the simulated sessions: {', '.join(failed)}")
+    durations = {}
+    for record in spans:
+        durations.setdefault(record['stage'], []).append(record['duration'])
+    print(json.dumps({'sessions': session_times, 'spans': durations}))
+
+
+def bench_sessions(count, work_dir, latency=0.0):
+    """End-to-end main() sessions, one simulated board at a time like a single bench station.
+
+    main() keeps its CSVs, checkpoints, sample store and traces next to the scripts, so the
+    sessions run in a child process from a scratch copy of them.
+    """
+    scratch = os.path.join(work_dir, "scripts")
+    os.makedirs(scratch)
+    for name in os.listdir(SCRIPT_DIR):
+        if name.endswith((".py", ".ino")):
+            shutil.copy(os.path.join(SCRIPT_DIR, name), scratch)
+    command = [sys.executable, os.path.join(scratch, "adc_benchmarks.py"), "--session-worker", str(count),
+               "--latency", str(latency), "--reference-dir", SCRIPT_DIR]
+    result = subprocess.run(command, cwd=scratch, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Simulated sessions failed:\n{result.stderr}")
+    run = json.loads(result.stdout.strip().splitlines()[-1])
+
+    session_times = run['sessions']
+    total = sum(session_times)
+    results = {'session': summarize(session_times, total, len(session_times), "boards/s")}
+    results['session']['boards_per_hour'] = round(3600.0 * len(session_times) / total, 1)
+    for name, (stage, unit) in SESSION_SPANS.items():
+        durations = run['spans'].get(name)
+        if durations:
+            results[stage] = summarize(durations, sum(durations), len(durations), unit)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Stages whose throughput dropped or p90 latency grew by more than tolerance vs the baseline."""
+    regressions = []
+    for stage, current in results.items():
+        reference = baseline.get(stage)
+        if not reference:
+            continue
+        if current['throughput'] < reference['throughput'] * (1 - tolerance):
+            regressions.append(f"{stage}: throughput {current['throughput']:.1f} < baseline {reference['throughput']:.1f} {current['unit']}")
+        if current['p90_ms'] > reference['p90_ms'] * (1 + tolerance):
+            regressions.append(f"{stage}: p90 {current['p90_ms']:.3f}ms > baseline {reference['p90_ms']:.3f}ms")
+    return regressions
+
+
+def print_report(results, baseline):
+    print(f"\n{'stage':<18}{'throughput':>16}  {'unit':<10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'vs base':>10}")
+    for stage, r in results.items():
+        ratio = ""
+        if stage in baseline:
+            ratio = f"{r['throughput'] / baseline[stage]['throughput']:.2f}x"
+        print(f"{stage:<18}{r['throughput']:>16.1f}  {r['unit']:<10}{r['p50_ms']:>10.3f}{r['p90_ms']:>10.3f}{r['p99_ms']:>10.3f}{ratio:>10}")
+    if 'session' in results:
+        print(f"\n⏱️ End-to-end: {results['session']['boards_per_hour']:.0f} boards/hour per station (no operator time)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the calibration pipeline.")
+    parser.add_argument("--boards", type=int, default=1000, help="synthetic boards for the offline stages")
+    parser.add_argument("--sessions", type=int, default=5, help="end-to-end sessions against simulated boards (0 to skip)")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated reply latency per reading in seconds")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="allowed relative slowdown before flagging")
+    parser.add_argument("--io-boards", type=int, default=IO_BOARDS, help="boards for the stages that write files")
+    parser.add_argument("--output", help="also write this run's results to a JSON file")
+    parser.add_argument("--session-worker", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--reference-dir", default=SCRIPT_DIR, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.session_worker is not None:
+        session_worker(args.session_worker, args.latency, args.reference_dir)
+        return 0
+
+    readings = load_readings()
+    if len(readings) == 0:
+        print("❌ No reference CSVs found in tests/.")
+        return 1
+    print(f"🧪 {args.boards} synthetic boards x {len(readings)} readings, {args.sessions} simulated sessions")
+
+    work_dir = tempfile.mkdtemp(prefix="sarq_bench_")
+    try:
+        results = bench_stages(synthetic_boards(readings, args.boards), work_dir, args.io_boards)
+        if args.sessions > 0:
+            results.update(bench_sessions(args.sessions, work_dir, latency=args.latency))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file).get('results', {})
+    print_report(results, baseline)
+
+    run = {'created': time.strftime("%Y-%m-%d %H:%M:%S"), 'boards': args.boards, 'sessions': args.sessions,
+           'python': sys.version.split()[0], 'numpy': np.__version__, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(run, file, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(run, file, indent=2)
+        print(f"💾 Baseline saved to {args.baseline}")
+        return 0
+
+    if not baseline:
+        print("ℹ️ No baseline yet; run with --save-baseline to store one.")
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("\n❌ Regressions against the baseline:")
+        for line in regressions:
+            print(f"   {line}")
+        return 1
+    print(f"\n✅ No regressions (tolerance {args.tolerance:.0%}).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
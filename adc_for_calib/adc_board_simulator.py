@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Apr 22 16:15:48 2025
+
+@author: nichm
+
+Virtual SARQ boards on pseudo-terminals.
+
+Each VirtualBoard opens a pty and speaks the adc_for_calib.ino protocol
+('a' text reading, 'b' binary frame, 's<hz>' / 'x' streaming, 'c' / 'r'
+coefficients, 'e' esp_adc_cal characterization), so the calibration scripts can run against it unchanged.
+The analog front end is modelled per board from the eval CSVs in tests/:
+input voltage -> raw ADC (cubic fit, clipped to 12 bits) and raw ADC ->
+esp_adc_cal mV (esp_adc_cal_raw_to_voltage() with the characterization
+recovered from the logged pairs, the same one 'e' reports).
+
+Run it directly to start a bench of simulated boards:
+    python adc_board_simulator.py 8
+"""
+
+import csv
+import glob
+import os
+import pty
+import random
+import select
+import sys
+import threading
+import time
+import tty
+
+import numpy as np
+
+from adc_esp_adc_cal import characterize_vref, estimate_characterization, raw_to_voltage
+from adc_firmware_emulator import ADC_MAX_VALUE, DEFAULT_COEFFS, arduino_float_str, calculate_vin, calibrate_vin
+from adc_frame_protocol import encode_frame
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+REFERENCE_GLOBS = [
+    os.path.join(SCRIPT_DIR, "tests", "sarq_eval-*.csv"),
+    os.path.join(SCRIPT_DIR, "..", "adc_read_2", "tests", "sarq-*.csv"),
+]
+
+
+class BoardProfile:
+    """Analog front end of one real board, fitted from its eval CSV."""
+
+    def __init__(self, name, raw_coeffs, noise_counts, characterization=None):
+        self.name = name
+        self.raw_coeffs = raw_coeffs
+        self.noise_counts = noise_counts
+        self.characterization = characterization or characterize_vref()
+
+    @classmethod
+    def from_csv(cls, path, max_error=1.0):
+        """Fit a profile from a CSV with Raw ADC / ESP ADC Cal Raw Voltage / ... / Actual Input columns."""
+        rows = []
+        with open(path, newline='') as file:
+            reader = csv.reader(file)
+            next(reader, None)
+            for row in reader:
+                try:
+                    rows.append([float(v) for v in row[:5]])
+                except (ValueError, IndexError):
+                    continue
+        data = np.array(rows)
+        # Drop typo rows (e.g. 0.97 entered for 12.97)
+        data = data[np.abs(data[:, 4] - data[:, 3]) < max_error]
+        linear = data[data[:, 0] < ADC_MAX_VALUE]
+
+        raw_coeffs = np.polyfit(linear[:, 4], linear[:, 0], 3)
+        residual = np.polyval(raw_coeffs, linear[:, 4]) - linear[:, 0]
+        return cls(os.path.basename(path), raw_coeffs, float(np.std(residual)),
+                   estimate_characterization(data[:, 0], data[:, 1] * 1000.0))
+
+    def raw_adc(self, vin, noise_counts, rng):
+        raw = np.polyval(self.raw_coeffs, vin) + rng.gauss(0, noise_counts)
+        return int(min(max(round(raw), 0), ADC_MAX_VALUE))
+
+    def adc_cal_mv(self, raw):
+        """esp_adc_cal mV for a raw code, from the characterization the board reports on 'e'."""
+        return int(raw_to_voltage(raw, self.characterization))
+
+
+def load_profiles(patterns=REFERENCE_GLOBS):
+    """Fit a profile for every reference CSV found."""
+    profiles = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            try:
+                profiles.append(BoardProfile.from_csv(path))
+            except (ValueError, TypeError, IndexError, np.linalg.LinAlgError):
+                print(f"⚠️ Skipping {path}: not enough usable rows.")
+    return profiles
+
+
+class VirtualBoard:
+    """One simulated board behind a pseudo-terminal."""
+
+    def __init__(self, profile, coeffs=DEFAULT_COEFFS, noise_counts=None, latency=0.0,
+                 dropout=0.0, boot_time=0.0, seed=None):
+        self.profile = profile
+        self.coeffs = list(coeffs)
+        self.version = 0
+        self.noise_counts = profile.noise_counts if noise_counts is None else noise_counts
+        self.latency = latency
+        self.dropout = dropout
+        self.boot_time = boot_time
+        self.rng = random.Random(seed)
+        self.input_voltage = 0.0
+        self.seq = 0
+        self.stream_interval = 0.0
+        self.requests = 0
+        self.running = False
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self._slave = slave
+        self.write_lock = threading.Lock()
+
+    def set_input_voltage(self, volts):
+        self.input_voltage = volts
+
+    def sample(self):
+        raw = self.profile.raw_adc(self.input_voltage, self.noise_counts, self.rng)
+        mv = self.profile.adc_cal_mv(raw)
+        vin = calculate_vin(mv)
+        return raw, mv, vin, calibrate_vin(self.coeffs, vin)
+
+    def _write(self, data):
+        with self.write_lock:
+            os.write(self.master, data)
+
+    def _reply(self, data):
+        if self.rng.random() < self.dropout:
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        self._write(data)
+
+    def _text_reading(self):
+        raw, mv, vin, calibrated = self.sample()
+        return (f"Raw ADC: {raw} | ESP ADC Cal Raw to Voltage: {arduino_float_str(mv / 1000.0, 3)}"
+                f" | Calculated VIN: {arduino_float_str(vin, 3)}"
+                f" | Calibrated VIN: {arduino_float_str(calibrated, 3)}\r\n").encode()
+
+    def _binary_reading(self):
+        raw, mv, vin, calibrated = self.sample()
+        frame = encode_frame(self.seq, raw, mv, vin, calibrated)
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        return frame
+
+    def _coefficients_line(self):
+        return ("Calibration Coefficients: " + ", ".join(f"{c:.10g}" for c in self.coeffs)
+                + f" | Version: {self.version}\r\n").encode()
+
+    def _characterization_line(self):
+        chars = self.profile.characterization
+        return (f"ADC Characterization: type {chars['type']} | vref {chars['vref']} | "
+                f"coeff_a {chars['coeff_a']} | coeff_b {chars['coeff_b']}\r\n").encode()
+
+    def _handle(self, buffer):
+        """Consume commands from the start of buffer; returns what is left (incomplete line commands)."""
+        while buffer:
+            command = buffer[:1]
+            if command in (b'c', b's'):
+                if b'\n' not in buffer:
+                    return buffer
+                line, buffer = buffer.split(b'\n', 1)
+                argument = line[1:].decode(errors='replace')
+                if command == b'c':
+                    try:
+                        values = [float(v) for v in argument.split()[:4]]
+                        if len(values) != 4:
+                            raise ValueError
+                        self.coeffs = values
+                        self.version += 1
+                        self._reply(self._coefficients_line())
+                    except ValueError:
+                        self._reply(b"Calibration Error: expected 4 coefficients\r\n")
+                else:
+                    hz = int(argument.strip() or 0)
+                    hz = min(max(hz if hz > 0 else 100, 1), 500)
+                    self.stream_interval = 1.0 / hz
+                continue
+
+            buffer = buffer[1:]
+            self.requests += 1
+            if command == b'a':
+                self._reply(self._text_reading())
+            elif command == b'b':
+                self._reply(self._binary_reading())
+            elif command == b'r':
+                self._reply(self._coefficients_line())
+            elif command == b'e':
+                self._reply(self._characterization_line())
+            elif command == b'x':
+                self.stream_interval = 0.0
+        return buffer
+
+    def _run(self):
+        started = time.monotonic()
+        buffer = b''
+        next_frame = time.monotonic()
+        while self.running:
+            timeout = 0.05
+            if self.stream_interval:
+                timeout = max(0.0, min(timeout, next_frame - time.monotonic()))
+            readable, _, _ = select.select([self.master], [], [], timeout)
+            if readable:
+                try:
+                    data = os.read(self.master, 1024)
+                except OSError:
+                    break
+                # Bytes sent while the board is still booting are lost, like on the real UART
+                if time.monotonic() - started >= self.boot_time:
+                    buffer = self._handle(buffer + data)
+
+            if self.stream_interval and time.monotonic() >= next_frame:
+                if self.rng.random() >= self.dropout:
+                    self._write(self._binary_reading())
+                else:
+                    self.seq = (self.seq + 1) & 0xFFFFFFFF
+                next_frame = max(next_frame + self.stream_interval, time.monotonic() - self.stream_interval)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=f"board-{self.port}", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self._slave)
+
+
+def start_bench(count, supply=None, profiles=None, **board_options):
+    """Start count simulated boards (cycling through the fitted profiles), optionally powered by a SimulatedSupply."""
+    profiles = profiles or load_profiles()
+    if not profiles:
+        raise RuntimeError("No reference CSVs found to fit board profiles.")
+    boards = []
+    for i in range(count):
+        options = dict(board_options)
+        if 'seed' in options and options['seed'] is not None:
+            options['seed'] += i
+        board = VirtualBoard(profiles[i % len(profiles)], **options).start()
+        if supply is not None:
+            supply.attach(board.set_input_voltage)
+        boards.append(board)
+    return boards
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    voltage = float(sys.argv[2]) if len(sys.argv) > 2 else 12.0
+    boards = start_bench(count)
+    print(f"🧪 {count} simulated board(s) at {voltage}V input:")
+    for board in boards:
+        board.set_input_voltage(voltage)
+        print(f"   {board.port}  (profile {board.profile.name}, noise {board.noise_counts:.1f} counts)")
+    print("Press Ctrl-C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for board in boards:
+            board.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Apr 15 10:03:27 2025
+
+@author: nichm
+
+Cached arduino-cli builds and parallel uploads.
+
+Binaries are stored per hash of the sketch sources plus FQBN, so an
+unchanged sketch is never recompiled. Each sketch/FQBN pair also keeps a
+persistent build directory, so when only the calibration part of the sketch
+changes arduino-cli reuses the compiled core and library objects and
+rebuilds just the sketch itself.
+
+Firmware that only suits one board (e.g. a calibration model the generic
+sketch cannot store) is built from a copy of the sketch under
+board_sketches/<board>/, never from the shared sketch that is flashed to the
+fleet. The copy keeps the sketch's name, so it shares the sketch's build
+directory (arduino-cli wipes a build directory used for a sketch of another
+name) and a fleet of per-board builds only recompiles the sketch itself.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BUILD_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".build_cache")
+BOARD_SKETCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "board_sketches")
+SKETCH_EXTENSIONS = (".ino", ".h", ".hpp", ".c", ".cpp")
+
+# One compile at a time per persistent build directory
+build_lock = threading.Lock()
+
+
+def safe_name(text):
+    """Turn a port or FQBN into something usable as a file name."""
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", text).strip("_")
+
+
+def sketch_hash(ino_filepath, board_fqbn):
+    """Hash every source file in the sketch folder together with the FQBN."""
+    sketch_dir = os.path.dirname(os.path.abspath(ino_filepath))
+    digest = hashlib.sha256(board_fqbn.encode())
+    for name in sorted(os.listdir(sketch_dir)):
+        if name.endswith(SKETCH_EXTENSIONS):
+            digest.update(name.encode())
+            with open(os.path.join(sketch_dir, name), 'rb') as file:
+                digest.update(file.read())
+    return digest.hexdigest()
+
+
+def board_sketch(ino_filepath, board_no, root=BOARD_SKETCH_DIR):
+    """Copy the sketch folder's sources to board_sketches/<board>/<sketch>/ and return the copied .ino path."""
+    sketch_dir = os.path.dirname(os.path.abspath(ino_filepath))
+    sketch_name = os.path.splitext(os.path.basename(ino_filepath))[0]
+    board_dir = os.path.join(root, str(board_no))
+    target_dir = os.path.join(board_dir, sketch_name)
+    # Start from a clean copy so nothing generated for an earlier build (e.g. vin_lut.h) is left behind
+    shutil.rmtree(target_dir, ignore_errors=True)
+    os.makedirs(target_dir)
+    for name in os.listdir(sketch_dir):
+        if name.endswith(SKETCH_EXTENSIONS):
+            shutil.copyfile(os.path.join(sketch_dir, name), os.path.join(target_dir, name))
+    return os.path.join(target_dir, os.path.basename(ino_filepath))
+
+
+def has_binaries(output_dir):
+    return os.path.isdir(output_dir) and any(f.endswith(".bin") for f in os.listdir(output_dir))
+
+
+def build_sketch(ino_filepath, board_fqbn, cache_dir=BUILD_CACHE_DIR):
+    """Compile the sketch unless this exact source/FQBN was built before. Returns the binaries folder or None."""
+    key = sketch_hash(ino_filepath, board_fqbn)[:16]
+    output_dir = os.path.join(cache_dir, "out", key)
+    if has_binaries(output_dir):
+        print(f"♻️ Build cache hit ({key}), skipping compile.")
+        return output_dir
+
+    # Keyed by sketch name, not folder: per-board copies (board_sketch()) reuse the core and library objects
+    sketch_name = os.path.splitext(os.path.basename(ino_filepath))[0]
+    build_path = os.path.join(cache_dir, "build", f"{sketch_name}-{safe_name(board_fqbn)}")
+    tmp_dir = output_dir + ".tmp"
+    compile_cmd = ["arduino-cli", "compile", "--fqbn", board_fqbn,
+                   "--build-path", build_path, "--output-dir", tmp_dir, ino_filepath]
+
+    with build_lock:
+        print(f"🔹 Compiling: {' '.join(compile_cmd)}")
+        start = time.monotonic()
+        try:
+            result = subprocess.run(compile_cmd, capture_output=True, text=True)
+        except FileNotFoundError:
+            print("❌ arduino-cli not found on PATH.")
+            return None
+
+        if result.returncode != 0 or not has_binaries(tmp_dir):
+            print(f"❌ Compilation failed:\n{result.stderr}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return None
+
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.replace(tmp_dir, output_dir)
+        print(f"✅ Compiled {key} in {time.monotonic() - start:.1f}s")
+    return output_dir
+
+
+def upload_sketch(output_dir, board_fqbn, port, log_dir):
+    """Upload prebuilt binaries to one port and keep the arduino-cli output in a per-port log. Returns (ok, seconds)."""
+    upload_cmd = ["arduino-cli", "upload", "--port", port, "--fqbn", board_fqbn, "--input-dir", output_dir]
+    start = time.monotonic()
+    try:
+        result = subprocess.run(upload_cmd, capture_output=True, text=True)
+        ok, stdout, stderr = result.returncode == 0, result.stdout, result.stderr
+    except FileNotFoundError:
+        ok, stdout, stderr = False, "", "arduino-cli not found on PATH."
+    seconds = time.monotonic() - start
+
+    log_path = os.path.join(log_dir, f"upload-{safe_name(port)}.log")
+    with open(log_path, 'w') as file:
+        file.write(f"$ {' '.join(upload_cmd)}\n")
+        file.write(f"# {'ok' if ok else 'FAILED'} in {seconds:.1f}s\n\n")
+        file.write(stdout)
+        file.write(stderr)
+    return ok, seconds
+
+
+def upload_many(output_dir, board_fqbn, ports, max_workers=4, cache_dir=BUILD_CACHE_DIR):
+    """Upload binaries to several ports at once. Returns {port: (ok, seconds)}.
+
+    output_dir is one binaries folder for every port, or {port: folder} for per-board builds.
+    """
+    log_dir = os.path.join(cache_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    folders = output_dir if isinstance(output_dir, dict) else {port: output_dir for port in ports}
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(ports)))) as pool:
+        futures = {pool.submit(upload_sketch, folders[port], board_fqbn, port, log_dir): port for port in ports}
+        for future, port in futures.items():
+            ok, seconds = future.result()
+            results[port] = (ok, seconds)
+            status = "✅ Upload successful" if ok else "❌ Upload failed"
+            print(f"{status} on {port} ({seconds:.1f}s, log: upload-{safe_name(port)}.log)")
+    return results
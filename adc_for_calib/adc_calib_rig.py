@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Apr 14 09:12:41 2025
+
+@author: nichm
+
+Rig mode: calibrate every board plugged into the bench at once.
+
+All non-Bluetooth serial ports are opened together and each board runs the
+same calibration/evaluation steps as adc_dynamic_calibration_2.py on its own
+thread. The boards share one bench supply, so the operator enters the actual
+input voltage once per point and every board is sampled in parallel.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from adc_dynamic_calibration_2 import (
+    get_board_number,
+    detect_serial_ports,
+    BoardSession,
+    request_reading,
+    cubic_fit,
+    evaluate_fit,
+    update_ino_defaults,
+    provision_coefficients,
+    USE_BINARY_FRAMES,
+    SUPPLY,
+    METER,
+    CSV_FLUSH_EVERY,
+    CSV_FSYNC,
+    STORE_SAMPLES,
+    CALIB_HEADERS,
+    EVAL_HEADERS,
+    get_sweep_plan,
+)
+from adc_instruments import open_supply, run_sweep
+from adc_build_cache import board_sketch, build_sketch, upload_many
+from adc_trace import tracer, span, session_trace_path
+from adc_csv_sink import CsvSink, read_rows
+from adc_sample_store import SampleStore
+from adc_esp_adc_cal import forget_unsupported, get_characterization
+
+class RigBoard:
+    """Calibration/evaluation state for one board on the rig."""
+
+    def __init__(self, port, board_no, test_dir):
+        self.port = port
+        self.board_no = board_no
+        self.calib_filename = os.path.join(test_dir, f"sarq_calib-{board_no}.csv")
+        self.eval_filename = os.path.join(test_dir, f"sarq_eval-{board_no}.csv")
+        self.session = BoardSession(port)
+        self.active = True
+        self.measured_vin = []
+        self.actual_vin = []
+        self.coeffs = None
+        self.sinks = {}
+        self.store = None  # Shared SampleStore of the rig
+        self.store_sessions = {}
+
+    @property
+    def ser(self):
+        return self.session.ser
+
+    def log(self, message):
+        print(f"[{self.board_no} @ {self.port}] {message}")
+
+
+def traced(func, board, *args):
+    """Run func(board, *args) with the board's number and port attached to its trace spans."""
+    with tracer.bound(board=board.board_no, port=board.port):
+        return func(board, *args)
+
+
+def run_on_all(boards, func, *args):
+    """Run func(board, *args) on every active board in parallel and return the results."""
+    active = [b for b in boards if b.active]
+    if not active:
+        return {}
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(active)) as pool:
+        futures = {pool.submit(traced, func, board, *args): board for board in active}
+        for future, board in futures.items():
+            try:
+                results[board.board_no] = future.result()
+            except Exception as e:
+                board.log(f"⚠️ Error: {e}")
+                results[board.board_no] = None
+    return results
+
+
+def all_phases(boards, name):
+    """Time a rig-wide phase on every board's session."""
+    stack = ExitStack()
+    for board in boards:
+        stack.enter_context(board.session.phase(name))
+    return stack
+
+
+def finish(boards):
+    """Close every port and print each board's session summary."""
+    for board in boards:
+        board.active = True
+    run_on_all(boards, close_board)
+    if boards and boards[0].store is not None:
+        boards[0].store.close()
+    for board in boards:
+        board.session.summary()
+    tracer.close()
+    print(f"🧾 Trace written to {tracer.path}")
+
+
+def assign_board_numbers(ports, test_dir):
+    """Ask the operator which board sits on each detected port."""
+    boards = []
+    used = set()
+    for port in ports:
+        print(f"\n🔌 {port}")
+        while True:
+            board_no = get_board_number()
+            if board_no not in used:
+                break
+            print(f"Board {board_no} is already assigned to another port.")
+        used.add(board_no)
+        boards.append(RigBoard(port, board_no, test_dir))
+    return boards
+
+
+def open_board(board):
+    """Open the serial connection of one board unless it is still open."""
+    ser = board.session.open()
+    if ser is None:
+        board.log("❌ Could not open port. Skipping this board.")
+        board.active = False
+        return
+    get_characterization(ser, board.board_no)  # Cached after the first read
+
+
+def close_board(board):
+    """Close the serial connection and CSV files of one board."""
+    board.session.close()
+    for sink in board.sinks.values():
+        sink.close()
+
+
+def has_rows(board, filename_attr, headers):
+    return bool(read_rows(getattr(board, filename_attr), headers))
+
+
+def open_sink(board, filename_attr, headers, resume=False):
+    """Open the board's CSV once for the whole sweep, appending to it when resuming."""
+    sink = CsvSink(getattr(board, filename_attr), headers, flush_every=CSV_FLUSH_EVERY, fsync=CSV_FSYNC, resume=resume)
+    board.sinks[filename_attr] = sink
+    if filename_attr == "calib_filename":
+        for row in sink.resumed_rows:
+            board.measured_vin.append(float(row[0]))
+            board.actual_vin.append(float(row[1]))
+    if sink.resumed:
+        board.log(f"↩️ Resuming with {len(sink.resumed_rows)} logged point(s).")
+    if board.store is not None:
+        kind = 'calib' if filename_attr == "calib_filename" else 'eval'
+        board.store_sessions[filename_attr] = board.store.new_session(board.board_no, kind)
+
+
+def store_point(board, filename_attr, row):
+    if board.store is not None:
+        board.store.append(board.store_sessions[filename_attr], [row])
+
+
+def ask_resume(boards, filename_attr, headers):
+    """Ask once whether boards with logged points should resume instead of starting over."""
+    existing = [b.board_no for b in boards if b.active and has_rows(b, filename_attr, headers)]
+    if not existing:
+        return False
+    choice = input(f"\nBoards {', '.join(existing)} already have logged points. Resume (r) or start over (o)? ").strip().lower()
+    while choice not in ['r', 'o']:
+        choice = input("Invalid choice. Enter 'r' to resume or 'o' to start over: ").strip().lower()
+    return choice == 'r'
+
+
+def capture_calibration_point(board, actual_input):
+    """Sample the board once and log it against the actual input voltage."""
+    with span("serial_read") as trace:
+        data = board.ser and request_reading(board.ser, binary=USE_BINARY_FRAMES)
+        trace['ok'] = bool(data)
+    if not data:
+        board.log("❌ No data received. Check the connection; board dropped from the rig.")
+        board.active = False
+        return None
+
+    calculated_vin = data[2]
+    board.sinks["calib_filename"].write([calculated_vin, actual_input])
+    store_point(board, "calib_filename", [data[0], data[1], calculated_vin, data[3], actual_input])
+
+    board.measured_vin.append(calculated_vin)
+    board.actual_vin.append(actual_input)
+    board.log(f"Logged: Measured VIN={calculated_vin}, Actual VIN={actual_input}")
+    return calculated_vin
+
+
+def capture_evaluation_point(board, actual_input):
+    """Sample the board once and log the calibrated VIN error."""
+    with span("serial_read") as trace:
+        data = board.ser and request_reading(board.ser, binary=USE_BINARY_FRAMES)
+        trace['ok'] = bool(data)
+    if not data:
+        board.log("❌ No data received. Check the connection; board dropped from the rig.")
+        board.active = False
+        return None
+
+    raw_adc, raw_voltage, calculated_vin, calibrated_vin = data
+    difference = round(actual_input - calibrated_vin, 4)
+    board.sinks["eval_filename"].write([raw_adc, raw_voltage, calculated_vin, calibrated_vin, actual_input, difference])
+    store_point(board, "eval_filename", [raw_adc, raw_voltage, calculated_vin, calibrated_vin, actual_input])
+
+    board.log(f"Logged: Raw ADC={raw_adc}, Calibrated VIN={calibrated_vin}, Actual={actual_input}, Diff={difference}")
+    return difference
+
+
+def fit_board(board):
+    """Fit the cubic calibration of one board and append the coefficients to its CSV."""
+    if len(board.measured_vin) < 4:
+        board.log("⚠️ Fewer than 4 points captured. Skipping calibration.")
+        return None
+
+    board.log("⚙️ Starting calibration process...")
+    board.coeffs = cubic_fit(board.measured_vin, board.actual_vin)
+    evaluate_fit(board.coeffs, board.measured_vin, board.actual_vin)
+
+    sink = board.sinks["calib_filename"]
+    sink.write([])
+    sink.write(["Cubic Fit Coefficients:"] + list(board.coeffs))
+    sink.close()
+    if board.store is not None:
+        board.store.update_session(board.store_sessions["calib_filename"], coeffs=board.coeffs)
+    return board.coeffs
+
+
+def provision_board(board):
+    """Store the board's coefficients over serial. Returns the NVS version or None."""
+    if board.coeffs is None or not board.session.is_open:
+        return None
+    with board.session.phase("provision"):
+        version = provision_coefficients(board.ser, board.coeffs)
+    if version is not None:
+        board.log(f"✅ Provisioned coefficients (version {version}).")
+        if board.store is not None and "calib_filename" in board.store_sessions:
+            board.store.update_session(board.store_sessions["calib_filename"], provisioned_version=version)
+    return version
+
+
+def flash_boards(boards, ino_filepath, board_fqbn):
+    """Upload copies of the sketch with each board's coefficients as defaults, then store them in NVS too.
+
+    The copies are built one after the other (they share one build directory) and uploaded in parallel.
+    """
+    builds = {}
+    for board in boards:
+        if board.coeffs is None:
+            continue
+        board.log("🔹 Building calibrated firmware...")
+        with board.session.phase("flash"), tracer.bound(board=board.board_no, port=board.port):
+            sketch = board_sketch(ino_filepath, board.board_no)
+            if not update_ino_defaults(sketch, board.coeffs):
+                continue
+            with span("compile") as trace:
+                output_dir = build_sketch(sketch, board_fqbn)
+                trace['ok'] = output_dir is not None
+        if output_dir is not None:
+            builds[board.port] = output_dir
+    flashing = [b for b in boards if b.port in builds]
+    if not flashing:
+        return
+
+    for board in flashing:
+        board.session.close()
+    with span("upload", ports=len(builds)) as trace:
+        results = upload_many(builds, board_fqbn, list(builds))
+        trace['ok'] = all(ok for ok, _ in results.values())
+    for board in flashing:
+        ok, seconds = results[board.port]
+        board.session.phase_times["flash"] = board.session.phase_times.get("flash", 0.0) + seconds
+        if ok:
+            forget_unsupported(board.board_no)
+        else:
+            board.log("❌ Upload failed; the board keeps its previous firmware.")
+    # Boards whose upload failed still take their port back
+    run_on_all(flashing, open_board)
+    run_on_all([b for b in flashing if results[b.port][0]], provision_board)
+
+
+def flash_generic_firmware(boards, ino_filepath, board_fqbn):
+    """Build the sketch once and upload it to every board in parallel before calibrating."""
+    output_dir = build_sketch(ino_filepath, board_fqbn)
+    if output_dir is None:
+        return False
+    run_on_all(boards, close_board)
+    results = upload_many(output_dir, board_fqbn, [b.port for b in boards])
+    for board in boards:
+        ok, seconds = results[board.port]
+        board.session.phase_times["flash"] = board.session.phase_times.get("flash", 0.0) + seconds
+        if ok:
+            forget_unsupported(board.board_no)
+        else:
+            board.log("❌ Upload failed. Skipping this board.")
+            board.active = False
+    return True
+
+
+def broadcast_loop(boards, capture):
+    """Prompt for each actual voltage and sample every board in parallel."""
+    while any(b.active for b in boards):
+        try:
+            with span("operator_input"):
+                user_input = input("Enter 'a' to input Actual Voltage, or 'q' to finish: ").strip().lower()
+            if user_input == 'q':
+                break
+            elif user_input == 'a':
+                with span("operator_input"):
+                    actual_input = float(input("Actual Input Voltage: "))
+                print("Waiting for serial data...")
+                results = run_on_all(boards, capture, actual_input)
+                received = sum(1 for r in results.values() if r is not None)
+                print(f"📥 {received}/{len(results)} boards logged at {actual_input}V")
+        except ValueError:
+            print("Invalid input, please enter a valid number.")
+        except KeyboardInterrupt:
+            print("Exiting...")
+            break
+
+
+def sample_loop(boards, capture):
+    """Sweep with the programmable supply when one is configured, otherwise prompt the operator."""
+    if not SUPPLY:
+        broadcast_loop(boards, capture)
+        return
+
+    supply = open_supply(SUPPLY, meter_spec=METER)
+    print(f"🔌 Supply: {supply.identify()}")
+
+    def capture_all(actual_input):
+        results = run_on_all(boards, capture, actual_input)
+        received = sum(1 for r in results.values() if r is not None)
+        print(f"📥 {received}/{len(results)} boards logged at {actual_input}V")
+        return received or None
+
+    run_sweep(supply, get_sweep_plan(), capture_all)
+    supply.close()
+
+
+def run_rig(boards, ino_filepath, board_fqbn):
+    """Flash, calibrate and/or evaluate the boards (main() closes everything afterwards)."""
+    if input("\nFlash adc_for_calib.ino to all boards first? (y/n): ").strip().lower() == 'y':
+        if not flash_generic_firmware(boards, ino_filepath, board_fqbn):
+            return
+    run_on_all(boards, open_board)
+    if not any(b.active for b in boards):
+        return
+
+    mode = input("\nSelect mode - Calibration (c) or Evaluation (e): ").strip().lower()
+    while mode not in ['c', 'e']:
+        mode = input("Invalid choice. Enter 'c' for Calibration or 'e' for Evaluation: ").strip().lower()
+
+    if mode == 'c':
+        print("\n🔧 Starting Calibration Mode...\n")
+        resume = ask_resume(boards, "calib_filename", CALIB_HEADERS)
+        run_on_all(boards, open_sink, "calib_filename", CALIB_HEADERS, resume)
+        with all_phases(boards, "calibration"):
+            sample_loop(boards, capture_calibration_point)
+
+        # Boards dropped mid-sweep still get fitted on the points they logged
+        for board in boards:
+            board.active = True
+        with all_phases(boards, "fit"):
+            run_on_all(boards, fit_board)
+        # Boards running the generic firmware take their coefficients over serial;
+        # only older images still need a per-board recompile
+        versions = run_on_all(boards, provision_board)
+        flash_boards([b for b in boards if versions.get(b.board_no) is None], ino_filepath, board_fqbn)
+        print("✅ Calibration completed for all boards.")
+
+        choice = input("\nDo you want to proceed with Evaluation Mode? (y/n): ").strip().lower()
+        if choice != 'y':
+            print("Exiting program.")
+            return
+        # Sessions take their port back after flashing; this only retries lost ones
+        run_on_all(boards, open_board)
+
+    print("\n📊 Starting Evaluation Mode...\n")
+    resume = ask_resume(boards, "eval_filename", EVAL_HEADERS)
+    run_on_all(boards, open_sink, "eval_filename", EVAL_HEADERS, resume)
+    with all_phases(boards, "evaluation"):
+        sample_loop(boards, capture_evaluation_point)
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    test_dir = os.path.join(script_dir, "tests")
+    os.makedirs(test_dir, exist_ok=True)
+    ino_filepath = os.path.join(script_dir, "adc_for_calib.ino")
+    board_fqbn = "esp32:esp32:esp32"  # Change this based on your board
+
+    ports = detect_serial_ports()
+    if not ports:
+        print("No valid serial ports detected.")
+        return
+    print(f"🧰 Rig mode: {len(ports)} port(s) detected: {', '.join(ports)}")
+    tracer.open(session_trace_path("rig"))
+
+    boards = []
+    try:
+        boards = assign_board_numbers(ports, test_dir)
+        store = SampleStore() if STORE_SAMPLES else None
+        for board in boards:
+            board.store = store
+        run_rig(boards, ino_filepath, board_fqbn)
+    finally:
+        # Also on early exits: flush the store index, close ports and CSVs, close the trace
+        finish(boards)
+
+
+if __name__ == "__main__":
+    main()
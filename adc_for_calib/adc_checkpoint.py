@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Apr 28 08:47:22 2025
+
+@author: nichm
+
+Checkpoints for interrupted calibration sessions.
+
+The calibration state of a board (collected points, sweep plan and position,
+firmware coefficient version, stage) is saved as JSON after every point. The
+file is written to a temporary name and swapped in with os.replace(), so a
+crash or Ctrl-C never leaves a half-written checkpoint behind.
+"""
+
+import json
+import os
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CHECKPOINT_DIR = os.path.join(SCRIPT_DIR, "checkpoints")
+
+
+def checkpoint_path(board_no, checkpoint_dir=CHECKPOINT_DIR):
+    return os.path.join(checkpoint_dir, f"sarq_checkpoint-{board_no}.json")
+
+
+def write_json_atomic(path, data):
+    """Write JSON to path so readers see either the old or the new file, never a partial one."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file, indent=2)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+class Checkpoint:
+    """Calibration progress of one board, saved after every change."""
+
+    def __init__(self, board_no, checkpoint_dir=CHECKPOINT_DIR):
+        self.path = checkpoint_path(board_no, checkpoint_dir)
+        self.state = {
+            'board_no': board_no,
+            'port': None,
+            'stage': 'capture',
+            'measured_vin': [],
+            'actual_vin': [],
+            'sweep_plan': None,
+            'sweep_position': 0,
+            'coeff_version': None,
+            'coeffs': None,
+            'model': None,  # {'name', 'params'} when a model other than the cubic is flashed
+            'started': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'updated': None,
+        }
+
+    @classmethod
+    def load(cls, board_no, checkpoint_dir=CHECKPOINT_DIR):
+        """The saved checkpoint of a board, or None if there is none (or it is unreadable)."""
+        checkpoint = cls(board_no, checkpoint_dir)
+        try:
+            with open(checkpoint.path) as file:
+                checkpoint.state.update(json.load(file))
+        except FileNotFoundError:
+            return None
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"⚠️ Ignoring unreadable checkpoint {checkpoint.path}: {e}")
+            return None
+        return checkpoint
+
+    def __getitem__(self, key):
+        return self.state[key]
+
+    @property
+    def points(self):
+        return len(self.state['measured_vin'])
+
+    def remaining_plan(self):
+        """Sweep setpoints not captured yet, or None when the sweep had no plan."""
+        plan = self.state['sweep_plan']
+        return None if plan is None else plan[self.state['sweep_position']:]
+
+    def update(self, **fields):
+        self.state.update(fields)
+        self.save()
+
+    def record_point(self, measured, actual, position=None):
+        """Add a point; position is the sweep index after it (default: one further than before)."""
+        self.state['measured_vin'].append(measured)
+        self.state['actual_vin'].append(actual)
+        self.state['sweep_position'] = self.state['sweep_position'] + 1 if position is None else position
+        self.save()
+
+    def save(self):
+        self.state['updated'] = time.strftime("%Y-%m-%d %H:%M:%S")
+        write_json_atomic(self.path, self.state)
+
+    def clear(self):
+        """Remove the checkpoint once the session no longer needs it."""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def describe(self):
+        plan = self.state['sweep_plan']
+        position = f", sweep {self.state['sweep_position']}/{len(plan)}" if plan else ""
+        return (f"{self.points} point(s){position}, stage '{self.state['stage']}', "
+                f"coefficients v{self.state['coeff_version']}, saved {self.state['updated']}")
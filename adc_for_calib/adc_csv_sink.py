@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Apr 25 10:05:17 2025
+
+@author: nichm
+
+CSV logging with one open handle per file.
+
+A CsvSink keeps its file open for the whole session and flushes every
+flush_every rows (optionally with fsync), instead of reopening the file for
+every sample. With resume=True an existing file with the same header is
+appended to instead of being overwritten; a row cut off by a crash is
+trimmed first, and so is the trailing coefficients block of a finished
+sweep, so the new rows continue the data rows that read_rows() returns.
+"""
+
+import csv
+import os
+import time
+
+
+def read_rows(filename, headers):
+    """Data rows of an existing CSV whose header matches, or None.
+
+    Reading stops at the first blank row (the trailing coefficients block).
+    """
+    try:
+        with open(filename, newline='') as file:
+            reader = csv.reader(file)
+            if next(reader, None) != list(headers):
+                return None
+            rows = []
+            for row in reader:
+                if not row:
+                    break
+                rows.append(row)
+            return rows
+    except FileNotFoundError:
+        return None
+
+
+def trim_partial_row(filename):
+    """Drop a last line without newline (a row cut off mid-write)."""
+    with open(filename, 'rb+') as file:
+        data = file.read()
+        if data and not data.endswith(b'\n'):
+            file.truncate(data.rfind(b'\n') + 1)
+
+
+def truncate_after_rows(filename, count):
+    """Cut everything after the header and the first count data rows. Returns True if anything was cut."""
+    with open(filename, 'rb+') as file:
+        for _ in range(count + 1):
+            file.readline()
+        end = file.tell()
+        if not file.read(1):
+            return False
+        file.truncate(end)
+        return True
+
+
+class CsvSink:
+    """Single-handle CSV writer with a flush/fsync policy."""
+
+    def __init__(self, filename, headers, flush_every=1, flush_interval=None, fsync=False, resume=False):
+        self.filename = filename
+        self.headers = list(headers)
+        self.flush_every = max(1, flush_every)
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.pending = 0
+        self.rows_written = 0
+        self.last_flush = time.monotonic()
+
+        self.resumed_rows = read_rows(filename, self.headers) if resume else None
+        if self.resumed_rows is not None:
+            trim_partial_row(filename)
+            self.resumed_rows = read_rows(filename, self.headers)
+            if truncate_after_rows(filename, len(self.resumed_rows)):
+                print(f"✂️ Dropped the coefficients block after the {len(self.resumed_rows)} logged row(s) "
+                      f"of {os.path.basename(filename)}; it is refitted when the sweep ends.")
+            self.file = open(filename, mode='a', newline='')
+            self.writer = csv.writer(self.file)
+        else:
+            self.resumed_rows = []
+            self.file = open(filename, mode='w', newline='')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(self.headers)
+            self.flush()
+
+    @property
+    def resumed(self):
+        return len(self.resumed_rows) > 0
+
+    def write(self, row):
+        """Queue one row; it reaches the file at the next flush."""
+        self.writer.writerow(row)
+        self.rows_written += 1
+        self.pending += 1
+        if self.pending >= self.flush_every or (
+                self.flush_interval is not None and time.monotonic() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def write_many(self, rows):
+        for row in rows:
+            self.write(row)
+
+    def flush(self, sync=None):
+        """Push buffered rows to the OS (and to disk when fsync is on)."""
+        if self.file.closed:
+            return
+        self.file.flush()
+        if self.fsync if sync is None else sync:
+            os.fsync(self.file.fileno())
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        """Flush, sync to disk and close."""
+        if not self.file.closed:
+            self.flush(sync=True)
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -8,11 +8,11 @@ Created on Fri Mar 21 15:05:06 2025
 import serial
 import serial.tools.list_ports
 import csv
-import time
 import re
 import os
 import numpy as np
 from scipy.optimize import curve_fit
+from adc_serial import wait_until_ready
 
 def get_board_number():
     """Prompt user for board number."""
@@ -41,17 +41,28 @@ def list_serial_ports():
             return filtered_ports[int(choice) - 1]
         print("Invalid selection. Try again.")
 
-def setup_serial(port, baudrate=115200):
-    """Initialize serial connection."""
+def setup_serial(port, baudrate=115200, reset=False):
+    """Open the serial connection and wait until the firmware answers."""
     try:
-        ser = serial.Serial(port, baudrate, timeout=2, dsrdtr=False, rtscts=False)
-        time.sleep(2)
-        print(f"Connected to {port}")
-        return ser
+        ser = serial.Serial(None, baudrate, timeout=2, dsrdtr=False, rtscts=False)
+        ser.port = port
+        if not reset:
+            # Keep DTR/RTS released so opening the port does not reboot the ESP32
+            ser.dtr = False
+            ser.rts = False
+        ser.open()
     except serial.SerialException as e:
         print(f"Error: {e}")
         return None
 
+    latency = wait_until_ready(ser, parse_serial_data)
+    if latency is None:
+        print(f"❌ {port} opened but the board did not answer.")
+        ser.close()
+        return None
+    print(f"Connected to {port} (ready in {latency:.2f}s)")
+    return ser
+
 def parse_serial_data(line):
     """Extract values from the serial output."""
     match = re.search(r"Raw ADC: (\d+) \| ESP ADC Cal Raw to Voltage: ([\d.]+) \| Calculated VIN: ([\d.]+) \| Calibrated VIN: ([\d.]+)", line)
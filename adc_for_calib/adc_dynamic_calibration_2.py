@@ -7,12 +7,50 @@ Created on Fri Mar 21 15:05:06 2025
 
 import serial
 import serial.tools.list_ports
-import csv
 import time
 import re
 import os
 import numpy as np
-import subprocess
+from contextlib import contextmanager
+from adc_build_cache import board_sketch, build_sketch, upload_many
+from adc_serial import wait_until_ready
+from adc_frame_protocol import FrameError, FRAME_DELIMITER, MAX_FRAME_SIZE, decode_frame, as_reading
+from adc_stream import StreamReader
+from adc_settle import auto_capture
+from adc_instruments import open_supply, run_sweep
+from adc_trace import tracer, span, session_trace_path
+from adc_csv_sink import CsvSink, read_rows
+from adc_checkpoint import Checkpoint
+from adc_sample_store import SampleStore
+from adc_model_selection import select_model, as_cubic, generate_model_formula, model_params, model_row
+from adc_esp_adc_cal import forget_unsupported, get_characterization
+from adc_online_fit import OnlineFit
+from adc_sweep_planner import adaptive_plan, next_setpoint
+from adc_fleet_prior import load_prior, prior_fit
+
+USE_BINARY_FRAMES = False  # Set True to read samples as CRC-checked binary frames ('b' command)
+STREAM_RATE_HZ = 0         # >0: stream continuously at this rate and average each point over STREAM_WINDOW samples
+STREAM_WINDOW = 256
+AUTO_CAPTURE = False       # With streaming: record each point automatically once the reading settles
+SUPPLY = None              # Programmable supply for hands-off sweeps: "sim", "tcp:<host>:5025" or "serial:<port>@9600"
+METER = None               # Optional DMM reading the true input with SUPPLY: "tcp:<host>:5025" or "serial:<port>@9600"
+CSV_FLUSH_EVERY = 1        # Rows buffered before the CSV is flushed
+CSV_FSYNC = False          # Also fsync on every flush (the file is always synced on close)
+STORE_SAMPLES = True       # Also append every point to the sample store (adc_sample_store.py)
+AUTO_MODEL_SELECTION = False  # Cross-validate other models against the cubic (adc_model_selection.py)
+BOARD_FIRMWARE = False     # With AUTO_MODEL_SELECTION: let models the generic firmware can't store win; flashed as a per-board sketch copy
+ONLINE_FIT = True          # Refit after every point and show the coefficients with confidence intervals (adc_online_fit.py)
+FIT_TARGET_ERROR = 0.020   # V; the online fit converges once new points and the confidence band are within this
+EARLY_STOP = True          # Supply/auto-capture sweeps: stop once the online fit has converged
+ADAPTIVE_SWEEP = False     # With ONLINE_FIT: pick each voltage from the fit (adc_sweep_planner.py) instead of asking for a plan
+MAX_SWEEP_POINTS = 16      # Adaptive sweeps stop here even if the fit has not converged
+FLEET_PRIOR = False        # With ONLINE_FIT: MAP fit under the fleet prior (adc_fleet_prior.py), from as few as 3 points
+PRIOR_MIN_POINTS = 3
+
+CALIB_HEADERS = ["Measured VIN", "Actual VIN"]
+EVAL_HEADERS = ["Raw ADC", "ESP ADC Cal Raw Voltage", "Calculated VIN", "Calibrated VIN", "Actual Input", "Difference"]
+
+SERIAL_PATTERN = re.compile(r"Raw ADC: (\d+) \| ESP ADC Cal Raw to Voltage: ([\d.]+) \| Calculated VIN: ([\d.]+) \| Calibrated VIN: ([\d.]+)")
 
 def get_board_number():
     """Prompt user for board number."""
@@ -22,10 +60,14 @@ def get_board_number():
             return board_no
         print("Invalid input. Enter a 4-digit board number.")
 
+def detect_serial_ports():
+    """Return every non-Bluetooth serial port device."""
+    ports = serial.tools.list_ports.comports()
+    return [p.device for p in ports if "Bluetooth" not in p.description]
+
 def list_serial_ports():
     """List available serial ports and let the user select one."""
-    ports = serial.tools.list_ports.comports()
-    filtered_ports = [p.device for p in ports if "Bluetooth" not in p.description]
+    filtered_ports = detect_serial_ports()
 
     if not filtered_ports:
         print("No valid serial ports detected.")
@@ -41,20 +83,35 @@ def list_serial_ports():
             return filtered_ports[int(choice) - 1]
         print("Invalid selection. Try again.")
 
-def setup_serial(port, baudrate=115200):
-    """Initialize serial connection."""
-    try:
-        ser = serial.Serial(port, baudrate, timeout=2, dsrdtr=False, rtscts=False)
-        time.sleep(2)
-        print(f"Connected to {port}")
-        return ser
-    except serial.SerialException as e:
-        print(f"Error: {e}")
-        return None
+def setup_serial(port, baudrate=115200, reset=False):
+    """Open the serial connection and wait until the firmware answers."""
+    with span("setup_serial", port=port) as trace:
+        try:
+            ser = serial.Serial(None, baudrate, timeout=2, dsrdtr=False, rtscts=False)
+            ser.port = port
+            if not reset:
+                # Keep DTR/RTS released so opening the port does not reboot the ESP32
+                ser.dtr = False
+                ser.rts = False
+            ser.open()
+        except serial.SerialException as e:
+            print(f"Error: {e}")
+            trace['ok'] = False
+            return None
+
+        latency = wait_until_ready(ser, parse_serial_data)
+        if latency is None:
+            print(f"❌ {port} opened but the board did not answer.")
+            ser.close()
+            trace['ok'] = False
+            return None
+        trace['ready'] = round(latency, 3)
+    print(f"Connected to {port} (ready in {latency:.2f}s)")
+    return ser
 
 def parse_serial_data(line):
     """Extract values from the serial output."""
-    match = re.search(r"Raw ADC: (\d+) \| ESP ADC Cal Raw to Voltage: ([\d.]+) \| Calculated VIN: ([\d.]+) \| Calibrated VIN: ([\d.]+)", line)
+    match = SERIAL_PATTERN.search(line)
     if match:
         return (
             int(match.group(1)),    # Raw ADC
@@ -64,9 +121,190 @@ def parse_serial_data(line):
         )
     return None
 
+def read_binary_sample(ser, max_attempts=10):
+    """Send 'b' and decode the framed reply. Returns (seq, raw ADC, ADC cal mV, VIN, calibrated VIN) or None."""
+    ser.reset_input_buffer()
+    ser.write(b'b')
+    for _ in range(max_attempts):
+        frame = ser.read_until(FRAME_DELIMITER, MAX_FRAME_SIZE * 2)
+        if not frame:
+            continue
+        try:
+            return decode_frame(frame.rstrip(FRAME_DELIMITER))
+        except FrameError as e:
+            print(f"⚠️ Corrupted frame ({e}), requesting again.")
+            ser.reset_input_buffer()
+            ser.write(b'b')
+    return None
+
+def request_reading(ser, max_attempts=10, binary=False):
+    """Ask the board for a reading and return it parsed, or None if it never answers.
+
+    With binary=True the framed protocol is used: full float precision and CRC-checked.
+    """
+    if binary:
+        sample = read_binary_sample(ser, max_attempts)
+        return as_reading(sample) if sample else None
+
+    ser.reset_input_buffer()
+    ser.write(b'a')
+    for _ in range(max_attempts):
+        line = ser.readline().decode('utf-8', errors='replace').strip()
+        data = parse_serial_data(line) if line else None
+        if data:
+            return data
+    return None
+
+def start_stream(ser):
+    """Start a background stream reader when streaming mode is enabled, otherwise return None."""
+    if not STREAM_RATE_HZ:
+        return None
+    print(f"📡 Streaming at {STREAM_RATE_HZ} Hz, {STREAM_WINDOW} samples per point.")
+    return StreamReader(ser, STREAM_RATE_HZ).start()
+
+def read_point(ser, reader=None):
+    """Reading for one capture point: a windowed stream average when streaming, a single request otherwise."""
+    if reader is None:
+        return request_reading(ser, binary=USE_BINARY_FRAMES)
+
+    stats = reader.capture(STREAM_WINDOW)
+    if stats is None:
+        return None
+    vin = stats['vin']
+    print(f"📈 {stats['n']} samples: VIN mean={vin['mean']:.4f} median={vin['median']:.4f} std={vin['std']:.4f}")
+    return (
+        round(stats['raw_adc']['mean'], 2),
+        round(stats['adc_cal_mv']['mean'] / 1000.0, 6),
+        round(vin['mean'], 6),
+        round(stats['calibrated_vin']['mean'], 6),
+    )
+
+def get_sweep_plan():
+    """Ask for the supply voltages of an automatic sweep, in the order they will be set."""
+    while True:
+        plan = input("Planned input voltages, in order (comma separated): ").strip()
+        try:
+            return [float(v) for v in plan.split(",") if v.strip()]
+        except ValueError:
+            print("Invalid input, please enter numbers separated by commas.")
+
+def parse_coefficients(line):
+    """Extract the provisioned calibrateVIN() coefficients and their version from the serial output."""
+    match = re.search(r"Calibration Coefficients: ([-+\d.eE]+), ([-+\d.eE]+), ([-+\d.eE]+), ([-+\d.eE]+) \| Version: (\d+)", line)
+    if match:
+        return [float(match.group(i)) for i in range(1, 5)], int(match.group(5))
+    return None
+
+def read_coefficients(ser, command=b'r', max_attempts=2):
+    """Ask the board for its active coefficients. Returns (coeffs, version) or None on older firmware."""
+    ser.reset_input_buffer()
+    ser.write(command)
+    for _ in range(max_attempts):
+        line = ser.readline().decode('utf-8', errors='replace').strip()
+        if line.startswith("Calibration Error"):
+            print(f"❌ {line}")
+            return None
+        result = parse_coefficients(line) if line else None
+        if result:
+            return result
+    return None
+
+def provision_coefficients(ser, coeffs):
+    """Store the coefficients in the board's NVS over serial and verify the read-back. Returns the new version or None."""
+    values = " ".join(f"{c:.10g}" for c in coeffs)
+    result = read_coefficients(ser, command=f"c {values}\n".encode())
+    if result is None:
+        print("⚠️ Board did not acknowledge the coefficients (firmware without runtime calibration?).")
+        return None
+
+    stored, version = result
+    if not np.allclose(stored, [float(f"{c:.10g}") for c in coeffs], rtol=1e-9, atol=0):
+        print(f"❌ Read-back mismatch: sent {values}, board has {stored}")
+        return None
+    print(f"✅ Coefficients stored on the board (version {version}).")
+    return version
+
+class BoardSession:
+    """Own one board's serial port for its whole calibration/flash/evaluation lifecycle."""
+
+    def __init__(self, port, baudrate=115200):
+        self.port = port
+        self.baudrate = baudrate
+        self.ser = None
+        self.reconnects = 0
+        self.connect_latencies = []
+        self.phase_times = {}
+
+    @property
+    def is_open(self):
+        return self.ser is not None and self.ser.is_open
+
+    def open(self):
+        """Open the port (or take it back) and wait for the firmware. Returns the handle or None."""
+        if self.is_open:
+            return self.ser
+        start = time.monotonic()
+        if self.ser is None:
+            self.ser = setup_serial(self.port, self.baudrate)
+            if self.ser is None:
+                return None
+        else:
+            # Reuse the same handle and its settings instead of building a new one
+            with span("reconnect", port=self.port) as trace:
+                try:
+                    self.ser.open()
+                except serial.SerialException as e:
+                    print(f"Error: {e}")
+                    trace['ok'] = False
+                    return None
+                if wait_until_ready(self.ser, parse_serial_data) is None:
+                    print(f"❌ {self.port} reopened but the board did not answer.")
+                    self.ser.close()
+                    trace['ok'] = False
+                    return None
+            self.reconnects += 1
+            print(f"♻️ Reconnected to {self.port}")
+        self.connect_latencies.append(time.monotonic() - start)
+        return self.ser
+
+    @contextmanager
+    def released(self):
+        """Hand the port to an external tool (e.g. arduino-cli upload) and take it back afterwards."""
+        was_open = self.is_open
+        if was_open:
+            self.ser.close()
+        try:
+            yield self.port
+        finally:
+            if was_open:
+                self.open()
+
+    @contextmanager
+    def phase(self, name):
+        """Accumulate the wall time spent in a named phase."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phase_times[name] = self.phase_times.get(name, 0.0) + time.monotonic() - start
+
+    def close(self):
+        if self.is_open:
+            self.ser.close()
+
+    def summary(self):
+        """Print how long each phase took and how often the port was reconnected."""
+        print(f"\n⏱️ Session summary for {self.port}:")
+        for name, seconds in self.phase_times.items():
+            print(f"   {name:<12} {seconds:8.1f}s")
+        if self.connect_latencies:
+            print(f"   Connects: {len(self.connect_latencies)} (reconnects: {self.reconnects}), "
+                  f"slowest ready: {max(self.connect_latencies):.2f}s")
+
 def cubic_fit(x_vals, y_vals):
     """Perform a cubic polynomial fit."""
-    coeffs = np.polyfit(x_vals, y_vals, 3)
+    with span("cubic_fit", points=len(x_vals)):
+        coeffs = np.polyfit(x_vals, y_vals, 3)
     print(f"Cubic Fit Coefficients: {coeffs}")
     return coeffs
 
@@ -77,6 +315,26 @@ def generate_arduino_formula(coeffs):
         return ({coeffs[0]:.6f} * vin * vin * vin) + ({coeffs[1]:.6f} * vin * vin) + ({coeffs[2]:.6f} * vin) + {coeffs[3]:.6f}; 
     }}
     """
+
+def generate_default_coeffs(coeffs):
+    """Generate the calCoeffs[] initializer: the coefficients the firmware uses until NVS holds some."""
+    return f"double calCoeffs[4] = {{{', '.join(f'{c:.10g}' for c in coeffs)}}};"
+
+def update_ino_defaults(ino_filepath, coeffs):
+    """Replace the calCoeffs[] defaults in the .ino file, leaving the provisionable calibrateVIN() as it is."""
+    with span("update_ino"):
+        with open(ino_filepath, 'r') as file:
+            ino_code = file.read()
+        updated_code, count = re.subn(r"double\s+calCoeffs\s*\[\s*4\s*\]\s*=\s*\{[^}]*\}\s*;",
+                                      generate_default_coeffs(coeffs), ino_code)
+        if not count:
+            print(f"❌ No calCoeffs[4] defaults in {ino_filepath}, nothing updated.")
+            return False
+        with open(ino_filepath, 'w') as file:
+            file.write(updated_code)
+    print(f"✅ Updated the default coefficients in {ino_filepath}.")
+    return True
+
 def evaluate_fit(coeffs, measured, actual):
     """Evaluate the cubic fit by comparing predicted values with actual."""
     predicted = np.polyval(coeffs, measured)
@@ -107,107 +365,171 @@ def get_valid_ino_filepath(script_dir):
         print(f"File '{ino_filename}' not found. Please enter a valid filename.")
 
 def update_ino_file(ino_filepath, new_function):
-    """Replace the existing calibrateVIN() function in the .ino file."""
+    """Replace the function of the same name (calibrateVIN() unless new_function defines another) in the .ino file."""
     try:
-        with open(ino_filepath, 'r') as file:
-            ino_code = file.read()
-
-        # Find and replace the existing calibrateVIN() function
-        pattern = re.compile(r"float\s+calibrateVIN\s*\(.*?\)\s*\{.*?\}", re.DOTALL)
-        updated_code = pattern.sub(new_function.strip(), ino_code)
-
-        with open(ino_filepath, 'w') as file:
-            file.write(updated_code)
+        with span("update_ino"):
+            with open(ino_filepath, 'r') as file:
+                ino_code = file.read()
+
+            # Find and replace the existing function, braces matched so if/else bodies survive
+            name = re.search(r"float\s+(\w+)\s*\(", new_function).group(1)
+            match = re.search(rf"float\s+{name}\s*\(.*?\)\s*\{{", ino_code, re.DOTALL)
+            if not match:
+                print(f"❌ No {name}() in {ino_filepath}, nothing updated.")
+                return False
+            depth, end = 1, match.end()
+            while depth and end < len(ino_code):
+                depth += {'{': 1, '}': -1}.get(ino_code[end], 0)
+                end += 1
+            updated_code = ino_code[:match.start()] + new_function.strip() + ino_code[end:]
+
+            with open(ino_filepath, 'w') as file:
+                file.write(updated_code)
 
         print(f"✅ Updated {ino_filepath} with new calibration function.")
+        return True
     except FileNotFoundError:
         print(f"Error: File '{ino_filepath}' not found.")
         ino_filepath = get_valid_ino_filepath(os.path.dirname(ino_filepath))
-        update_ino_file(ino_filepath, new_function)  # Retry update with new file path
+        return update_ino_file(ino_filepath, new_function)  # Retry update with new file path
     except Exception as e:
         print(f"Error updating .ino file: {e}")
-
-def run_evaluation(ser, filename):
+    return False
+
+def open_sink(filename, headers):
+    """Open the session's CSV, offering to resume it when it already holds logged points."""
+    rows = read_rows(filename, headers)
+    resume = False
+    if rows:
+        choice = input(f"\n{os.path.basename(filename)} already has {len(rows)} logged point(s). "
+                       "Resume (r) or start over (o)? ").strip().lower()
+        while choice not in ['r', 'o']:
+            choice = input("Invalid choice. Enter 'r' to resume or 'o' to start over: ").strip().lower()
+        resume = choice == 'r'
+    sink = CsvSink(filename, headers, flush_every=CSV_FLUSH_EVERY, fsync=CSV_FSYNC, resume=resume)
+    if sink.resumed:
+        print(f"↩️ Resuming with {len(sink.resumed_rows)} point(s) from {filename}")
+    return sink
+
+def open_store_session(board_no, kind, firmware_version=None, session_id=None):
+    """Start (or continue) a sample-store session for the board. Returns (store, session id), or (None, None) when off."""
+    if not STORE_SAMPLES:
+        return None, None
+    try:
+        store = SampleStore()
+        if session_id is not None and str(session_id) in store.index['sessions']:
+            return store, session_id
+        return store, store.new_session(board_no, kind, firmware_version=firmware_version)
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Sample store unavailable ({e}), logging to CSV only.")
+        return None, None
+
+def open_calibration(ser, port, board_no, calib_filename):
+    """Resume the board's checkpoint or start a new one, and open the calibration CSV. Returns (checkpoint, sink)."""
+    checkpoint = Checkpoint.load(board_no)
+    current = read_coefficients(ser)
+    current_version = current[1] if current else None
+    if checkpoint is not None and checkpoint.points:
+        print(f"\n💾 Checkpoint found for board {board_no}: {checkpoint.describe()}")
+        if input("Resume this calibration? (y/n): ").strip().lower() == 'y':
+            if checkpoint['coeff_version'] != current_version:
+                print(f"⚠️ Board reports coefficients v{current_version}, the checkpoint was taken at v{checkpoint['coeff_version']}.")
+            checkpoint.update(port=port)
+            sink = CsvSink(calib_filename, CALIB_HEADERS, flush_every=CSV_FLUSH_EVERY, fsync=CSV_FSYNC, resume=True)
+            if len(sink.resumed_rows) != checkpoint.points:
+                # The CSV lost or gained rows since the checkpoint: rebuild it from the checkpoint
+                sink.close()
+                sink = CsvSink(calib_filename, CALIB_HEADERS, flush_every=CSV_FLUSH_EVERY, fsync=CSV_FSYNC)
+                sink.write_many(zip(checkpoint['measured_vin'], checkpoint['actual_vin']))
+            print(f"↩️ Resuming with {checkpoint.points} point(s).")
+            return checkpoint, sink
+        checkpoint.clear()
+        sink = CsvSink(calib_filename, CALIB_HEADERS, flush_every=CSV_FLUSH_EVERY, fsync=CSV_FSYNC)
+    else:
+        sink = open_sink(calib_filename, CALIB_HEADERS)
+
+    checkpoint = Checkpoint(board_no)
+    checkpoint.state.update(port=port, coeff_version=current_version)
+    for row in sink.resumed_rows:
+        checkpoint.state['measured_vin'].append(float(row[0]))
+        checkpoint.state['actual_vin'].append(float(row[1]))
+    checkpoint.state['sweep_position'] = checkpoint.points
+    checkpoint.save()
+    return checkpoint, sink
+
+def run_evaluation(ser, filename, board_no=None):
     """Continue logging measured VIN and actual VIN to CSV after calibration."""
     print("\n📊 Starting Evaluation Mode...\n")
-    with open(filename, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(["Raw ADC", "ESP ADC Cal Raw Voltage", "Calculated VIN", "Calibrated VIN", "Actual Input", "Difference"])
-
-        no_data_count = 0  # Counter to track how long we've been waiting
-
-        while True:
-            try:
-                # Prompt the user to trigger a new reading
-                user_input = input("Enter 'a' to input Actual Voltage, or 'q' to quit: ").strip().lower()
-                if user_input == 'q':
-                    "Exiting..."
-                    break
-                elif user_input == 'a':
-                    ser.write(b'a')  # Send 'a' to Arduino to request new data
-
-                    print("Waiting for serial data...")
-                    while True:
-                        line = ser.readline().decode('utf-8').strip()
-
-                        if not line:
-                            no_data_count += 1
-                            if no_data_count > 10:  # Stop waiting after 10 attempts
-                                print("❌ No data received from the Arduino. Please check the connection and restart the device.")
-                                return
-                            continue
-
-                        print(f"Received: {line}")
-                        match = re.search(r"Raw ADC: (\d+) \| ESP ADC Cal Raw to Voltage: ([\d.]+) \| Calculated VIN: ([\d.]+) \| Calibrated VIN: ([\d.]+)", line)
-                        if match:
-                            raw_adc = int(match.group(1))
-                            raw_voltage = float(match.group(2))
-                            calculated_vin = float(match.group(3))
-                            calibrated_vin = float(match.group(4))
-
-                            # Prompt for actual input voltage
+    store, store_session = None, None
+    if board_no is not None:
+        current = read_coefficients(ser)
+        store, store_session = open_store_session(board_no, 'eval', firmware_version=current[1] if current else None)
+        if store is not None and current:
+            store.update_session(store_session, coeffs=current[0])
+    reader = start_stream(ser)
+    try:
+        with open_sink(filename, EVAL_HEADERS) as sink:
+            while True:
+                try:
+                    # Prompt the user to trigger a new reading
+                    with span("operator_input"):
+                        user_input = input("Enter 'a' to input Actual Voltage, or 'q' to quit: ").strip().lower()
+                    if user_input == 'q':
+                        "Exiting..."
+                        break
+                    elif user_input == 'a':
+                        print("Waiting for serial data...")
+                        with span("serial_read") as trace:
+                            data = read_point(ser, reader)
+                            trace['ok'] = data is not None
+                        if not data:
+                            print("❌ No data received from the Arduino. Please check the connection and restart the device.")
+                            return
+
+                        raw_adc, raw_voltage, calculated_vin, calibrated_vin = data
+                        print(f"Received: Raw ADC={raw_adc}, ESP ADC Cal={raw_voltage}V, Calculated VIN={calculated_vin}, Calibrated VIN={calibrated_vin}")
+
+                        # Prompt for actual input voltage
+                        with span("operator_input"):
                             actual_input = input("Actual Input Voltage: ").strip()
-                            actual_input = float(actual_input)
-                            difference = round(actual_input - calibrated_vin,4)
-
-                            # Log to evaluation file immediately
-                            writer.writerow([raw_adc, raw_voltage, calculated_vin, calibrated_vin, actual_input, difference])
-                            print(f"Logged: Raw ADC={raw_adc}, Calibrated VIN={calibrated_vin}, Actual={actual_input}, Diff={difference}")
-
-                            # Reset no-data counter after receiving valid data
-                            no_data_count = 0  
-                            break  # Exit the inner while loop to wait for next 'a' input
-
-            except ValueError:
-                print("Invalid input, please enter a valid number.")
-            except KeyboardInterrupt:
-                print("Exiting...")
-                break
-            
+                        actual_input = float(actual_input)
+                        difference = round(actual_input - calibrated_vin,4)
+
+                        # Log to evaluation file immediately
+                        with span("csv_log"):
+                            sink.write([raw_adc, raw_voltage, calculated_vin, calibrated_vin, actual_input, difference])
+                            if store is not None:
+                                store.append(store_session, [[raw_adc, raw_voltage, calculated_vin, calibrated_vin, actual_input]])
+                        print(f"Logged: Raw ADC={raw_adc}, Calibrated VIN={calibrated_vin}, Actual={actual_input}, Diff={difference}")
+
+                except ValueError:
+                    print("Invalid input, please enter a valid number.")
+                except KeyboardInterrupt:
+                    print("Exiting...")
+                    break
+    finally:
+        if reader is not None:
+            reader.stop()
+        if store is not None:
+            store.close()
+
 def compile_and_upload(ino_filepath, board_fqbn, port):
-    """Compiles and uploads the .ino file to the Arduino board."""
+    """Compiles (through the build cache) and uploads the .ino file to the Arduino board."""
     try:
-        # Compile the sketch
-        compile_cmd = f'arduino-cli compile --fqbn {board_fqbn} "{ino_filepath}"'
-        print(f"🔹 Compiling: {compile_cmd}")
-        compile_result = subprocess.run(compile_cmd, shell=True, capture_output=True, text=True)
-
-        if compile_result.returncode != 0:
-            print(f"❌ Compilation failed:\n{compile_result.stderr}")
-            return
-
-        # Upload the compiled sketch
-        upload_cmd = f'arduino-cli upload --port {port} --fqbn {board_fqbn} "{ino_filepath}"'
-        print(f"🔹 Uploading: {upload_cmd}")
-        upload_result = subprocess.run(upload_cmd, shell=True, capture_output=True, text=True)
-
-        if upload_result.returncode == 0:
-            print("✅ Upload successful!")
-        else:
-            print(f"❌ Upload failed:\n{upload_result.stderr}")
+        with span("compile") as trace:
+            output_dir = build_sketch(ino_filepath, board_fqbn)
+            trace['ok'] = output_dir is not None
+        if output_dir is None:
+            return False
+
+        with span("upload", port=port) as trace:
+            ok, _ = upload_many(output_dir, board_fqbn, [port])[port]
+            trace['ok'] = ok
+        return ok
 
     except Exception as e:
         print(f"⚠️ Error during compile/upload: {e}")
+        return False
 
 def main():
     board_no = get_board_number()
@@ -219,13 +541,23 @@ def main():
     eval_filename = os.path.join(test_dir, f"sarq_eval-{board_no}.csv")
     calib_filename = os.path.join(test_dir, f"sarq_calib-{board_no}.csv")
 
+    # Per-session JSON-lines trace; summarize a batch with "python adc_trace.py"
+    tracer.open(session_trace_path(board_no), board=board_no)
+
     port = list_serial_ports()
     if port is None:
+        tracer.close()
         return
+    tracer.bind(port=port)
     
-    ser = setup_serial(port)
+    session = BoardSession(port)
+    ser = session.open()
     if ser is None:
+        tracer.close()
         return
+    # esp_adc_cal parameters for raw-domain fits and lookup tables (read once, then cached per board;
+    # firmware without 'e' is cached as unsupported so later starts skip the read timeouts)
+    get_characterization(ser, board_no)
 
     while True:
         # Ask user whether they want Calibration or Evaluation
@@ -235,101 +567,273 @@ def main():
         
         calibrate = mode == 'c'
 
-        if calibrate:
-            print("\n🔧 Starting Calibration Mode...\n")
-            csv_file = calib_filename
-            headers = ["Measured VIN", "Actual VIN"]
-        else:
-            csv_file = eval_filename
-            headers = ["Raw ADC", "ESP ADC Cal Raw Voltage", "Calculated VIN", "Calibrated VIN", "Actual Input", "Difference"]
-
-        # Open the correct CSV file and write headers
-        with open(csv_file, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(headers)
-
         measured_vin = []
         actual_vin = []
-
-        while True:
-            try:
+        sink = None
+        checkpoint = None
+        if calibrate:
+            print("\n🔧 Starting Calibration Mode...\n")
+            # One handle for the whole sweep; evaluation opens its own in run_evaluation()
+            # Every point is also checkpointed so an interrupted sweep can be resumed
+            checkpoint, sink = open_calibration(ser, port, board_no, calib_filename)
+            measured_vin = list(checkpoint['measured_vin'])
+            actual_vin = list(checkpoint['actual_vin'])
+            # A resumed sweep keeps appending to the store session it started
+            store, store_session = open_store_session(board_no, 'calib', checkpoint['coeff_version'],
+                                                      checkpoint.state.get('store_session'))
+            checkpoint.update(store_session=store_session)
+
+        fit = None
+        if calibrate and ONLINE_FIT:
+            prior = load_prior() if FLEET_PRIOR else None
+            if FLEET_PRIOR and prior is None:
+                print("⚠️ No fleet prior yet (run adc_fleet_prior.py); fitting from scratch.")
+            fit = prior_fit(prior, FIT_TARGET_ERROR) if prior else OnlineFit(target=FIT_TARGET_ERROR)
+            for calculated_vin, actual_input in zip(measured_vin, actual_vin):
+                fit.update(calculated_vin, actual_input)
+            if fit.n:
+                print(fit.status())
+
+        with session.phase("calibration" if calibrate else "evaluation"):
+            reader = start_stream(ser) if calibrate else None
+
+            def log_point(calculated_vin, actual_input, position=None, data=None):
+                with span("csv_log"):
+                    sink.write([calculated_vin, actual_input])
+                    checkpoint.record_point(calculated_vin, actual_input, position)
+                    if store is not None:
+                        raw_adc, raw_voltage, _, calibrated_vin = data or (None, None, None, None)
+                        store.append(store_session, [[raw_adc, raw_voltage, calculated_vin, calibrated_vin, actual_input]])
+                print(f"Logged: Measured VIN={calculated_vin}, Actual VIN={actual_input}")
+                measured_vin.append(calculated_vin)
+                actual_vin.append(actual_input)
+                if fit is not None:
+                    fit.update(calculated_vin, actual_input)
+                    fit.report()
+                return calculated_vin
+
+            adaptive = ADAPTIVE_SWEEP and fit is not None
+
+            def sweep_setpoints():
+                """Voltages for a supply/auto-capture sweep: chosen from the fit, or the (remaining) plan."""
+                if adaptive:
+                    return adaptive_plan(fit, measured_vin, actual_vin, MAX_SWEEP_POINTS)
+                return until_converged(planned_sweep())
+
+            def suggest_next():
+                """Manual sweeps: show the voltage the planner would pick next."""
+                if adaptive and not fit.converged():
+                    setpoint = next_setpoint(fit, measured_vin, actual_vin)
+                    if setpoint is not None:
+                        print(f"💡 Suggested next input: {setpoint:g}V")
+
+            def until_converged(plan):
+                """The plan's voltages, stopping early once the online fit has converged."""
+                for actual_input in plan:
+                    if EARLY_STOP and fit is not None and fit.converged():
+                        print(f"⏹️ Stopping the sweep early after {fit.n} points.")
+                        return
+                    yield actual_input
+
+            def planned_sweep():
+                """The sweep plan, or what is left of it when resuming a checkpoint."""
+                remaining = checkpoint.remaining_plan()
+                if remaining:
+                    print(f"↩️ Continuing the sweep: {', '.join(f'{v:g}' for v in remaining)} V")
+                    return remaining
+                plan = get_sweep_plan()
+                checkpoint.update(sweep_plan=plan, sweep_position=0)
+                return plan
+
+            if calibrate and SUPPLY:
+                # Hands-off sweep: the supply sets each voltage and reads back the true value
+                supply = open_supply(SUPPLY, meter_spec=METER)
+                print(f"🔌 Supply: {supply.identify()}")
+
+                sweep_plan = sweep_setpoints()
+                position = checkpoint['sweep_position']
+
+                def capture(actual_input):
+                    nonlocal position
+                    position += 1
+                    with span("serial_read") as trace:
+                        data = read_point(ser, reader)
+                        trace['ok'] = data is not None
+                    if not data:
+                        print("No data received. Check if Arduino is sending data.")
+                        return None
+                    return log_point(data[2], actual_input, position, data)
+
+                run_sweep(supply, sweep_plan, capture)
+                supply.close()
+            elif reader is not None and AUTO_CAPTURE:
+                plan = sweep_setpoints()
+                position = checkpoint['sweep_position']
+
+                def next_actual():
+                    nonlocal position
+                    actual_input = next(plan, None)
+                    if actual_input is not None:
+                        position += 1
+                        print(f"➡️ Set the input to {actual_input}V")
+                    return actual_input
+
+                auto_capture(reader, next_actual,
+                             lambda stats, actual_input: log_point(round(stats['vin']['mean'], 6), actual_input, position))
+            else:
                 if calibrate:
-                    user_input = input("Enter 'a' to input Actual Voltage, or 'q' to finish calibration: ")
-                    if user_input.lower() == 'q':
+                    suggest_next()
+                while True:
+                    try:
+                        if calibrate:
+                            with span("operator_input"):
+                                user_input = input("Enter 'a' to input Actual Voltage, or 'q' to finish calibration: ")
+                            if user_input.lower() == 'q':
+                                break
+                            elif user_input.lower() == 'a':
+                                with span("operator_input"):
+                                    actual_input = float(input("Actual Input Voltage: "))
+                                print("Waiting for serial data...")
+                                with span("serial_read") as trace:
+                                    data = read_point(ser, reader)
+                                    trace['ok'] = data is not None
+                                if data:
+                                    calculated_vin = data[2]  # Log only Calculated VIN
+                                    print(f"Received: Raw ADC={data[0]}, Calculated VIN={calculated_vin}")
+
+                                    # Log to calibration file (and checkpoint) immediately
+                                    log_point(calculated_vin, actual_input, data=data)
+                                    suggest_next()
+                                else:
+                                    print("No data received. Check if Arduino is sending data.")
+
+                        else:  # Evaluation Mode
+                            run_evaluation(ser, eval_filename, board_no)  # ✅ CALL run_evaluation()
+                            break  # Exit after evaluation
+
+                    except ValueError:
+                        print("Invalid input, please enter a valid number.")
+                    except KeyboardInterrupt:
+                        print("Exiting...")
                         break
-                    elif user_input.lower() == 'a':
-                        actual_input = float(input("Actual Input Voltage: "))
-                        ser.write(b'a')
 
-                        print("Waiting for serial data...")
-                        while True:
-                            line = ser.readline().decode('utf-8').strip()
-                            if line:
-                                print(f"Received: {line}")
-                                match = re.search(r"Raw ADC: (\d+) \| ESP ADC Cal Raw to Voltage: ([\d.]+) \| Calculated VIN: ([\d.]+) \| Calibrated VIN: ([\d.]+)", line)
-                                if match:
-                                    calculated_vin = float(match.group(3))  # Log only Calculated VIN
-                                    
-                                    # Log to calibration file immediately
-                                    with open(calib_filename, mode='a', newline='') as file:
-                                        writer = csv.writer(file)
-                                        writer.writerow([calculated_vin, actual_input])
-
-                                    print(f"Logged: Measured VIN={calculated_vin}, Actual VIN={actual_input}")
-
-                                    measured_vin.append(calculated_vin)
-                                    actual_vin.append(actual_input)
-                                    break
-                            else:
-                                print("No data received. Check if Arduino is sending data.")
-
-                else:  # Evaluation Mode
-                    run_evaluation(ser, eval_filename)  # ✅ CALL run_evaluation()
-                    break  # Exit after evaluation
-
-            except ValueError:
-                print("Invalid input, please enter a valid number.")
-            except KeyboardInterrupt:
-                print("Exiting...")
-                break
-
-        # Close serial before reopening (to avoid conflicts)
-        ser.close()
+            if reader is not None:
+                reader.stop()
 
         # Proceed to calibration if needed
-        if calibrate and len(measured_vin) >= 4:
+        use_prior = fit is not None and fit.has_prior and len(measured_vin) >= PRIOR_MIN_POINTS
+        if calibrate and use_prior:
+            # The MAP estimate is only provisioned when it predicts readings within the target
+            bound = fit.max_predictive_band()
+            print(f"🧭 Fleet prior fit from {fit.n} points: readings predicted within ±{bound * 1000:.0f} mV (95%) "
+                  f"over {fit.operating_range[0]:g}-{fit.operating_range[1]:g} V")
+            if bound > FIT_TARGET_ERROR:
+                print(f"⚠️ More than the ±{FIT_TARGET_ERROR * 1000:.0f} mV target: the board is outside the fleet prior "
+                      f"or needs more points. Fitting the cubic from its own points instead.")
+                use_prior = False
+                if len(measured_vin) < 4:
+                    print("❌ At least 4 points are needed for that. Resume this calibration to add more.")
+        if calibrate and (use_prior or len(measured_vin) >= 4):
             print("⚙️ Starting calibration process...")
-            coeffs = cubic_fit(measured_vin, actual_vin)
-            evaluate_fit(coeffs, measured_vin, actual_vin)
-
-            # Append coefficients to the calibration CSV file
-            with open(calib_filename, mode='a', newline='') as file:
-                writer = csv.writer(file)
-                writer.writerow([])
-                writer.writerow(["Cubic Fit Coefficients:"] + list(coeffs))
+            with session.phase("fit"):
+                if use_prior:
+                    # MAP estimate: the fleet prior updated with this board's points
+                    coeffs = fit.coeffs
+                    print(f"Cubic Fit Coefficients (fleet prior, {fit.n} points): {coeffs}")
+                else:
+                    coeffs = cubic_fit(measured_vin, actual_vin)
+                evaluate_fit(coeffs, measured_vin, actual_vin)
+                model = None
+                if AUTO_MODEL_SELECTION and not use_prior:
+                    with span("model_selection", points=len(measured_vin)) as trace:
+                        model = select_model([[np.nan, np.nan, m, np.nan, a] for m, a in zip(measured_vin, actual_vin)],
+                                             provisionable_only=not BOARD_FIRMWARE)
+                        trace['model'] = model['model']
+                    if model['model'] is not None:
+                        scores = ", ".join(f"{k} {v['cv_rmse'] * 1000:.1f}mV" for k, v in model['scores'].items())
+                        print(f"🧮 Held-out RMSE: {scores} -> using {model['model']}")
+                        if as_cubic(model) is not None:
+                            coeffs = as_cubic(model)
+                            model = None
+                    else:
+                        model = None
+            # Record what the board will run: the cubic's coefficients, or the chosen model and its parameters
+            if model is None:
+                checkpoint.update(stage="fitted", coeffs=[float(c) for c in coeffs], model=None)
+            else:
+                checkpoint.update(stage="fitted", coeffs=None,
+                                  model={'name': model['model'], 'params': model_params(model)})
+            if store is not None:
+                store.update_session(store_session, coeffs=coeffs if model is None else None,
+                                     model=model['model'] if model else 'cubic',
+                                     model_params=model_params(model) if model else None)
+
+            # Append the fitted model to the calibration CSV file
+            sink.write([])
+            if model is None:
+                sink.write(["Cubic Fit Coefficients:"] + list(coeffs))
+            else:
+                sink.write(model_row(model))
                 
-            # Generate and update Arduino function
-            arduino_function = generate_arduino_formula(coeffs)            
-            update_ino_file("adc_for_calib.ino", arduino_function)
-
-            print("✅ Calibration completed! The Arduino code has been updated.")
-
-            # 🟢 Compile & Upload the new Arduino code
-            board_fqbn = "esp32:esp32:esp32"  # Change this based on your board
-            compile_and_upload("adc_for_calib.ino", board_fqbn, port)
+            # Push the coefficients at runtime; recompile only for firmware that can't store them
+            # Only polynomial models fit the firmware's stored cubic
+            version = None
+            if model is None:
+                with session.phase("provision"), span("provision") as trace:
+                    version = provision_coefficients(ser, coeffs)
+                    trace['ok'] = version is not None
+
+            if version is not None:
+                checkpoint.update(stage="provisioned", coeff_version=version)
+                if store is not None:
+                    store.update_session(store_session, provisioned_version=version)
+                print("✅ Calibration completed! The board is using the new coefficients.")
+            else:
+                # Firmware built for this board only goes into a copy of the sketch, never the shared one.
+                # A cubic becomes the copy's calCoeffs[] defaults so calibrateVIN() stays provisionable;
+                # other models replace the calibration function itself
+                ino_filepath = board_sketch("adc_for_calib.ino", board_no)
+                if model is None:
+                    updated = update_ino_defaults(ino_filepath, coeffs)
+                else:
+                    updated = update_ino_file(ino_filepath, generate_model_formula(model))
+                if updated:
+                    print("✅ Calibration completed! The Arduino code has been updated.")
+
+                    # 🟢 Compile & Upload the new Arduino code
+                    # The session lends the port to arduino-cli and takes it back after the upload
+                    board_fqbn = "esp32:esp32:esp32"  # Change this based on your board
+                    with session.phase("flash"), session.released():
+                        flashed = compile_and_upload(ino_filepath, board_fqbn, port)
+                    if flashed:
+                        checkpoint.update(stage="flashed")
+                        forget_unsupported(board_no)
+                        # Coefficients already in NVS win over the defaults: store the new ones there too
+                        ser = session.open()
+                        if model is None and ser is not None and provision_coefficients(ser, coeffs) is not None:
+                            checkpoint.update(stage="provisioned")
+
+            # Done with this sweep; a failed flash keeps the checkpoint for a retry
+            if checkpoint['stage'] in ("provisioned", "flashed"):
+                checkpoint.clear()
+
+        if sink is not None:
+            sink.close()
+            if store is not None:
+                store.close()
 
         # After Calibration, Ask for Evaluation
         if calibrate:
             choice = input("\nDo you want to proceed with Evaluation Mode? (y/n): ").strip().lower()
             if choice == 'y':
-                print("♻️ Reopening serial connection for Evaluation Mode...")
-                ser = setup_serial(port)  # Reopen Serial Port
+                ser = session.open()  # No-op unless the port was lost after upload
                 if ser is None:
                     print("❌ Failed to reopen serial port. Exiting.")
                     break
 
-                # ✅ Run evaluation immediately after reopening the serial port
-                run_evaluation(ser, eval_filename)
+                # ✅ Run evaluation on the same session
+                with session.phase("evaluation"):
+                    run_evaluation(ser, eval_filename, board_no)
                 break  # Exit the loop after evaluation mode
 
             else:
@@ -338,6 +842,11 @@ def main():
         else:
             break  # Exit after evaluation
 
+    session.close()
+    session.summary()
+    tracer.close()
+    print(f"🧾 Trace written to {tracer.path}")
+
 
 if __name__ == "__main__":
     main()
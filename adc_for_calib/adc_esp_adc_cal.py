@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon May 19 11:20:54 2025
+
+@author: nichm
+
+Host model of esp_adc_cal_raw_to_voltage() for ADC1 at 11 dB, 12 bit.
+
+The firmware characterizes the ADC once at boot (esp_adc_cal_characterize)
+from the eFuse two-point values, the eFuse Vref or DEFAULT_VREF, and then
+turns raw counts into millivolts with an integer linear model below code 2880
+and a bilinear lookup over (Vref, code) above it, blended over one 64-code
+step. On the reference boards the model reproduces every logged reading up
+to code ~3840; over the last LUT steps the boards read up to ~6 mV lower,
+which is left as is (it is the saturating top of the range).
+
+The 'e' command of the sketch prints the characterization; it is read once
+per board and cached, and for logs from boards that cannot report it the
+parameters are recovered from the logged (raw, mV) pairs. With the exact
+raw -> mV curve on the host, one model from raw counts to the actual input
+can be fitted for the whole fleet in a single batched solve.
+
+    python adc_esp_adc_cal.py                         # estimate + check against the reference logs
+    python adc_esp_adc_cal.py --fit                   # raw-domain fits vs the Calculated VIN cubic
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+
+import numpy as np
+
+from adc_checkpoint import write_json_atomic
+from adc_fleet_refit import refit
+from adc_fleet_report import load_csvs
+from adc_model_selection import clean_mask
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_PATH = os.path.join(SCRIPT_DIR, "characterization", "adc_characterization.json")
+UNSUPPORTED = "unsupported"  # Cache entry of a board whose firmware has no 'e' command
+DEFAULT_GLOBS = [
+    os.path.join(SCRIPT_DIR, "tests", "sarq_eval-*.csv"),
+    os.path.join(SCRIPT_DIR, "..", "adc_read_2", "tests", "sarq-*.csv"),
+]
+
+# esp_adc_cal_esp32.c constants for ADC1, ADC_ATTEN_DB_11
+DEFAULT_VREF = 1100
+ADC_12_BIT_RES = 4096
+LIN_COEFF_A_SCALE = 65536
+VREF_ATTEN_SCALE = 196602
+VREF_ATTEN_OFFSET = 142
+LUT_VREF_LOW = 1000
+LUT_VREF_HIGH = 1200
+LUT_ADC_STEP_SIZE = 64
+LUT_LOW_THRESH = 2880
+LUT_HIGH_THRESH = LUT_LOW_THRESH + LUT_ADC_STEP_SIZE
+LUT_ADC1_LOW = np.array([2240, 2297, 2352, 2405, 2457, 2512, 2564, 2616, 2664, 2709,
+                         2754, 2795, 2832, 2868, 2903, 2937, 2969, 3000, 3030, 3060], dtype=np.int64)
+LUT_ADC1_HIGH = np.array([2667, 2706, 2745, 2780, 2813, 2844, 2873, 2901, 2928, 2956,
+                          2982, 3006, 3032, 3059, 3084, 3111, 3138, 3165, 3192, 3217], dtype=np.int64)
+CAL_TYPES = {0: "eFuse Vref", 1: "eFuse two point", 2: "default Vref"}
+
+cache_lock = threading.Lock()  # Rig boards save their characterization from parallel threads
+
+CHARACTERIZATION_PATTERN = re.compile(r"ADC Characterization: type (\d+) \| vref (\d+) \| coeff_a (\d+) \| coeff_b (\d+)")
+
+
+def characterize_vref(vref=DEFAULT_VREF):
+    """Characterization from a Vref alone (what the board uses without eFuse two-point values)."""
+    return {'type': 2 if vref == DEFAULT_VREF else 0, 'vref': int(vref),
+            'coeff_a': int(vref) * VREF_ATTEN_SCALE // ADC_12_BIT_RES, 'coeff_b': VREF_ATTEN_OFFSET}
+
+
+def divide(numerator, denominator, rounded):
+    """Integer division rounded like the C code, or the exact quotient behind it."""
+    if rounded:
+        return (numerator + denominator // 2) // denominator
+    return numerator / denominator
+
+
+def voltage_linear(raw, coeff_a, coeff_b, rounded=True):
+    return divide(coeff_a * raw, LIN_COEFF_A_SCALE, rounded) + coeff_b
+
+
+def voltage_lut(raw, vref, rounded=True):
+    i = np.clip((raw - LUT_LOW_THRESH) // LUT_ADC_STEP_SIZE, 0, len(LUT_ADC1_LOW) - 2)
+    x2dist = LUT_VREF_HIGH - vref
+    x1dist = vref - LUT_VREF_LOW
+    y2dist = (i + 1) * LUT_ADC_STEP_SIZE + LUT_LOW_THRESH - raw
+    y1dist = raw - (i * LUT_ADC_STEP_SIZE + LUT_LOW_THRESH)
+    voltage = (LUT_ADC1_LOW[i] * x2dist * y2dist + LUT_ADC1_HIGH[i] * x1dist * y2dist
+               + LUT_ADC1_LOW[i + 1] * x2dist * y1dist + LUT_ADC1_HIGH[i + 1] * x1dist * y1dist)
+    return divide(voltage, (LUT_VREF_HIGH - LUT_VREF_LOW) * LUT_ADC_STEP_SIZE, rounded)
+
+
+def raw_to_voltage(raw, chars, rounded=True):
+    """esp_adc_cal_raw_to_voltage() in mV for an array of raw 12-bit codes.
+
+    rounded=True is the C integer math; False gives the smooth curve behind the 1 mV steps.
+    """
+    raw = np.asarray(raw, dtype=np.int64)
+    linear = voltage_linear(raw, chars['coeff_a'], chars['coeff_b'], rounded)
+    lut = voltage_lut(np.maximum(raw, LUT_LOW_THRESH), chars['vref'], rounded)
+    # Blend linear and LUT over the first step above the threshold
+    x = raw - LUT_LOW_THRESH
+    blended = divide(linear * LUT_ADC_STEP_SIZE + lut * x - linear * x, LUT_ADC_STEP_SIZE, rounded)
+    return np.where(raw < LUT_LOW_THRESH, linear, np.where(raw <= LUT_HIGH_THRESH, blended, lut))
+
+
+def estimate_characterization(raw, mv):
+    """Recover the characterization from logged raw codes and esp_adc_cal mV, or None.
+
+    Vref-only characterizations (eFuse or default Vref) are tried first; if their linear range
+    does not reproduce the log, coeff_a/coeff_b are searched on integers around a line fit
+    (eFuse two-point) while vref stays the one that best matches the LUT range.
+    """
+    raw = np.asarray(raw, dtype=np.int64)
+    mv = np.round(np.asarray(mv, dtype=np.float64)).astype(np.int64)
+    if len(raw) == 0:
+        return None
+    vrefs = np.arange(900, 1301)
+    candidates = [characterize_vref(v) for v in vrefs]
+    hits = [np.count_nonzero(raw_to_voltage(raw, c) == mv) for c in candidates]
+    errors = [np.abs(raw_to_voltage(raw, c) - mv).sum() for c in candidates]
+    chars = candidates[np.lexsort((errors, -np.array(hits)))[0]]
+
+    linear = raw < LUT_LOW_THRESH
+    if np.count_nonzero(linear) >= 2 and np.ptp(raw[linear]) > 0 and \
+            np.any(voltage_linear(raw[linear], chars['coeff_a'], chars['coeff_b']) != mv[linear]):
+        slope, offset = np.polyfit(raw[linear], mv[linear], 1)
+        best = None
+        for coeff_b in range(int(round(offset)) - 3, int(round(offset)) + 4):
+            centre = int(round(slope * LIN_COEFF_A_SCALE))
+            for coeff_a in range(centre - 64, centre + 65):
+                found = np.count_nonzero(voltage_linear(raw[linear], coeff_a, coeff_b) == mv[linear])
+                if best is None or found > best[0]:
+                    best = (found, coeff_a, coeff_b)
+        chars = {**chars, 'type': 1, 'coeff_a': best[1], 'coeff_b': best[2]}
+    return chars
+
+
+def parse_characterization(line):
+    match = CHARACTERIZATION_PATTERN.search(line)
+    if match:
+        cal_type, vref, coeff_a, coeff_b = (int(match.group(i)) for i in range(1, 5))
+        return {'type': cal_type, 'vref': vref, 'coeff_a': coeff_a, 'coeff_b': coeff_b}
+    return None
+
+
+def read_characterization(ser, max_attempts=2):
+    """Ask the board ('e') for its esp_adc_cal characterization. None on firmware without the command."""
+    ser.reset_input_buffer()
+    ser.write(b'e')
+    for _ in range(max_attempts):
+        line = ser.readline().decode('utf-8', errors='replace').strip()
+        result = parse_characterization(line) if line else None
+        if result:
+            return result
+    return None
+
+
+def load_cache(path=CACHE_PATH):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (json.JSONDecodeError, OSError) as e:
+        print(f"⚠️ Ignoring unreadable characterization cache {path}: {e}")
+        return {}
+
+
+def cached_characterization(board_no, path=CACHE_PATH):
+    chars = load_cache(path).get(str(board_no))
+    return chars if isinstance(chars, dict) else None
+
+
+def save_characterization(board_no, chars, path=CACHE_PATH):
+    with cache_lock:
+        cache = load_cache(path)
+        cache[str(board_no)] = chars
+        write_json_atomic(path, cache)
+
+
+def forget_unsupported(board_no, path=CACHE_PATH):
+    """Ask the board again next time: called after new firmware is uploaded to it."""
+    with cache_lock:
+        cache = load_cache(path)
+        if cache.get(str(board_no)) == UNSUPPORTED:
+            del cache[str(board_no)]
+            write_json_atomic(path, cache)
+
+
+def get_characterization(ser, board_no, path=CACHE_PATH):
+    """The board's characterization: from the cache, else read once over serial and cached.
+
+    Firmware without 'e' is remembered too, so its read timeouts are paid once per board.
+    """
+    cached = load_cache(path).get(str(board_no))
+    if cached == UNSUPPORTED:
+        return None
+    if cached is not None or ser is None:
+        return cached
+    chars = read_characterization(ser)
+    if chars is None:
+        save_characterization(board_no, UNSUPPORTED, path)
+        print(f"⚠️ Board {board_no} did not report its ADC characterization; not asking again until it is reflashed.")
+        return None
+    save_characterization(board_no, chars, path)
+    print(f"📐 ADC characterization of board {board_no}: {CAL_TYPES.get(chars['type'], chars['type'])}, "
+          f"Vref {chars['vref']} mV, coeff_a {chars['coeff_a']}, coeff_b {chars['coeff_b']}")
+    return chars
+
+
+def dataset_characterization(dataset, path=CACHE_PATH):
+    """Cached characterization of the dataset's board, else one estimated from its logged readings."""
+    chars = cached_characterization(dataset['board'], path) if dataset['board'] is not None else None
+    if chars is not None:
+        return chars
+    values = dataset['values']
+    keep = np.isfinite(values[:, 0]) & np.isfinite(values[:, 1])
+    if not np.any(keep):
+        return None
+    return estimate_characterization(values[keep, 0], values[keep, 1] * 1000.0)
+
+
+def raw_domain_fit(datasets, characterizations, degree=3):
+    """Batched fits from raw counts (through the exact esp_adc_cal curve, in V) to the actual input.
+
+    Data-entry slips are dropped first (adc_model_selection.clean_mask). Returns refit()'s
+    (coeffs, ok, metrics) and the cleaned datasets with the Calculated VIN column left in place,
+    so the same rows can be fitted in the VIN domain; boards without a characterization are not ok.
+    """
+    raw_rows, vin_rows = [], []
+    for dataset, chars in zip(datasets, characterizations):
+        values = dataset['values'][clean_mask(dataset['values'])]
+        vin_rows.append({**dataset, 'values': values})
+        raw_domain = values.copy()
+        valid = np.isfinite(values[:, 0]) & (chars is not None)
+        raw_domain[:, 2] = np.nan
+        if chars is not None:
+            raw_domain[valid, 2] = raw_to_voltage(values[valid, 0], chars) / 1000.0
+        raw_rows.append({**dataset, 'values': raw_domain})
+    return refit(raw_rows, degree), vin_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Model esp_adc_cal_raw_to_voltage() and fit in the raw-ADC domain.")
+    parser.add_argument("paths", nargs="*", help="eval CSVs with Raw ADC columns (default: reference eval logs)")
+    parser.add_argument("--fit", action="store_true", help="compare raw-domain fits with the Calculated VIN cubic")
+    parser.add_argument("--degree", type=int, default=3)
+    args = parser.parse_args()
+
+    datasets = [d for d in load_csvs(args.paths or DEFAULT_GLOBS) if d['kind'] == 'eval']
+    if not datasets:
+        print("No eval datasets with raw ADC readings found.")
+        return 1
+
+    characterizations = []
+    for dataset in datasets:
+        chars = dataset_characterization(dataset)
+        characterizations.append(chars)
+        if chars is None:
+            print(f"❌ {dataset['name']}: no raw readings")
+            continue
+        values = dataset['values']
+        keep = np.isfinite(values[:, 0]) & np.isfinite(values[:, 1])
+        error = raw_to_voltage(values[keep, 0], chars) - np.round(values[keep, 1] * 1000.0)
+        print(f"📐 {dataset['name']:<40} Vref {chars['vref']} mV, coeff_a {chars['coeff_a']}, coeff_b {chars['coeff_b']}: "
+              f"{np.count_nonzero(error == 0)}/{len(error)} readings exact, max |error| {np.max(np.abs(error)):.0f} mV")
+
+    if args.fit:
+        (raw_coeffs, raw_ok, raw_metrics), cleaned = raw_domain_fit(datasets, characterizations, args.degree)
+        vin_coeffs, vin_ok, vin_metrics = refit(cleaned, args.degree)
+        print(f"\n⚙️ Degree {args.degree} fits to the actual input (rms / max in mV)")
+        print(f"{'dataset':<40}{'Calculated VIN':>22}{'raw (esp_adc_cal)':>22}")
+        for i, dataset in enumerate(datasets):
+            cells = []
+            for ok, metrics in ((vin_ok, vin_metrics), (raw_ok, raw_metrics)):
+                cells.append(f"{metrics['rms'][i] * 1000:>9.1f} / {metrics['max_abs'][i] * 1000:>6.1f}" if ok[i] else f"{'-':>18}")
+            print(f"{dataset['name']:<40}{cells[0]:>22}{cells[1]:>22}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
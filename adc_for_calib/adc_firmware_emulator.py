@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed May 14 16:03:29 2025
+
+@author: nichm
+
+Bit-exact host emulation of the firmware VIN pipeline.
+
+Every eval row keeps the raw ADC code and the esp_adc_cal voltage, so new
+coefficients can be scored on historical data without putting the board back
+on the bench. This reproduces, vectorised over whole datasets:
+    calculateVIN()   uint32 mV / 1000.0 -> float, float / float gain, * double divider ratio -> float
+    calibrateVIN()   float VIN promoted to double, double coefficients, result stored as float
+with the coefficients rounded the way they reach the board: "%.6f" literals
+when flashed through generate_arduino_formula(), "%.10g" text when provisioned
+over serial, or unrounded. --check replays the logged rows and compares the
+emulated values with what the board printed. The board simulator serves its
+readings through the same functions, and this module stays free of pty/serial
+imports so it runs wherever the COM-port scripts do.
+
+    python adc_firmware_emulator.py --check
+    python adc_firmware_emulator.py tests/sarq_eval-*.csv --coeffs 0.000443 -0.007643 1.040472 0.018605
+    python adc_firmware_emulator.py --refit reports/fleet_refit.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from adc_fleet_report import load_csvs
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_GLOBS = [
+    os.path.join(SCRIPT_DIR, "tests", "sarq_eval-*.csv"),
+    os.path.join(SCRIPT_DIR, "..", "adc_read_2", "tests", "sarq-*.csv"),
+]
+# calibrateVIN() literals of adc_read_2.ino, the firmware that logged ../adc_read_2/tests/
+ADC_READ_2_COEFFS = [0.00121, -0.0298, 1.228, -0.627]
+ROUNDING = {'flash': "{:.6f}", 'provision': "{:.10g}", 'exact': None}
+DEFAULT_COEFFS = [0.000443, -0.007643, 1.040472, 0.018605]
+ADC_MAX_VALUE = 4095
+
+# Divider/op-amp constants of calculateVIN() in adc_for_calib.ino
+R6, R7, R8, R9 = 100000.0, 10000000.0, 10000.0, 200000.0
+
+
+def arduino_float_str(value, digits):
+    """Format a number like Arduino's Print::printFloat(value, digits)."""
+    text = ""
+    if value < 0.0:
+        text = "-"
+        value = -value
+    rounding = 0.5
+    for _ in range(digits):
+        rounding /= 10.0
+    value += rounding
+    int_part = int(value)
+    remainder = value - int_part
+    text += str(int_part)
+    if digits > 0:
+        text += "."
+    for _ in range(digits):
+        remainder *= 10.0
+        digit = int(remainder)
+        text += str(digit)
+        remainder -= digit
+    return text
+
+
+def round_coeffs(coeffs, rounding='flash'):
+    """Coefficients as the board will hold them (float64 array)."""
+    template = ROUNDING[rounding]
+    coeffs = np.asarray(coeffs, dtype=np.float64)
+    if template is None:
+        return coeffs
+    return np.vectorize(lambda c: float(template.format(c)))(coeffs).astype(np.float64)
+
+
+def calculate_vin(adc_cal_mv):
+    """calculateVIN() for esp_adc_cal millivolts (an integer or an array of them); returns float32."""
+    adc_voltage = (np.asarray(adc_cal_mv, dtype=np.float64) / 1000.0).astype(np.float32)
+    gain = np.float32(1.0 + (R9 / R8))
+    scaled = adc_voltage / gain                                    # float / float
+    return (scaled.astype(np.float64) * ((R6 + R7) / R6)).astype(np.float32)[()]
+
+
+def calibrate_vin(coeffs, vin):
+    """calibrateVIN() for one coefficient set (degree 3) or a stack of them (sets x 4); returns float32.
+
+    Evaluated as written in the firmware: (a*v*v*v) + (b*v*v) + (c*v) + d in double.
+    """
+    coeffs = np.asarray(coeffs, dtype=np.float64)
+    v = np.asarray(vin, dtype=np.float32).astype(np.float64)
+    if coeffs.ndim == 2:
+        a, b, c, d = (coeffs[:, k, None] for k in range(4))
+    else:
+        a, b, c, d = coeffs
+    return ((a * v * v * v) + (b * v * v) + (c * v) + d).astype(np.float32)[()]
+
+
+def adc_cal_mv(values):
+    """Integer esp_adc_cal millivolts back from the logged 'ESP ADC Cal Raw Voltage' column (volts)."""
+    return np.round(values[:, 1] * 1000.0).astype(np.int64)
+
+
+def emulate(values, coeffs, rounding='flash'):
+    """(calculated VIN, calibrated VIN) the firmware would report for the logged rows."""
+    vin = calculate_vin(adc_cal_mv(values))
+    return vin, calibrate_vin(round_coeffs(coeffs, rounding), vin)
+
+
+def score(datasets, coeff_sets, rounding='flash'):
+    """Error of each coefficient set against the actual input over all rows (sets x metrics)."""
+    values = np.concatenate([d['values'] for d in datasets])
+    values = values[np.isfinite(values[:, 1]) & np.isfinite(values[:, 4])]
+    vin = calculate_vin(adc_cal_mv(values))
+    coeff_sets = np.stack([round_coeffs(c, rounding) for c in coeff_sets])
+    error = calibrate_vin(coeff_sets, vin).astype(np.float64) - values[:, 4]
+    return {
+        'n': len(values),
+        'mean_abs': np.mean(np.abs(error), axis=1),
+        'max_abs': np.max(np.abs(error), axis=1),
+        'rms': np.sqrt(np.mean(error ** 2, axis=1)),
+        'bias': np.mean(error, axis=1),
+    }
+
+
+def check_dataset(dataset, coeffs, rounding='flash'):
+    """Rows whose printed Calculated/Calibrated VIN (3 decimals, Arduino printFloat) differ from the emulation."""
+    values = dataset['values']
+    vin, calibrated = emulate(values, coeffs, rounding)
+    mismatches = []
+    for row, v, c in zip(values, vin, calibrated):
+        printed = (arduino_float_str(float(v), 3), arduino_float_str(float(c), 3))
+        logged = (f"{row[2]:.3f}", f"{row[3]:.3f}")
+        if printed != logged:
+            mismatches.append({'logged': logged, 'emulated': printed, 'raw_adc': row[0]})
+    return mismatches
+
+
+def logged_coeffs(dataset):
+    """Coefficients the board had when the eval was logged (adc_read_2 firmware, else the calib fit/defaults)."""
+    if dataset['name'].startswith("adc_read_2"):
+        return ADC_READ_2_COEFFS, 'exact'
+    if dataset['coeffs']:
+        return dataset['coeffs'], 'flash'
+    calib = os.path.join(SCRIPT_DIR, "tests", f"sarq_calib-{dataset['board']:04d}.csv")
+    found = load_csvs([calib]) if dataset['board'] is not None else []
+    return (found[0]['coeffs'] if found and found[0]['coeffs'] else DEFAULT_COEFFS), 'flash'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-evaluate coefficients offline with the firmware's float32 pipeline.")
+    parser.add_argument("paths", nargs="*", help="eval CSVs (default: reference eval logs)")
+    parser.add_argument("--coeffs", nargs=4, type=float, action="append", metavar=("A", "B", "C", "D"),
+                        help="coefficient set to score (repeatable)")
+    parser.add_argument("--refit", default=None, help="score every board's coefficients from adc_fleet_refit.py output")
+    parser.add_argument("--rounding", choices=list(ROUNDING), default='flash')
+    parser.add_argument("--check", action="store_true", help="verify the emulation against the logged values")
+    args = parser.parse_args()
+
+    datasets = [d for d in load_csvs(args.paths or DEFAULT_GLOBS) if d['kind'] == 'eval']
+    if not datasets:
+        print("No eval datasets found.")
+        return 1
+
+    if args.check:
+        failed = 0
+        for dataset in datasets:
+            coeffs, rounding = logged_coeffs(dataset)
+            mismatches = check_dataset(dataset, coeffs, rounding)
+            failed += len(mismatches)
+            status = "✅" if not mismatches else "❌"
+            print(f"{status} {dataset['name']:<40} {len(dataset['values']) - len(mismatches)}/{len(dataset['values'])} "
+                  f"rows reproduced ({rounding} coefficients {list(coeffs)})")
+            for m in mismatches[:5]:
+                print(f"      raw {m['raw_adc']:.0f}: logged {m['logged']}, emulated {m['emulated']}")
+        return 1 if failed else 0
+
+    labels, coeff_sets = [], []
+    for coeffs in args.coeffs or []:
+        labels.append(" ".join(f"{c:.6g}" for c in coeffs))
+        coeff_sets.append(coeffs)
+    if args.refit:
+        with open(args.refit) as file:
+            for row in json.load(file)['boards']:
+                if row['ok'] and len(row['coeffs']) == 4:
+                    labels.append(f"refit {row['name']}")
+                    coeff_sets.append(row['coeffs'])
+    if not coeff_sets:
+        labels.append("defaults")
+        coeff_sets.append(DEFAULT_COEFFS)
+
+    started = time.perf_counter()
+    for dataset in datasets:
+        result = score([dataset], coeff_sets, args.rounding)
+        print(f"📋 {dataset['name']} ({result['n']} rows)")
+        for i, label in enumerate(labels):
+            print(f"   {label:<48} mean |err| {result['mean_abs'][i]:.4f}V  max {result['max_abs'][i]:.4f}V  "
+                  f"rms {result['rms'][i]:.4f}V  bias {result['bias'][i]:+.4f}V")
+    print(f"⏱️ Scored {len(coeff_sets)} coefficient set(s) on {len(datasets)} dataset(s) in "
+          f"{(time.perf_counter() - started) * 1000:.1f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu May 29 14:06:51 2025
+
+@author: nichm
+
+Fleet prior for calibrating new boards from a handful of points.
+
+The boards' curves are nearly parallel, so the cubic of a new board is not
+fitted from scratch: the coefficients of every stored calibration (in the
+OnlineFit basis, measured VIN mapped onto [-1, 1]) give a population mean
+and covariance, and the new board's fit is the MAP estimate under that
+prior (adc_online_fit.OnlineFit with prior_mean/prior_cov and the pooled
+reading noise), with predictive error bounds from the posterior.
+
+The sample covariance of a few boards is shrunk towards its diagonal
+(SHRINKAGE), inflated by 1 + 1/boards for the uncertainty of the mean, and
+then scaled by the smallest factor whose predictive bounds still cover
+COVERAGE of a held-out board's points: a handful of boards understates how
+far the next one can be. That check, and --validate, leave each board out
+in turn (all its sweeps), learn the prior from the others, take 3-5 of the
+held-out board's points in the planner's order and score the MAP fit on all
+of its points.
+
+    python adc_fleet_prior.py --store
+    python adc_fleet_prior.py tests/sarq_*.csv ../adc_read_2/tests/sarq-*.csv --validate
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from adc_fleet_refit import refit
+from adc_fleet_report import load_csvs, load_store
+from adc_model_selection import clean_mask
+from adc_online_fit import OPERATING_RANGE, OnlineFit, scale
+from adc_sample_store import STORE_DIR, SampleStore
+from adc_sweep_planner import planner_order
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_GLOBS = [
+    os.path.join(SCRIPT_DIR, "tests", "sarq_calib-*.csv"),
+    os.path.join(SCRIPT_DIR, "tests", "sarq_eval-*.csv"),
+    os.path.join(SCRIPT_DIR, "..", "adc_read_2", "tests", "sarq-*.csv"),
+]
+PRIOR_PATH = os.path.join(STORE_DIR, "fleet_prior.json")
+SHRINKAGE = 0.3       # Weight of the diagonal in the shrunk coefficient covariance
+MIN_BOARDS = 2
+MIN_POINTS = 8        # Sweeps shorter than this are not used to learn the prior
+VALIDATION_POINTS = (3, 4, 5)
+INFLATION_GRID = (1, 2, 4, 8, 16, 32, 64)
+COVERAGE = 0.90       # Held-out points the 95% bounds must cover when choosing the inflation
+
+
+def usable(datasets):
+    """Sweeps with measured and actual VIN, data-entry slips removed."""
+    cleaned = []
+    for dataset in datasets:
+        values = dataset['values'][clean_mask(dataset['values'])]
+        if len(values) >= MIN_POINTS:
+            cleaned.append({**dataset, 'values': values})
+    return cleaned
+
+
+def learn_prior(datasets, degree=3, shrinkage=SHRINKAGE, inflation=1.0, operating_range=OPERATING_RANGE):
+    """Population mean/covariance of the (scaled) coefficients and the pooled reading noise, or None."""
+    if len(datasets) < MIN_BOARDS:
+        return None
+    coeffs, ok, metrics = refit(datasets, degree)
+    if np.count_nonzero(ok) < MIN_BOARDS:
+        return None
+    theta = np.stack([scale(c, operating_range) for c in coeffs[ok]])
+    mean = theta.mean(axis=0)
+    sample_cov = np.cov(theta, rowvar=False)
+    cov = (1 - shrinkage) * sample_cov + shrinkage * np.diag(np.diag(sample_cov))
+    cov *= (1.0 + 1.0 / len(theta)) * inflation
+    n = metrics['n'][ok]
+    noise = np.sqrt(np.sum(metrics['rms'][ok] ** 2 * n) / np.sum(n - (degree + 1)))
+    return {
+        'degree': degree,
+        'operating_range': list(operating_range),
+        'mean': [float(v) for v in mean],
+        'cov': [[float(v) for v in row] for row in cov],
+        'noise': float(noise),
+        'shrinkage': shrinkage,
+        'inflation': inflation,
+        'boards': [d['name'] for d, good in zip(datasets, ok) if good],
+        'created': time.time(),
+    }
+
+
+def prior_fit(prior, target=None):
+    """An OnlineFit starting from the prior (MAP after each update)."""
+    options = {} if target is None else {'target': target}
+    return OnlineFit(prior['degree'], prior_mean=prior['mean'], prior_cov=prior['cov'], noise=prior['noise'],
+                     operating_range=tuple(prior['operating_range']), **options)
+
+
+def map_fit(prior, x, y):
+    fit = prior_fit(prior)
+    for xi, yi in zip(x, y):
+        fit.update(xi, yi)
+    return fit
+
+
+def save_prior(prior, path=PRIOR_PATH):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump(prior, file, indent=2)
+
+
+def load_prior(path=PRIOR_PATH):
+    """The saved fleet prior, or None when there is none yet."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        return json.load(file)
+
+
+def validate(datasets, points=VALIDATION_POINTS, shrinkage=SHRINKAGE, inflation=1.0):
+    """Leave-one-board-out errors of the MAP fit from the first k planned points, per held-out dataset."""
+    results = []
+    for held_out in datasets:
+        others = [d for d in datasets if d is not held_out and (d['board'] != held_out['board'] or d['board'] is None)]
+        prior = learn_prior(others, shrinkage=shrinkage, inflation=inflation)
+        if prior is None:
+            continue
+        x, y = held_out['values'][:, 2], held_out['values'][:, 4]
+        order = planner_order(x, y, fit=prior_fit(prior))
+        row = {'name': held_out['name'], 'n': len(x),
+               'full_rms': float(np.sqrt(np.mean((np.polyval(np.polyfit(x, y, 3), x) - y) ** 2)))}
+        for k in points:
+            fit = map_fit(prior, x[order[:k]], y[order[:k]])
+            error = fit.predict(x) - y
+            inside = np.abs(error) <= fit.predictive_band(x)
+            row[k] = {'rms': float(np.sqrt(np.mean(error ** 2))), 'max_abs': float(np.max(np.abs(error))),
+                      'coverage': float(np.mean(inside))}
+            # The cubic from scratch is undetermined until 4 distinct voltages (logs repeat some rows)
+            if len(np.unique(x[order[:k]])) > 3:
+                scratch = np.polyfit(x[order[:k]], y[order[:k]], 3)
+                row[k]['scratch_rms'] = float(np.sqrt(np.mean((np.polyval(scratch, x) - y) ** 2)))
+        results.append(row)
+    return results
+
+
+def choose_inflation(datasets, shrinkage=SHRINKAGE, grid=INFLATION_GRID, coverage=COVERAGE):
+    """Smallest covariance factor whose leave-one-board-out bounds cover enough points (1.0 if untestable)."""
+    k = VALIDATION_POINTS[len(VALIDATION_POINTS) // 2]
+    for inflation in grid:
+        rows = validate(datasets, (k,), shrinkage, inflation)
+        if not rows:
+            return 1.0
+        covered = sum(row[k]['coverage'] * row['n'] for row in rows) / sum(row['n'] for row in rows)
+        if covered >= coverage:
+            return float(inflation)
+    return float(grid[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Learn the fleet prior used to calibrate new boards from a few points.")
+    parser.add_argument("paths", nargs="*", help="calibration/eval CSVs (default: reference sweep logs)")
+    parser.add_argument("--store", action="store_true", help="learn from the calib sessions of the sample store")
+    parser.add_argument("--shrinkage", type=float, default=SHRINKAGE)
+    parser.add_argument("--inflation", type=float, default=None, help="covariance factor (default: chosen by coverage)")
+    parser.add_argument("--validate", action="store_true", help="leave-one-board-out check with 3-5 points")
+    parser.add_argument("--output", default=PRIOR_PATH)
+    args = parser.parse_args()
+
+    if args.store:
+        datasets = [d for d in load_store(SampleStore()) if d['kind'] == 'calib']
+    else:
+        datasets = load_csvs(args.paths or DEFAULT_GLOBS)
+    datasets = usable(datasets)
+    inflation = args.inflation or choose_inflation(datasets, args.shrinkage)
+    prior = learn_prior(datasets, shrinkage=args.shrinkage, inflation=inflation)
+    if prior is None:
+        print(f"❌ Need at least {MIN_BOARDS} sweeps of {MIN_POINTS}+ points to learn a prior.")
+        return 1
+
+    sd = np.sqrt(np.diag(prior['cov']))
+    print(f"🧭 Fleet prior from {len(prior['boards'])} sweeps: noise {prior['noise'] * 1000:.1f} mV, "
+          f"covariance x{inflation:g}")
+    print(f"   scaled coefficients {', '.join(f'{m:.4f}±{s:.4f}' for m, s in zip(prior['mean'], sd))}")
+
+    if args.validate:
+        for row in validate(datasets, shrinkage=args.shrinkage, inflation=inflation):
+            print(f"📋 {row['name']} ({row['n']} points, all-points cubic rms {row['full_rms'] * 1000:.1f} mV)")
+            for k in VALIDATION_POINTS:
+                r = row[k]
+                scratch = f", from scratch {r['scratch_rms'] * 1000:.1f} mV" if 'scratch_rms' in r else ""
+                print(f"   {k} points: MAP rms {r['rms'] * 1000:.1f} mV, max {r['max_abs'] * 1000:.1f} mV, "
+                      f"{r['coverage']:.0%} within the 95% bounds{scratch}")
+
+    save_prior(prior, args.output)
+    print(f"💾 Prior written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
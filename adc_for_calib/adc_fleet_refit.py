@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri May  2 10:18:53 2025
+
+@author: nichm
+
+Batched refit of every board's calibration.
+
+All calibration points are packed into padded (boards x points) arrays with
+a mask, the Vandermonde tensor is built once, and every board's least-squares
+problem is solved in one stacked QR. Columns are scaled per board before the
+QR and the coefficients scaled back, so the result matches np.polyfit. Fit
+metrics come out of masked array reductions, and the new coefficients are
+written back to the sample store as each session's 'refit' entry (the
+deployed 'coeffs' are left alone) and to a JSON file.
+
+    python adc_fleet_refit.py --store
+    python adc_fleet_refit.py tests/sarq_calib-*.csv --degree 2
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from adc_fleet_report import load_csvs, load_store
+from adc_sample_store import SampleStore
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_GLOBS = [os.path.join(SCRIPT_DIR, "tests", "sarq_calib-*.csv")]
+
+
+def pack(datasets):
+    """Padded measured/actual arrays (boards x max points) and the mask of real points."""
+    sizes = np.array([len(d['values']) for d in datasets])
+    width = max(int(sizes.max()) if len(sizes) else 0, 1)
+    x = np.zeros((len(datasets), width))
+    y = np.zeros((len(datasets), width))
+    mask = np.arange(width) < sizes[:, None]
+    if len(datasets):
+        flat_x = np.concatenate([d['values'][:, 2] for d in datasets])
+        flat_y = np.concatenate([d['values'][:, 4] for d in datasets])
+        x[mask] = flat_x
+        y[mask] = flat_y
+    mask &= np.isfinite(x) & np.isfinite(y)
+    x[~mask] = 0.0
+    y[~mask] = 0.0
+    return x, y, mask
+
+
+def batch_polyfit(x, y, mask, degree=3):
+    """Least-squares polynomials for every row of x/y at once. Returns (coeffs highest power first, ok)."""
+    powers = np.arange(degree, -1, -1)
+    scale = np.max(np.abs(np.where(mask, x, 0.0)), axis=1)
+    scale[scale == 0] = 1.0
+    vander = (x / scale[:, None])[..., None] ** powers           # boards x points x (degree + 1)
+    vander *= mask[..., None]
+    q, r = np.linalg.qr(vander)
+    qty = np.einsum('bnk,bn->bk', q, y * mask)
+    diag = np.abs(np.diagonal(r, axis1=1, axis2=2))
+    ok = (mask.sum(axis=1) > degree) & np.all(diag > 1e-10 * np.maximum(diag.max(axis=1, keepdims=True), 1e-300), axis=1)
+    r[~ok] = np.eye(degree + 1)                                    # Keep solve() happy for rank-deficient boards
+    scaled = np.linalg.solve(r, qty[..., None])[..., 0]
+    coeffs = scaled / scale[:, None] ** powers
+    coeffs[~ok] = np.nan
+    return coeffs, ok
+
+
+def batch_metrics(coeffs, x, y, mask):
+    """Masked residual statistics for every board."""
+    degree = coeffs.shape[1] - 1
+    predicted = np.einsum('bk,bnk->bn', coeffs, x[..., None] ** np.arange(degree, -1, -1))
+    residual = np.where(mask, predicted - y, 0.0)
+    n = mask.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_y = (y * mask).sum(axis=1) / n
+        ss_res = (residual ** 2).sum(axis=1)
+        ss_tot = (np.where(mask, y - mean_y[:, None], 0.0) ** 2).sum(axis=1)
+        return {
+            'n': n,
+            'mean_abs': np.abs(residual).sum(axis=1) / n,
+            'max_abs': np.abs(residual).max(axis=1),
+            'rms': np.sqrt(ss_res / n),
+            'r2': 1.0 - ss_res / ss_tot,
+        }, residual
+
+
+def refit(datasets, degree=3, gross_error=None):
+    """Refit every dataset in one batch; optionally drop points off by more than gross_error and refit once."""
+    x, y, mask = pack(datasets)
+    coeffs, ok = batch_polyfit(x, y, mask, degree)
+    metrics, residual = batch_metrics(coeffs, x, y, mask)
+    dropped = np.zeros(len(datasets), int)
+    if gross_error is not None:
+        outliers = mask & (np.abs(residual) > gross_error)
+        if outliers.any():
+            dropped = outliers.sum(axis=1)
+            mask = mask & ~outliers
+            coeffs, ok = batch_polyfit(x, y, mask, degree)
+            metrics, _ = batch_metrics(coeffs, x, y, mask)
+    metrics['dropped'] = dropped
+    return coeffs, ok, metrics
+
+
+def results_table(datasets, coeffs, ok, metrics, degree):
+    rows = []
+    for i, dataset in enumerate(datasets):
+        rows.append({
+            'name': dataset['name'],
+            'board': dataset['board'],
+            'degree': degree,
+            'ok': bool(ok[i]),
+            'coeffs': [float(c) for c in coeffs[i]] if ok[i] else None,
+            'previous_coeffs': dataset['coeffs'],
+            **{k: (float(v[i]) if np.isfinite(v[i]) else None) for k, v in metrics.items()},
+        })
+        rows[-1]['n'] = int(metrics['n'][i])
+        rows[-1]['dropped'] = int(metrics['dropped'][i])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Refit every board's calibration in one batched solve.")
+    parser.add_argument("paths", nargs="*", help="calibration CSVs or glob patterns (default: tests/sarq_calib-*.csv)")
+    parser.add_argument("--store", action="store_true", help="refit the calib sessions of the sample store and write back")
+    parser.add_argument("--degree", type=int, default=3)
+    parser.add_argument("--gross-error", type=float, default=None, help="drop points with |residual| above this (V) and refit")
+    parser.add_argument("--output", default=os.path.join(SCRIPT_DIR, "reports", "fleet_refit.json"))
+    args = parser.parse_args()
+
+    store = SampleStore() if args.store else None
+    if store is not None:
+        ids = [sid for sid, _ in store.sessions(kind='calib')]
+        datasets = [d for d in load_store(store) if d['kind'] == 'calib']
+    else:
+        datasets = [d for d in load_csvs(args.paths or DEFAULT_GLOBS) if d['kind'] == 'calib']
+    if not datasets:
+        print("No calibration datasets found.")
+        return 1
+
+    started = time.perf_counter()
+    coeffs, ok, metrics = refit(datasets, args.degree, args.gross_error)
+    elapsed = time.perf_counter() - started
+    rows = results_table(datasets, coeffs, ok, metrics, args.degree)
+    print(f"⚙️ Refit {len(datasets)} boards ({int(ok.sum())} ok) with degree {args.degree} in {elapsed * 1000:.1f} ms")
+    for row in rows:
+        if row['ok']:
+            print(f"   {row['name']:<40} n={row['n']:<4} rms {row['rms']:.4f}V  max {row['max_abs']:.4f}V  R²={row['r2']:.5f}")
+        else:
+            print(f"   {row['name']:<40} n={row['n']:<4} ❌ not enough distinct points")
+
+    if store is not None:
+        refitted = time.time()
+        fields = ('degree', 'coeffs', 'n', 'rms', 'max_abs', 'r2', 'dropped')
+        store.update_sessions({session_id: {'refit': {**{k: row[k] for k in fields}, 'at': refitted}}
+                               for session_id, row in zip(ids, rows) if row['ok']})
+        print(f"💾 Refit coefficients written to {store.index_path}")
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as file:
+        json.dump({'degree': args.degree, 'seconds': elapsed, 'boards': rows}, file, indent=2)
+    print(f"💾 Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
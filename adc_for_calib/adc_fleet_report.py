@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Apr 30 15:42:10 2025
+
+@author: nichm
+
+Fleet-wide calibration quality report.
+
+Every eval dataset (and every calib dataset with fitted coefficients) is
+stacked into flat NumPy arrays with a dataset index, so per-board and
+per-voltage-bin statistics, residual curves and outlier boards all come out
+of a few bincount passes. CSVs are parsed in a process pool when there are
+many of them; the sample store (adc_sample_store.py) can be used instead.
+
+    python adc_fleet_report.py                       # tests/ and ../adc_read_2/tests/
+    python adc_fleet_report.py --store --plots reports/
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from adc_sample_store import SampleStore, board_from_filename, read_csv_session
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_GLOBS = [
+    os.path.join(SCRIPT_DIR, "tests", "*.csv"),
+    os.path.join(SCRIPT_DIR, "..", "adc_read_2", "tests", "*.csv"),
+]
+POOL_THRESHOLD = 32  # Parse in worker processes from this many files on
+
+
+def load_csv(path):
+    """One dataset dict from a calib/eval CSV (runs in worker processes)."""
+    kind, rows, coeffs = read_csv_session(path)
+    values = np.array([[np.nan if v is None else v for v in row] for row in rows], dtype=np.float64).reshape(-1, 5)
+    name = os.path.relpath(path, os.path.join(SCRIPT_DIR, ".."))
+    return {'name': name, 'board': board_from_filename(path), 'kind': kind, 'values': values, 'coeffs': coeffs}
+
+
+def try_load_csv(path):
+    """load_csv() that reports unreadable files instead of raising."""
+    try:
+        return load_csv(path), None
+    except (ValueError, OSError) as e:
+        return None, f"{path}: {e}"
+
+
+def load_csvs(patterns, workers=None):
+    """Datasets from every CSV matching the patterns, parsed in parallel when there are many."""
+    paths = sorted({os.path.normpath(p) for pattern in patterns for p in glob.glob(pattern)})
+    if len(paths) >= POOL_THRESHOLD:
+        chunksize = max(1, len(paths) // (4 * (workers or os.cpu_count() or 1)))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(try_load_csv, paths, chunksize=chunksize))
+    else:
+        results = [try_load_csv(path) for path in paths]
+
+    datasets = []
+    for dataset, error in results:
+        if error:
+            print(f"⚠️ Skipping {error}")
+        else:
+            datasets.append(dataset)
+    return datasets
+
+
+def load_store(store):
+    """Datasets from the sample store, one per session."""
+    fields = ('raw_adc', 'cal_voltage', 'calculated_vin', 'calibrated_vin', 'actual_input')
+    columns = [store.column(f) for f in fields]
+    datasets = []
+    for session_id, entry in store.sessions():
+        values = np.zeros((entry['count'], len(fields)))
+        for k, column in enumerate(columns):
+            if entry['ranges']:
+                values[:, k] = np.concatenate([column[a:b] for a, b in entry['ranges']])
+        datasets.append({'name': f"session {session_id}", 'board': entry['board'], 'kind': entry['kind'],
+                         'values': values, 'coeffs': entry['coeffs']})
+    return datasets
+
+
+def stack_errors(datasets):
+    """Flat (dataset index, actual input, error) arrays over all usable datasets.
+
+    Eval rows: calibrated VIN - actual. Calib rows: fitted cubic - actual (fit residuals).
+    """
+    used, index, actual, error = [], [], [], []
+    for dataset in datasets:
+        values = dataset['values']
+        if len(values) == 0:
+            continue
+        if dataset['kind'] == 'eval':
+            predicted = values[:, 3]
+        elif dataset['coeffs'] is not None:
+            predicted = np.polyval(dataset['coeffs'], values[:, 2])
+        else:
+            continue
+        index.append(np.full(len(values), len(used)))
+        actual.append(values[:, 4])
+        error.append(predicted - values[:, 4])
+        used.append(dataset)
+    if not used:
+        return used, np.zeros(0, int), np.zeros(0), np.zeros(0)
+    return used, np.concatenate(index), np.concatenate(actual), np.concatenate(error)
+
+
+def group_stats(groups, values, count):
+    """n, mean, std, rms and max |value| per group in one pass (NaN for empty groups)."""
+    n = np.bincount(groups, minlength=count).astype(np.float64)
+    total = np.bincount(groups, values, minlength=count)
+    squares = np.bincount(groups, values * values, minlength=count)
+    max_abs = np.zeros(count)
+    np.maximum.at(max_abs, groups, np.abs(values))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / n
+        rms = np.sqrt(squares / n)
+        std = np.sqrt(np.maximum(squares / n - mean * mean, 0.0) * n / np.maximum(n - 1, 1))
+    max_abs[n == 0] = np.nan
+    return {'n': n.astype(int), 'mean': mean, 'std': std, 'rms': rms, 'max_abs': max_abs}
+
+
+def robust_z(values):
+    """Distance from the median in units of scaled MAD."""
+    median = np.nanmedian(values)
+    mad = 1.4826 * np.nanmedian(np.abs(values - median))
+    return (values - median) / mad if mad > 0 else np.zeros_like(values)
+
+
+def fleet_report(datasets, bin_width=1.0, gross_error=1.0, bias_threshold=0.1, z_threshold=3.5):
+    """Per-board, per-bin and fleet statistics plus outlier boards, as a JSON-ready dict."""
+    used, index, actual, error = stack_errors(datasets)
+    # Rows off by more than gross_error are data-entry slips (e.g. 0.97 typed for 12.97), not calibration error
+    gross = ~np.isfinite(error) | (np.abs(error) > gross_error)
+    count = len(used)
+    excluded = np.bincount(index[gross], minlength=count)
+    index, actual, error = index[~gross], actual[~gross], error[~gross]
+
+    boards = group_stats(index, error, count)
+    bias_z = robust_z(boards['mean'])
+    rms_z = robust_z(boards['rms'])
+
+    edges = np.arange(np.floor(actual.min() / bin_width) * bin_width if len(actual) else 0.0,
+                      (np.ceil(actual.max() / bin_width) + 1) * bin_width if len(actual) else bin_width, bin_width)
+    bins = np.clip(np.digitize(actual, edges) - 1, 0, len(edges) - 2)
+    nbins = len(edges) - 1
+    per_bin = group_stats(bins, error, nbins)
+    # Residual curve of every board: mean error per voltage bin (boards x bins)
+    curves = group_stats(index * nbins + bins, error, count * nbins)['mean'].reshape(count, nbins)
+
+    def clean(x):
+        return None if not np.isfinite(x) else round(float(x), 5)
+
+    board_rows = []
+    for i, dataset in enumerate(used):
+        reasons = []
+        if abs(boards['mean'][i]) > bias_threshold:
+            reasons.append(f"bias {boards['mean'][i]:+.3f}V")
+        if abs(bias_z[i]) > z_threshold:
+            reasons.append(f"bias z={bias_z[i]:.1f}")
+        if rms_z[i] > z_threshold:
+            reasons.append(f"rms z={rms_z[i]:.1f}")
+        board_rows.append({
+            'name': dataset['name'], 'board': dataset['board'], 'kind': dataset['kind'],
+            'n': int(boards['n'][i]), 'excluded': int(excluded[i]),
+            'bias': clean(boards['mean'][i]), 'std': clean(boards['std'][i]),
+            'rms': clean(boards['rms'][i]), 'max_abs': clean(boards['max_abs'][i]),
+            'outlier': bool(reasons), 'reasons': reasons,
+        })
+
+    fleet = group_stats(np.zeros(len(error), int), error, 1)
+    return {
+        'generated': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'datasets': count,
+        'rows': int(len(error)),
+        'excluded_rows': int(excluded.sum()),
+        'fleet': {k: clean(v[0]) if k != 'n' else int(v[0]) for k, v in fleet.items()},
+        'boards': board_rows,
+        'bins': [{'low': clean(edges[b]), 'high': clean(edges[b + 1]), 'n': int(per_bin['n'][b]),
+                  'mean': clean(per_bin['mean'][b]), 'std': clean(per_bin['std'][b]),
+                  'rms': clean(per_bin['rms'][b]), 'max_abs': clean(per_bin['max_abs'][b])}
+                 for b in range(nbins) if per_bin['n'][b]],
+        'residual_curves': {
+            'bin_centers': [clean(c) for c in (edges[:-1] + edges[1:]) / 2],
+            'mean_error': {d['name']: [clean(v) for v in curves[i]] for i, d in enumerate(used)},
+        },
+    }
+
+
+def print_report(report):
+    fleet = report['fleet']
+    print(f"📋 {report['datasets']} datasets, {report['rows']} rows ({report['excluded_rows']} gross errors excluded)")
+    print(f"   Fleet: bias {fleet['mean']:+.4f}V, rms {fleet['rms']:.4f}V, max |err| {fleet['max_abs']:.3f}V\n")
+    print(f"{'dataset':<40}{'kind':<6}{'n':>5}{'bias V':>9}{'std V':>8}{'rms V':>8}{'max V':>8}  flags")
+    for b in sorted(report['boards'], key=lambda b: -(b['rms'] or 0)):
+        flag = "⚠️ " + ", ".join(b['reasons']) if b['outlier'] else ""
+        print(f"{b['name']:<40}{b['kind']:<6}{b['n']:>5}{b['bias']:>+9.3f}{b['std']:>8.3f}{b['rms']:>8.3f}{b['max_abs']:>8.3f}  {flag}")
+    print(f"\n{'bin V':<14}{'n':>6}{'mean V':>9}{'rms V':>8}{'max V':>8}")
+    for b in report['bins']:
+        print(f"{b['low']:>5.1f}-{b['high']:<7.1f}{b['n']:>6}{b['mean']:>+9.3f}{b['rms']:>8.3f}{b['max_abs']:>8.3f}")
+
+
+def save_plots(report, plot_dir):
+    """Residual curves and per-board bias histogram (needs matplotlib)."""
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("⚠️ matplotlib is not installed; skipping plots.")
+        return
+    os.makedirs(plot_dir, exist_ok=True)
+    centers = np.array(report['residual_curves']['bin_centers'], dtype=float)
+    fig, ax = plt.subplots(figsize=(9, 5))
+    outliers = {b['name'] for b in report['boards'] if b['outlier']}
+    for name, curve in report['residual_curves']['mean_error'].items():
+        curve = np.array([np.nan if v is None else v for v in curve], dtype=float)
+        ax.plot(centers, curve, marker='o', lw=2 if name in outliers else 0.8, label=name if name in outliers else None)
+    ax.axhline(0, color='k', lw=0.5)
+    ax.set_xlabel("Actual input (V)")
+    ax.set_ylabel("Mean error (V)")
+    ax.set_title("Residual curves per board (outliers labelled)")
+    if outliers:
+        ax.legend(fontsize=7)
+    fig.savefig(os.path.join(plot_dir, "residual_curves.png"), dpi=120, bbox_inches='tight')
+
+    fig, ax = plt.subplots(figsize=(6, 4))
+    ax.hist([b['bias'] for b in report['boards'] if b['bias'] is not None], bins=30)
+    ax.set_xlabel("Board bias (V)")
+    ax.set_ylabel("Boards")
+    fig.savefig(os.path.join(plot_dir, "bias_histogram.png"), dpi=120, bbox_inches='tight')
+    plt.close('all')
+    print(f"🖼️ Plots saved to {plot_dir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fleet-wide calibration quality report.")
+    parser.add_argument("paths", nargs="*", help="CSV files or glob patterns (default: tests/ folders)")
+    parser.add_argument("--store", action="store_true", help="read the sample store instead of CSVs")
+    parser.add_argument("--bin-width", type=float, default=1.0, help="voltage bin width in V")
+    parser.add_argument("--bias-threshold", type=float, default=0.1, help="flag boards with |bias| above this (V)")
+    parser.add_argument("--gross-error", type=float, default=1.0, help="exclude rows off by more than this (V)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes for parsing")
+    parser.add_argument("--output", default=os.path.join(SCRIPT_DIR, "reports", "fleet_report.json"))
+    parser.add_argument("--plots", help="directory for PNG plots (needs matplotlib)")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    datasets = load_store(SampleStore()) if args.store else load_csvs(args.paths or DEFAULT_GLOBS, args.workers)
+    if not datasets:
+        print("No datasets found.")
+        return 1
+    report = fleet_report(datasets, args.bin_width, args.gross_error, args.bias_threshold)
+    print_report(report)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"\n💾 Summary written to {args.output} ({time.perf_counter() - started:.2f}s)")
+    if args.plots:
+        save_plots(report, args.plots)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
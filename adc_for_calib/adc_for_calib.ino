@@ -1,5 +1,6 @@
 #include <Arduino.h>
 #include <esp_adc_cal.h>
+#include <Preferences.h>
 
 // Define ADC input pin
 #define VMON_PIN 39  // GPIO39 (VP) connected to voltage monitor
@@ -16,6 +17,7 @@
 #define R9 200000.0  // 200kΩ
 
 esp_adc_cal_characteristics_t *adc_chars;
+esp_adc_cal_value_t adcCalType;  // Source of the characterization (eFuse Vref, eFuse two point or default Vref)
 #define DEFAULT_VREF 1100  // Default VREF in mV
 
 float calculateVIN(uint32_t adcRaw) {
@@ -28,9 +30,153 @@ float calculateVIN(uint32_t adcRaw) {
     return VIN;
 }
 
+// calibrateVIN() coefficients (a*vin^3 + b*vin^2 + c*vin + d), loaded from NVS at boot
+// Defaults are used until the host provisions the board with the 'c' command
+Preferences prefs;
+double calCoeffs[4] = {0.000443, -0.007643, 1.040472, 0.018605};
+uint32_t calVersion = 0;
+
 float calibrateVIN(float vin) {
-        return (0.000443 * vin * vin * vin) + (-0.007643 * vin * vin) + (1.040472 * vin) + 0.018605; 
-    } 
+        return (calCoeffs[0] * vin * vin * vin) + (calCoeffs[1] * vin * vin) + (calCoeffs[2] * vin) + calCoeffs[3];
+    }
+
+// Raw-code lookup table that adc_lut_codegen.py writes into a per-board copy of the sketch;
+// when present it replaces calibrateVIN() for readings
+#if __has_include("vin_lut.h")
+#include "vin_lut.h"
+#endif
+
+float calibratedReading(int rawADC, float vin) {
+#ifdef USE_VIN_LUT
+    return rawToVinMv(rawADC) / 1000.0;
+#else
+    return calibrateVIN(vin);
+#endif
+}
+
+void loadCalibration() {
+    prefs.begin("sarq_cal", true);
+    if (prefs.getBytesLength("coeffs") == sizeof(calCoeffs)) {
+        prefs.getBytes("coeffs", calCoeffs, sizeof(calCoeffs));
+        calVersion = prefs.getUInt("version", 0);
+    }
+    prefs.end();
+}
+
+void printCalibration() {
+    Serial.printf("Calibration Coefficients: %.10g, %.10g, %.10g, %.10g | Version: %u\n",
+                  calCoeffs[0], calCoeffs[1], calCoeffs[2], calCoeffs[3], (unsigned) calVersion);
+}
+
+// esp_adc_cal characterization, so the host can reproduce esp_adc_cal_raw_to_voltage() (adc_esp_adc_cal.py)
+void printCharacterization() {
+    Serial.printf("ADC Characterization: type %d | vref %u | coeff_a %u | coeff_b %u\n",
+                  (int) adcCalType, (unsigned) adc_chars->vref, (unsigned) adc_chars->coeff_a, (unsigned) adc_chars->coeff_b);
+}
+
+// Parse "<a> <b> <c> <d>" from the rest of the line and store it in NVS
+void storeCalibration() {
+    String line = Serial.readStringUntil('\n');
+#ifdef USE_VIN_LUT
+    // Readings come from the lookup table, so the coefficients would have no effect
+    Serial.println("Calibration Error: VIN lookup table active, coefficients not stored");
+    return;
+#endif
+    const char *p = line.c_str();
+    double parsed[4];
+    for (int i = 0; i < 4; i++) {
+        char *end;
+        parsed[i] = strtod(p, &end);
+        if (end == p) {
+            Serial.println("Calibration Error: expected 4 coefficients");
+            return;
+        }
+        p = end;
+    }
+
+    memcpy(calCoeffs, parsed, sizeof(calCoeffs));
+    calVersion++;
+    prefs.begin("sarq_cal", false);
+    prefs.putBytes("coeffs", calCoeffs, sizeof(calCoeffs));
+    prefs.putUInt("version", calVersion);
+    prefs.end();
+    printCalibration();
+}
+
+// Binary sample record, sent COBS-encoded with a trailing 0x00 delimiter:
+// type, sequence, raw ADC, calibrated ADC mV, VIN, calibrated VIN, then CRC-16/CCITT-FALSE
+#define FRAME_TYPE_SAMPLE 0x01
+
+struct __attribute__((packed)) SampleRecord {
+    uint8_t type;
+    uint32_t seq;
+    uint16_t rawADC;
+    uint16_t adcCal_mV;
+    float vin;
+    float calibratedVIN;
+};
+
+uint32_t sampleSeq = 0;
+
+// Streaming mode: frames are sent every streamIntervalUs (0 = off), see 's' / 'x' commands
+// At 115200 baud a 21-byte frame limits the useful rate to ~500 Hz
+#define MAX_STREAM_HZ 500
+uint32_t streamIntervalUs = 0;
+uint32_t lastStreamUs = 0;
+
+uint16_t crc16(const uint8_t *data, size_t len) {
+    uint16_t crc = 0xFFFF;
+    for (size_t i = 0; i < len; i++) {
+        crc ^= (uint16_t) data[i] << 8;
+        for (int b = 0; b < 8; b++) {
+            crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+        }
+    }
+    return crc;
+}
+
+// Consistent Overhead Byte Stuffing: removes every 0x00 so it can delimit frames
+size_t cobsEncode(const uint8_t *data, size_t len, uint8_t *out) {
+    size_t codeIndex = 0, outIndex = 1;
+    uint8_t code = 1;
+    for (size_t i = 0; i < len; i++) {
+        if (data[i] == 0) {
+            out[codeIndex] = code;
+            codeIndex = outIndex++;
+            code = 1;
+        } else {
+            out[outIndex++] = data[i];
+            if (++code == 0xFF) {
+                out[codeIndex] = code;
+                codeIndex = outIndex++;
+                code = 1;
+            }
+        }
+    }
+    out[codeIndex] = code;
+    return outIndex;
+}
+
+void sendSampleFrame(int rawADC, uint32_t adcCalVoltage, float VIN, float calibratedVIN) {
+    uint8_t payload[sizeof(SampleRecord) + 2];
+    SampleRecord record = {FRAME_TYPE_SAMPLE, sampleSeq++, (uint16_t) rawADC, (uint16_t) adcCalVoltage, VIN, calibratedVIN};
+    memcpy(payload, &record, sizeof(record));
+    uint16_t crc = crc16(payload, sizeof(record));
+    payload[sizeof(record)] = crc & 0xFF;
+    payload[sizeof(record) + 1] = crc >> 8;
+
+    uint8_t frame[sizeof(payload) + 2];
+    size_t len = cobsEncode(payload, sizeof(payload), frame);
+    frame[len++] = 0x00;
+    Serial.write(frame, len);
+}
+
+void sendSample() {
+    int rawADC = analogRead(VMON_PIN);
+    uint32_t adcCalVoltage = esp_adc_cal_raw_to_voltage(rawADC, adc_chars);
+    float VIN = calculateVIN(rawADC);
+    sendSampleFrame(rawADC, adcCalVoltage, VIN, calibratedReading(rawADC, VIN));
+}
 
 void setup() {
     Serial.begin(115200);
@@ -43,7 +189,9 @@ void setup() {
     delay(500);
 
     adc_chars = (esp_adc_cal_characteristics_t*) calloc(1, sizeof(esp_adc_cal_characteristics_t));     // Allocate memory for ADC characteristics
-    esp_adc_cal_characterize(ADC_UNIT_1, ADC_ATTEN_DB_11, ADC_WIDTH_BIT_12, DEFAULT_VREF, adc_chars);    // Initialize ADC Calibration
+    adcCalType = esp_adc_cal_characterize(ADC_UNIT_1, ADC_ATTEN_DB_11, ADC_WIDTH_BIT_12, DEFAULT_VREF, adc_chars);    // Initialize ADC Calibration
+
+    loadCalibration();
 }
 
 void loop() {
@@ -54,7 +202,7 @@ void loop() {
             uint32_t adcCalVoltage = esp_adc_cal_raw_to_voltage(rawADC, adc_chars);  // Corrected voltage in mV
 
             float VIN = calculateVIN(rawADC);
-            float calibratedVIN = calibrateVIN(VIN);
+            float calibrated = calibratedReading(rawADC, VIN);
 
             Serial.print("Raw ADC: ");
             Serial.print(rawADC);
@@ -63,8 +211,28 @@ void loop() {
             Serial.print(" | Calculated VIN: ");
             Serial.print(VIN, 3);  // Display VIN
             Serial.print(" | Calibrated VIN: ");
-            Serial.println(calibratedVIN, 3);  // Display calibrated VIN
+            Serial.println(calibrated, 3);  // Display calibrated VIN
+        } else if (input == 'b') {
+            sendSample();  // Same reading as 'a', as a binary frame (no text formatting or rounding)
+        } else if (input == 's') {
+            // Start streaming: "s<rate in Hz>\n"
+            long hz = Serial.parseInt();
+            hz = constrain(hz <= 0 ? 100 : hz, 1, MAX_STREAM_HZ);
+            streamIntervalUs = 1000000UL / hz;
+            lastStreamUs = micros();
+        } else if (input == 'x') {
+            streamIntervalUs = 0;  // Stop streaming
+        } else if (input == 'c') {
+            storeCalibration();  // Provision coefficients: "c <a> <b> <c> <d>\n"
+        } else if (input == 'r') {
+            printCalibration();  // Read back the active coefficients
+        } else if (input == 'e') {
+            printCharacterization();  // esp_adc_cal parameters of this board
         }
     }
-    delay(1000);  
+
+    if (streamIntervalUs && micros() - lastStreamUs >= streamIntervalUs) {
+        lastStreamUs += streamIntervalUs;
+        sendSample();
+    }
 }
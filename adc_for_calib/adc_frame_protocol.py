@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Apr 16 14:21:50 2025
+
+@author: nichm
+
+Decoder for the binary sample frames sent by adc_for_calib.ino ('b' command).
+
+Each frame is a packed little-endian record (type, sequence, raw ADC, ADC cal
+mV, VIN, calibrated VIN) followed by a CRC-16/CCITT-FALSE, COBS-encoded and
+terminated by a 0x00 byte. Frames that fail COBS or CRC are counted as
+corrupted instead of being dropped silently.
+"""
+
+import binascii
+import struct
+
+import numpy as np
+
+FRAME_TYPE_SAMPLE = 0x01
+FRAME_DELIMITER = b'\x00'
+
+RECORD = struct.Struct('<BIHHff')
+RECORD_DTYPE = np.dtype([
+    ('type', '<u1'),
+    ('seq', '<u4'),
+    ('raw_adc', '<u2'),
+    ('adc_cal_mv', '<u2'),
+    ('vin', '<f4'),
+    ('calibrated_vin', '<f4'),
+])
+PAYLOAD_SIZE = RECORD.size + 2
+MAX_FRAME_SIZE = PAYLOAD_SIZE + PAYLOAD_SIZE // 254 + 2
+
+
+class FrameError(ValueError):
+    """Raised when a frame fails COBS decoding, length or CRC checks."""
+
+
+def crc16(data):
+    """CRC-16/CCITT-FALSE, the same checksum the firmware appends."""
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def cobs_encode(data):
+    """COBS-encode data so it contains no 0x00 bytes (delimiter not included)."""
+    out = bytearray()
+    for block in bytes(data).split(b'\x00'):
+        while len(block) >= 254:
+            out.append(0xFF)
+            out += block[:254]
+            block = block[254:]
+        out.append(len(block) + 1)
+        out += block
+    return bytes(out)
+
+
+def cobs_decode(frame):
+    """Undo COBS encoding of one frame (without its delimiter)."""
+    frame = memoryview(frame)
+    out = bytearray()
+    i, n = 0, len(frame)
+    while i < n:
+        code = frame[i]
+        if code == 0 or i + code > n:
+            raise FrameError("Invalid COBS code")
+        out += frame[i + 1:i + code]
+        i += code
+        if code < 0xFF and i < n:
+            out.append(0)
+    return bytes(out)
+
+
+def encode_frame(seq, raw_adc, adc_cal_mv, vin, calibrated_vin):
+    """Build a frame exactly like the firmware does (used by simulators and tests)."""
+    record = RECORD.pack(FRAME_TYPE_SAMPLE, seq, raw_adc, adc_cal_mv, vin, calibrated_vin)
+    return cobs_encode(record + struct.pack('<H', crc16(record))) + FRAME_DELIMITER
+
+
+def decode_payload(frame):
+    """Decode one frame (without delimiter) into its raw record bytes, checking length and CRC."""
+    payload = cobs_decode(frame)
+    if len(payload) != PAYLOAD_SIZE:
+        raise FrameError(f"Unexpected payload length {len(payload)}")
+    record = payload[:RECORD.size]
+    if crc16(record) != struct.unpack_from('<H', payload, RECORD.size)[0]:
+        raise FrameError("CRC mismatch")
+    if record[0] != FRAME_TYPE_SAMPLE:
+        raise FrameError(f"Unknown frame type {record[0]}")
+    return record
+
+
+def decode_frame(frame):
+    """Decode one frame into (seq, raw ADC, ADC cal mV, VIN, calibrated VIN)."""
+    return RECORD.unpack(decode_payload(frame))[1:]
+
+
+def as_reading(sample):
+    """Convert a decoded sample into the (raw ADC, cal voltage V, VIN, calibrated VIN) tuple of parse_serial_data()."""
+    _, raw_adc, adc_cal_mv, vin, calibrated_vin = sample
+    return raw_adc, adc_cal_mv / 1000.0, vin, calibrated_vin
+
+
+class FrameDecoder:
+    """Incremental decoder for a byte stream of frames.
+
+    feed() accepts any bytes-like chunk and keeps partial frames for the next
+    call. Valid records are appended to one contiguous buffer, so records()
+    returns a NumPy view of them without copying.
+    """
+
+    def __init__(self):
+        self.pending = bytearray()
+        self.buffer = bytearray()
+        self.frames = 0
+        self.corrupted = 0
+        self.dropped = 0
+        self.last_seq = None
+
+    def feed(self, chunk):
+        """Decode every complete frame in chunk. Returns the number of new valid records."""
+        self.pending += chunk
+        end = self.pending.rfind(FRAME_DELIMITER)
+        if end < 0:
+            if len(self.pending) > 4 * MAX_FRAME_SIZE:
+                # No delimiter in sight: garbage (e.g. text output), drop it
+                self.corrupted += 1
+                self.pending.clear()
+            return 0
+
+        view = memoryview(self.pending)
+        start = 0
+        added = 0
+        while start <= end:
+            stop = self.pending.find(FRAME_DELIMITER, start, end + 1)
+            frame = view[start:stop]
+            start = stop + 1
+            if not frame:
+                continue
+            self.frames += 1
+            try:
+                record = decode_payload(frame)
+            except FrameError:
+                self.corrupted += 1
+                continue
+            seq = struct.unpack_from('<I', record, 1)[0]
+            if self.last_seq is not None and seq != (self.last_seq + 1) & 0xFFFFFFFF:
+                self.dropped += (seq - self.last_seq - 1) & 0xFFFFFFFF
+            self.last_seq = seq
+            try:
+                self.buffer += record
+            except BufferError:
+                # A records() view is still alive: grow a copy and leave that view intact
+                self.buffer = self.buffer + record
+            added += 1
+        frame = None
+        view.release()
+        del self.pending[:end + 1]
+        return added
+
+    def records(self):
+        """All valid records so far as a structured NumPy array (a view on the internal buffer)."""
+        return np.frombuffer(self.buffer, dtype=RECORD_DTYPE)
+
+    def clear(self):
+        """Forget decoded records (counters are kept)."""
+        self.buffer = bytearray()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Apr 21 13:47:05 2025
+
+@author: nichm
+
+Programmable bench supply / meter backends for hands-off sweeps.
+
+A supply spec string picks the backend:
+    "sim"                        simulated supply + meter (no hardware)
+    "tcp:192.168.1.50:5025"      SCPI over a raw TCP socket (LXI instruments; port defaults to 5025)
+    "serial:COM7@9600"           SCPI over a serial port
+A separate DMM for the true voltage takes the same tcp/serial specs
+(open_supply(..., meter_spec=...)); without one the supply's own readback is used.
+"""
+
+import random
+import socket
+import threading
+import time
+
+import serial
+
+
+class SerialTransport:
+    """SCPI line transport over a serial port."""
+
+    def __init__(self, port, baudrate=9600, timeout=2):
+        self.ser = serial.Serial(port, baudrate, timeout=timeout)
+
+    def write(self, command):
+        self.ser.write((command + "\n").encode())
+
+    def query(self, command):
+        self.write(command)
+        return self.ser.readline().decode('utf-8', errors='replace').strip()
+
+    def close(self):
+        self.ser.close()
+
+
+class TcpTransport:
+    """SCPI line transport over a raw TCP socket."""
+
+    def __init__(self, host, port=5025, timeout=2):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.file = self.sock.makefile('rb')
+
+    def write(self, command):
+        self.sock.sendall((command + "\n").encode())
+
+    def query(self, command):
+        self.write(command)
+        return self.file.readline().decode('utf-8', errors='replace').strip()
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class ScpiSupply:
+    """Bench supply driven with standard SCPI commands, optionally read back through a separate meter."""
+
+    def __init__(self, transport, settle_time=0.5, meter=None):
+        self.transport = transport
+        self.settle_time = settle_time
+        self.meter = meter
+
+    def identify(self):
+        return self.transport.query("*IDN?")
+
+    def set_voltage(self, volts):
+        self.transport.write(f"VOLT {volts:.4f}")
+        self.transport.write("OUTP ON")
+
+    def measure_voltage(self):
+        """True output voltage: from the meter when one is attached, else the supply's own readback."""
+        if self.meter is not None:
+            return self.meter.measure_voltage()
+        return float(self.transport.query("MEAS:VOLT?"))
+
+    def output(self, on):
+        self.transport.write(f"OUTP {'ON' if on else 'OFF'}")
+
+    def close(self):
+        self.transport.close()
+        if self.meter is not None:
+            self.meter.close()
+
+
+class ScpiMeter:
+    """DC voltmeter driven with SCPI."""
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def measure_voltage(self):
+        return float(self.transport.query("MEAS:VOLT:DC?"))
+
+    def close(self):
+        self.transport.close()
+
+
+class SimulatedSupply:
+    """Local stand-in for a supply + meter: programmable output with gain/offset error, noise and settling.
+
+    Listeners registered with attach() are called with the true output
+    voltage whenever it changes (used to drive simulated boards).
+    """
+
+    def __init__(self, gain_error=0.002, offset=0.01, noise=0.002, settle_time=0.0, seed=None):
+        self.gain_error = gain_error
+        self.offset = offset
+        self.noise = noise
+        self.settle_time = settle_time
+        self.rng = random.Random(seed)
+        self.setpoint = 0.0
+        self.enabled = False
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def identify(self):
+        return "SARQ,Simulated Supply,0,1.0"
+
+    @property
+    def true_voltage(self):
+        if not self.enabled:
+            return 0.0
+        return self.setpoint * (1 + self.gain_error) + self.offset
+
+    def attach(self, listener):
+        self.listeners.append(listener)
+        listener(self.true_voltage)
+
+    def _notify(self):
+        for listener in self.listeners:
+            listener(self.true_voltage)
+
+    def set_voltage(self, volts):
+        with self.lock:
+            self.setpoint = volts
+            self.enabled = True
+        self._notify()
+
+    def measure_voltage(self):
+        with self.lock:
+            return round(self.true_voltage + self.rng.gauss(0, self.noise), 4)
+
+    def output(self, on):
+        with self.lock:
+            self.enabled = on
+        self._notify()
+
+    def close(self):
+        self.output(False)
+
+
+simulated_supply = None
+
+
+def get_simulated_supply():
+    """The process-wide simulated supply, so simulated boards and sweeps in one process share it."""
+    global simulated_supply
+    if simulated_supply is None:
+        simulated_supply = SimulatedSupply()
+    return simulated_supply
+
+
+def open_transport(spec):
+    """SCPI transport from a "tcp:<host>[:<port>]" or "serial:<port>[@<baudrate>]" spec."""
+    kind, _, target = spec.partition(":")
+    if kind == "tcp":
+        host, _, port = target.partition(":")
+        if not host:
+            raise ValueError(f"No host in instrument spec '{spec}'")
+        return TcpTransport(host, int(port or 5025))
+    if kind == "serial":
+        port, _, baudrate = target.partition("@")
+        if not port:
+            raise ValueError(f"No port in instrument spec '{spec}'")
+        return SerialTransport(port, int(baudrate or 9600))
+    raise ValueError(f"Unknown instrument spec '{spec}'")
+
+
+def open_meter(spec):
+    return ScpiMeter(open_transport(spec))
+
+
+def open_supply(spec, settle_time=0.5, meter_spec=None):
+    """Create a supply backend from a spec string (see module docstring), read back through a meter if given."""
+    if spec == "sim":
+        if meter_spec:
+            raise ValueError("The simulated supply has its own meter; no meter spec is used with 'sim'")
+        return get_simulated_supply()
+    meter = open_meter(meter_spec) if meter_spec else None
+    return ScpiSupply(open_transport(spec), settle_time, meter)
+
+
+def run_sweep(supply, plan, capture):
+    """Step the supply through the plan, read back the true voltage and call capture(actual) at each point.
+
+    Returns the number of points for which capture() returned a value.
+    """
+    captured = 0
+    try:
+        for setpoint in plan:
+            supply.set_voltage(setpoint)
+            time.sleep(supply.settle_time)
+            actual = supply.measure_voltage()
+            print(f"🔌 Set {setpoint:.3f}V, measured {actual:.4f}V")
+            if capture(actual) is not None:
+                captured += 1
+    except KeyboardInterrupt:
+        print("Sweep stopped.")
+    finally:
+        supply.output(False)
+    return captured
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon May 12 10:41:08 2025
+
+@author: nichm
+
+Raw ADC -> calibrated VIN lookup table for the firmware.
+
+Instead of esp_adc_cal_raw_to_voltage() + calculateVIN() + the float cubic of
+calibrateVIN() on every reading, the board can index a table of uint16_t
+millivolts by the raw 12-bit code: one entry every 2^shift codes, linear
+interpolation in integer math in between, stored in flash (PROGMEM). The
+table is generated here from what the board computes today (its esp_adc_cal
+characterization, see adc_esp_adc_cal.py, then calculateVIN() and
+calibrateVIN() with its coefficients), or with --direct from a cubic fitted straight from
+raw counts to the actual input. The firmware's integer interpolation is
+emulated for all 4096 codes to report the max error next to the footprint.
+
+A table only suits the board it was made for, so --ino writes it as vin_lut.h
+into a per-board copy of the sketch (board_sketches/<board>/<sketch>/, see
+adc_build_cache.board_sketch()); adc_for_calib.ino and ../SARQ/SARQ.ino use
+the header when it is there. With the table active adc_for_calib.ino refuses
+the 'c' command, since provisioned coefficients would not be used.
+
+    python adc_lut_codegen.py tests/sarq_eval-0004.csv
+    python adc_lut_codegen.py ../adc_read_2/tests/sarq-0002.csv --shift 6 --ino ../SARQ/SARQ.ino
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from adc_build_cache import board_sketch
+from adc_esp_adc_cal import dataset_characterization, raw_to_voltage
+from adc_firmware_emulator import ADC_MAX_VALUE, DEFAULT_COEFFS, calculate_vin, calibrate_vin
+from adc_fleet_report import load_csvs
+from adc_model_selection import clean_points, fit_model
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_GLOBS = [
+    os.path.join(SCRIPT_DIR, "tests", "sarq_eval-*.csv"),
+    os.path.join(SCRIPT_DIR, "..", "adc_read_2", "tests", "sarq-*.csv"),
+]
+CODES = np.arange(ADC_MAX_VALUE + 1)
+MAX_ERROR_MV = 2.0        # Largest table error accepted when the shift is chosen automatically
+LUT_HEADER = "vin_lut.h"
+LUT_CODE_BYTES = 40       # Approximate size of rawToVinMv() on the ESP32
+
+
+def firmware_curve(dataset, coeffs):
+    """calibrateVIN(calculateVIN(raw)) in volts for every raw code, as the board computes it today.
+
+    esp_adc_cal is taken without its 1 mV rounding: that step (about 5 mV of VIN) is quantization
+    of the current path, not something the table should reproduce.
+    """
+    chars = dataset_characterization(dataset)
+    if chars is None:
+        return None
+    mv = raw_to_voltage(CODES, chars, rounded=False)
+    return calibrate_vin(coeffs, calculate_vin(mv)).astype(np.float64)
+
+
+def direct_curve(values):
+    """A cubic from raw counts straight to the actual input, fitted on unsaturated readings."""
+    _, raw, actual = clean_points(values)
+    keep = np.isfinite(raw) & (raw < ADC_MAX_VALUE)
+    if np.count_nonzero(keep) < 5:
+        return None
+    coeffs = fit_model('raw_cubic', raw[keep], actual[keep])
+    return None if coeffs is None else np.polyval(coeffs, CODES.astype(float))
+
+
+def build_table(curve, shift):
+    """uint16 mV entries at codes 0, 2^shift, ... 4096 (the last one extrapolated from the final code)."""
+    step = 1 << shift
+    points = np.arange(0, ADC_MAX_VALUE + 2, step)
+    slope = curve[-1] - curve[-2]
+    values = np.where(points <= ADC_MAX_VALUE, curve[np.minimum(points, ADC_MAX_VALUE)],
+                      curve[-1] + slope * (points - ADC_MAX_VALUE))
+    return np.clip(np.round(values * 1000.0), 0, 0xFFFF).astype(np.uint16)
+
+
+def lookup(table, shift, raw):
+    """rawToVinMv() from the firmware: integer interpolation with rounding (arithmetic shift)."""
+    raw = np.asarray(raw, dtype=np.int32)
+    i = raw >> shift
+    a = table[i].astype(np.int32)
+    b = table[i + 1].astype(np.int32)
+    frac = raw & ((1 << shift) - 1)
+    return a + (((b - a) * frac + ((1 << shift) >> 1)) >> shift)
+
+
+def table_report(curve, shift):
+    table = build_table(curve, shift)
+    error = lookup(table, shift, CODES) - curve * 1000.0
+    return {'shift': shift, 'entries': len(table), 'table_bytes': int(table.nbytes),
+            'flash_bytes': int(table.nbytes) + LUT_CODE_BYTES,
+            'max_error_mv': float(np.max(np.abs(error))), 'rms_error_mv': float(np.sqrt(np.mean(error ** 2)))}, table
+
+
+def choose_shift(curve, max_error_mv=MAX_ERROR_MV, shifts=range(1, 9)):
+    """Largest step (smallest table) whose max error stays under max_error_mv."""
+    reports = [table_report(curve, shift)[0] for shift in shifts]
+    within = [r for r in reports if r['max_error_mv'] <= max_error_mv]
+    best = max(within, key=lambda r: r['shift']) if within else min(reports, key=lambda r: r['max_error_mv'])
+    return best['shift'], reports
+
+
+def generate_lut_source(table, shift, label=""):
+    """vin_lut.h for the firmware: the table plus rawToVinMv()."""
+    rows = [", ".join(str(v) for v in table[i:i + 16]) for i in range(0, len(table), 16)]
+    body = ",\n    ".join(rows)
+    note = f" ({label})" if label else ""
+    return f"""// Raw 12-bit ADC code -> calibrated VIN in mV{note}, generated by adc_lut_codegen.py
+#pragma once
+#include <Arduino.h>
+
+#define USE_VIN_LUT
+#define VIN_LUT_SHIFT {shift}
+static const uint16_t VIN_LUT[{len(table)}] PROGMEM = {{
+    {body}
+}};
+
+static uint16_t rawToVinMv(uint16_t raw) {{
+    uint16_t i = raw >> VIN_LUT_SHIFT;
+    int32_t a = pgm_read_word(&VIN_LUT[i]);
+    int32_t b = pgm_read_word(&VIN_LUT[i + 1]);
+    int32_t frac = raw & ((1 << VIN_LUT_SHIFT) - 1);
+    return (uint16_t) (a + (((b - a) * frac + ((1 << VIN_LUT_SHIFT) >> 1)) >> VIN_LUT_SHIFT));
+}}
+"""
+
+
+def write_board_lut(ino_filepath, board_no, source):
+    """Copy the sketch for this board and put the table next to it. Returns the copied .ino path."""
+    sketch = board_sketch(ino_filepath, f"{board_no:04d}")
+    with open(os.path.join(os.path.dirname(sketch), LUT_HEADER), 'w') as file:
+        file.write(source)
+    print(f"✅ Wrote {LUT_HEADER} into {os.path.dirname(sketch)} (flash {sketch} to board {board_no:04d}).")
+    return sketch
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a raw ADC -> calibrated VIN lookup table for the firmware.")
+    parser.add_argument("paths", nargs="*", help="eval CSVs with Raw ADC columns (default: reference eval logs)")
+    parser.add_argument("--direct", action="store_true", help="fit raw counts to the actual input instead of "
+                                                              "reproducing the current firmware chain")
+    parser.add_argument("--shift", type=int, default=None, choices=range(0, 9), metavar="0-8",
+                        help="log2 of the table step, 0 for one entry per code (default: chosen by --max-error)")
+    parser.add_argument("--max-error", type=float, default=MAX_ERROR_MV, help="mV, used when choosing the step")
+    parser.add_argument("--emit", action="store_true", help="print the generated C source")
+    parser.add_argument("--ino", default=None, help="write the table of the (single) dataset into a per-board copy of "
+                                                        "this sketch (e.g. adc_for_calib.ino, ../SARQ/SARQ.ino)")
+    parser.add_argument("--output", default=os.path.join(SCRIPT_DIR, "reports", "vin_lut.json"))
+    args = parser.parse_args()
+
+    datasets = [d for d in load_csvs(args.paths or DEFAULT_GLOBS) if d['kind'] == 'eval']
+    if not datasets:
+        print("No eval datasets with raw ADC readings found.")
+        return 1
+    if args.ino and (len(datasets) != 1 or datasets[0]['board'] is None):
+        print("❌ --ino needs exactly one dataset with a board number.")
+        return 1
+
+    results = []
+    for dataset in datasets:
+        coeffs = dataset['coeffs'] or DEFAULT_COEFFS
+        curve = direct_curve(dataset['values']) if args.direct else firmware_curve(dataset, coeffs)
+        if curve is None:
+            print(f"❌ {dataset['name']}: not enough raw readings")
+            continue
+        shift, reports = choose_shift(curve, args.max_error)
+        shift = args.shift if args.shift is not None else shift
+        report, table = table_report(curve, shift)
+        results.append({'name': dataset['name'], 'board': dataset['board'], 'direct': args.direct,
+                        'chosen': report, 'candidates': reports})
+
+        print(f"📋 {dataset['name']}")
+        for r in reports if shift in [r['shift'] for r in reports] else [report] + reports:
+            marker = "👉" if r['shift'] == shift else "  "
+            print(f"   {marker} step {1 << r['shift']:>4}: {r['entries']:>5} entries, {r['flash_bytes']:>5} bytes flash, "
+                  f"max error {r['max_error_mv']:.2f} mV (rms {r['rms_error_mv']:.2f})")
+        source = generate_lut_source(table, shift, dataset['name'])
+        if args.emit:
+            print(source)
+        if args.ino:
+            write_board_lut(args.ino, dataset['board'], source)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"💾 Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue May  6 09:55:37 2025
+
+@author: nichm
+
+Per-board model selection by cross-validation.
+
+Candidate calibration models are scored on held-out points (leave-one-out
+for small sweeps, k-fold otherwise):
+    quadratic, cubic       polynomial in calculated VIN
+    piecewise              two quadratics split at a breakpoint (chosen inside each fold)
+    spline                 monotone cubic Hermite (PCHIP) through least-squares knots
+    raw_cubic              cubic in raw ADC counts (bypasses esp_adc_cal and calculateVIN)
+Polynomial and piecewise folds are solved together as one batch (see
+adc_fleet_refit.batch_polyfit). The chosen model is the cheapest one to
+evaluate on the ESP32 among those whose held-out RMSE is within tolerance of
+the best. Only the polynomials can be provisioned into the generic firmware's
+cubic ('c' command); with provisionable_only the others are not candidates,
+otherwise they need a per-board build of the sketch. Boards are spread over a
+process pool when there are many.
+
+    python adc_model_selection.py                  # tests/ and ../adc_read_2/tests/
+    python adc_model_selection.py --store --allow-raw
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from adc_fleet_refit import batch_polyfit
+from adc_fleet_report import DEFAULT_GLOBS, load_csvs, load_store
+from adc_sample_store import SampleStore
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+POOL_THRESHOLD = 16
+
+# Firmware cost of evaluating each model once: float operations (incl. compares) and flash bytes for constants
+MODEL_COST = {
+    'quadratic': {'ops': 5, 'bytes': 12, 'provisionable': True},
+    'cubic': {'ops': 9, 'bytes': 16, 'provisionable': True},
+    'piecewise': {'ops': 6, 'bytes': 28, 'provisionable': False},
+    'spline': {'ops': 16, 'bytes': 72, 'provisionable': False},
+    'raw_cubic': {'ops': 9, 'bytes': 16, 'provisionable': False},
+}
+SPLINE_KNOTS = 6
+LOO_MAX_POINTS = 15
+K_FOLDS = 5
+MODEL_LABEL = "Calibration Model:"  # Calibration CSV row of a flashed model that has no cubic coefficients
+
+
+def make_folds(n, seed=0):
+    """Boolean test masks (folds x n): leave-one-out for small n, shuffled k-fold otherwise."""
+    if n <= LOO_MAX_POINTS:
+        return np.eye(n, dtype=bool)
+    order = np.random.default_rng(seed).permutation(n)
+    folds = np.zeros((K_FOLDS, n), dtype=bool)
+    folds[np.arange(n) % K_FOLDS, order] = True
+    return folds
+
+
+def polyval_rows(coeffs, x):
+    """Evaluate one polynomial per row of x (coeffs: rows x (degree + 1), highest power first)."""
+    result = np.zeros_like(x)
+    for k in range(coeffs.shape[1]):
+        result = result * x + coeffs[:, k:k + 1]
+    return result
+
+
+def cv_polynomial(x, y, folds, degree):
+    """Held-out predictions of a polynomial fit, all folds in one batched solve."""
+    tiled_x = np.broadcast_to(x, folds.shape).copy()
+    tiled_y = np.broadcast_to(y, folds.shape).copy()
+    coeffs, ok = batch_polyfit(tiled_x, tiled_y, ~folds, degree)
+    predicted = polyval_rows(np.nan_to_num(coeffs), tiled_x)
+    predicted[~ok] = np.nan
+    return np.where(folds, predicted, 0.0).sum(axis=0) / folds.sum(axis=0)
+
+
+def fit_polynomial(x, y, degree):
+    coeffs, ok = batch_polyfit(x[None, :], y[None, :], np.ones((1, len(x)), bool), degree)
+    return coeffs[0] if ok[0] else None
+
+
+def breakpoint_candidates(x, count=5):
+    return np.unique(np.percentile(x, np.linspace(30, 70, count)))
+
+
+def piecewise_batch(x, y, train, breakpoints, degree=2):
+    """Fit low/high polynomials for every (train mask, breakpoint) pair. Returns coeffs, ok and train SSE."""
+    rows, n = len(train) * len(breakpoints), len(x)
+    bx = np.broadcast_to(x, (rows, n)).copy()
+    by = np.broadcast_to(y, (rows, n)).copy()
+    masks = np.repeat(train, len(breakpoints), axis=0)
+    split = np.tile(breakpoints, len(train))[:, None]
+    low_mask, high_mask = masks & (bx < split), masks & (bx >= split)
+    low, low_ok = batch_polyfit(bx, by, low_mask, degree)
+    high, high_ok = batch_polyfit(bx, by, high_mask, degree)
+    predicted = np.where(bx < split, polyval_rows(np.nan_to_num(low), bx), polyval_rows(np.nan_to_num(high), bx))
+    sse = np.where(masks, (predicted - by) ** 2, 0.0).sum(axis=1)
+    ok = low_ok & high_ok
+    sse[~ok] = np.inf
+    shape = (len(train), len(breakpoints))
+    return low.reshape(shape + (-1,)), high.reshape(shape + (-1,)), ok.reshape(shape), sse.reshape(shape)
+
+
+def cv_piecewise(x, y, folds):
+    """Held-out predictions of the piecewise model; each fold picks its breakpoint on its training points."""
+    breakpoints = breakpoint_candidates(x)
+    low, high, ok, sse = piecewise_batch(x, y, ~folds, breakpoints)
+    best = np.argmin(sse, axis=1)
+    f = np.arange(len(folds))
+    split = breakpoints[best][:, None]
+    bx = np.broadcast_to(x, folds.shape)
+    predicted = np.where(bx < split, polyval_rows(np.nan_to_num(low[f, best]), bx),
+                         polyval_rows(np.nan_to_num(high[f, best]), bx))
+    predicted[~ok[f, best]] = np.nan
+    return np.where(folds, predicted, 0.0).sum(axis=0) / folds.sum(axis=0)
+
+
+def fit_piecewise(x, y):
+    breakpoints = breakpoint_candidates(x)
+    low, high, ok, sse = piecewise_batch(x, y, np.ones((1, len(x)), bool), breakpoints)
+    best = int(np.argmin(sse[0]))
+    if not ok[0, best]:
+        return None
+    return {'split': float(breakpoints[best]), 'low': low[0, best], 'high': high[0, best]}
+
+
+def predict_piecewise(params, x):
+    return np.where(x < params['split'], np.polyval(params['low'], x), np.polyval(params['high'], x))
+
+
+def isotonic(values, weights):
+    """Pool-adjacent-violators: the closest non-decreasing sequence (weighted least squares)."""
+    blocks = []
+    for v, w in zip(values, weights):
+        blocks.append([v * w, w, 1])
+        while len(blocks) > 1 and blocks[-2][0] / blocks[-2][1] > blocks[-1][0] / blocks[-1][1]:
+            total, weight, count = blocks.pop()
+            blocks[-1][0] += total
+            blocks[-1][1] += weight
+            blocks[-1][2] += count
+    return np.concatenate([np.full(count, total / weight) for total, weight, count in blocks])
+
+
+def pchip_slopes(kx, ky):
+    """Fritsch-Carlson slopes that keep the Hermite interpolant monotone."""
+    h = np.diff(kx)
+    delta = np.diff(ky) / h
+    slopes = np.zeros_like(ky)
+    slopes[0], slopes[-1] = delta[0], delta[-1]
+    for i in range(1, len(kx) - 1):
+        if delta[i - 1] * delta[i] > 0:
+            w1, w2 = 2 * h[i] + h[i - 1], h[i] + 2 * h[i - 1]
+            slopes[i] = (w1 + w2) / (w1 / delta[i - 1] + w2 / delta[i])
+    return slopes
+
+
+def fit_spline(x, y, knots=SPLINE_KNOTS):
+    """Monotone spline: least-squares knot values (hat basis), made non-decreasing, with PCHIP slopes."""
+    knots = min(knots, len(np.unique(x)) // 2)
+    if knots < 2:
+        return None
+    kx = np.unique(np.percentile(x, np.linspace(0, 100, knots)))
+    if len(kx) < 2:
+        return None
+    basis = np.zeros((len(x), len(kx)))
+    i = np.clip(np.searchsorted(kx, x, side='right') - 1, 0, len(kx) - 2)
+    t = np.clip((x - kx[i]) / (kx[i + 1] - kx[i]), 0.0, 1.0)
+    basis[np.arange(len(x)), i] = 1 - t
+    basis[np.arange(len(x)), i + 1] = t
+    weights = basis.sum(axis=0)
+    if np.any(weights == 0):
+        return None
+    ky = np.linalg.lstsq(basis, y, rcond=None)[0]
+    ky = isotonic(ky, weights)
+    return {'x': kx, 'y': ky, 'm': pchip_slopes(kx, ky)}
+
+
+def predict_spline(params, x):
+    kx, ky, m = params['x'], params['y'], params['m']
+    x = np.asarray(x, dtype=float)
+    i = np.clip(np.searchsorted(kx, x, side='right') - 1, 0, len(kx) - 2)
+    h = kx[i + 1] - kx[i]
+    t = (x - kx[i]) / h
+    inside = (t >= 0) & (t <= 1)
+    t = np.clip(t, 0, 1)
+    h00, h10, h01, h11 = 2 * t**3 - 3 * t**2 + 1, t**3 - 2 * t**2 + t, -2 * t**3 + 3 * t**2, t**3 - t**2
+    result = h00 * ky[i] + h10 * h * m[i] + h01 * ky[i + 1] + h11 * h * m[i + 1]
+    # Linear extrapolation with the end slopes
+    result = np.where(x < kx[0], ky[0] + m[0] * (x - kx[0]), result)
+    result = np.where(x > kx[-1], ky[-1] + m[-1] * (x - kx[-1]), result)
+    return np.where(inside | (x < kx[0]) | (x > kx[-1]), result, np.nan)
+
+
+def cv_spline(x, y, folds):
+    predicted = np.full(len(x), np.nan)
+    for test in folds:
+        params = fit_spline(x[~test], y[~test])
+        if params is not None:
+            predicted[test] = predict_spline(params, x[test])
+    return predicted
+
+
+def fit_model(name, x, y):
+    if name == 'quadratic':
+        return fit_polynomial(x, y, 2)
+    if name in ('cubic', 'raw_cubic'):
+        return fit_polynomial(x, y, 3)
+    if name == 'piecewise':
+        return fit_piecewise(x, y)
+    if name == 'spline':
+        return fit_spline(x, y)
+    raise ValueError(f"Unknown model {name}")
+
+
+def predict_model(name, params, x):
+    if name in ('quadratic', 'cubic', 'raw_cubic'):
+        return np.polyval(params, x)
+    if name == 'piecewise':
+        return predict_piecewise(params, x)
+    return predict_spline(params, x)
+
+
+def cross_validate(name, x, y, folds):
+    if name == 'quadratic':
+        return cv_polynomial(x, y, folds, 2)
+    if name in ('cubic', 'raw_cubic'):
+        return cv_polynomial(x, y, folds, 3)
+    if name == 'piecewise':
+        return cv_piecewise(x, y, folds)
+    return cv_spline(x, y, folds)
+
+
+def clean_mask(values, gross_error=1.0):
+    """Rows with calculated VIN and actual input, minus data-entry slips (off a linear trend by > gross_error).
+
+    The slips pull a line fitted through them off the good rows, so the worst row is dropped and the
+    line refitted, one row at a time, until every remaining row is within gross_error of it.
+    """
+    x, y = values[:, 2], values[:, 4]
+    keep = np.isfinite(x) & np.isfinite(y)
+    while np.count_nonzero(keep) > 4:
+        residual = np.abs(np.polyval(np.polyfit(x[keep], y[keep], 1), x) - y)
+        worst = np.argmax(np.where(keep, residual, -np.inf))
+        if residual[worst] <= gross_error:
+            break
+        keep[worst] = False
+    return keep
+
+
+def clean_points(values, gross_error=1.0):
+    """Calculated VIN, raw ADC and actual input of the clean_mask() rows."""
+    keep = clean_mask(values, gross_error)
+    return values[keep, 2], values[keep, 0], values[keep, 4]
+
+
+def select_model(values, allow_raw=False, provisionable_only=False, rel_tolerance=0.05, abs_tolerance=0.002, seed=0):
+    """Cross-validate every candidate on one board's rows and pick the cheapest one close to the best.
+
+    values: rows of (raw ADC, cal voltage, calculated VIN, calibrated VIN, actual input).
+    provisionable_only: only pick models the generic firmware can store (every candidate is still scored).
+    """
+    x, raw, y = clean_points(np.asarray(values, dtype=float))
+    scores = {}
+    if len(x) < 5:
+        return {'model': None, 'n': int(len(x)), 'scores': scores}
+    folds = make_folds(len(x), seed)
+    candidates = ['quadratic', 'cubic', 'piecewise', 'spline']
+    unsaturated = np.isfinite(raw) & (raw < 4095)
+    if np.count_nonzero(unsaturated) >= 5:
+        candidates.append('raw_cubic')
+
+    for name in candidates:
+        if name == 'raw_cubic':
+            rx, ry = raw[unsaturated], y[unsaturated]
+            predicted = cross_validate(name, rx, ry, make_folds(len(rx), seed))
+            error = predicted - ry
+        else:
+            error = cross_validate(name, x, y, folds) - y
+        if np.all(np.isfinite(error)):
+            scores[name] = {'cv_rmse': float(np.sqrt(np.mean(error ** 2))), 'cv_max': float(np.max(np.abs(error))),
+                            **MODEL_COST[name]}
+
+    eligible = {k: v for k, v in scores.items()
+                if (allow_raw or k != 'raw_cubic') and (v['provisionable'] or not provisionable_only)}
+    if not eligible:
+        return {'model': None, 'n': int(len(x)), 'scores': scores}
+    best = min(s['cv_rmse'] for s in eligible.values())
+    limit = best * (1 + rel_tolerance) + abs_tolerance
+    chosen = min((k for k, s in eligible.items() if s['cv_rmse'] <= limit),
+                 key=lambda k: (eligible[k]['ops'], eligible[k]['bytes'], eligible[k]['cv_rmse']))
+    model_x, model_y = (raw[unsaturated], y[unsaturated]) if chosen == 'raw_cubic' else (x, y)
+    return {'model': chosen, 'n': int(len(x)), 'scores': scores, 'params': fit_model(chosen, model_x, model_y),
+            'folds': 'loo' if len(x) <= LOO_MAX_POINTS else f"{K_FOLDS}-fold"}
+
+
+def as_cubic(result):
+    """Coefficients for the firmware's cubic calibrateVIN() when the chosen model is a polynomial, else None."""
+    if result['model'] == 'quadratic':
+        return np.concatenate([[0.0], result['params']])
+    if result['model'] == 'cubic':
+        return np.asarray(result['params'])
+    return None
+
+
+def model_params(result):
+    """The chosen model's parameters as plain floats and lists, for JSON checkpoints and the CSV."""
+    params = result['params']
+    if isinstance(params, dict):
+        return {k: np.asarray(v).tolist() for k, v in params.items()}
+    return np.asarray(params).tolist()
+
+
+def model_row(result):
+    """Trailing calibration CSV row of a model that is not a cubic: label, model name, parameters as JSON."""
+    return [MODEL_LABEL, result['model'], json.dumps(model_params(result))]
+
+
+def generate_model_formula(result):
+    """calibrateVIN() source for the chosen model; raw_cubic replaces calibratedReading(), which gets the raw code."""
+    name, p = result['model'], result['params']
+    if name in ('quadratic', 'cubic'):
+        c = as_cubic(result)
+        return f"""
+    float calibrateVIN(float vin) {{
+        return ({c[0]:.6f} * vin * vin * vin) + ({c[1]:.6f} * vin * vin) + ({c[2]:.6f} * vin) + {c[3]:.6f};
+    }}
+    """
+    if name == 'piecewise':
+        low, high = p['low'], p['high']
+        return f"""
+    float calibrateVIN(float vin) {{
+        if (vin < {p['split']:.4f}) {{
+            return ({low[0]:.6f} * vin * vin) + ({low[1]:.6f} * vin) + {low[2]:.6f};
+        }}
+        return ({high[0]:.6f} * vin * vin) + ({high[1]:.6f} * vin) + {high[2]:.6f};
+    }}
+    """
+    if name == 'spline':
+        def floats(values):
+            return ", ".join(f"{v:.6f}f" for v in values)
+        n = len(p['x'])
+        return f"""
+    float calibrateVIN(float vin) {{
+        static const float kx[{n}] = {{{floats(p['x'])}}};
+        static const float ky[{n}] = {{{floats(p['y'])}}};
+        static const float km[{n}] = {{{floats(p['m'])}}};
+        if (vin <= kx[0]) return ky[0] + km[0] * (vin - kx[0]);
+        if (vin >= kx[{n - 1}]) return ky[{n - 1}] + km[{n - 1}] * (vin - kx[{n - 1}]);
+        int i = 0;
+        while (vin > kx[i + 1]) i++;
+        float h = kx[i + 1] - kx[i];
+        float t = (vin - kx[i]) / h;
+        float t2 = t * t, t3 = t2 * t;
+        return (2 * t3 - 3 * t2 + 1) * ky[i] + (t3 - 2 * t2 + t) * h * km[i]
+             + (-2 * t3 + 3 * t2) * ky[i + 1] + (t3 - t2) * h * km[i + 1];
+    }}
+    """
+    c = p
+    return f"""
+    float calibratedReading(int rawADC, float vin) {{
+        float x = rawADC;
+        return ({c[0]:.6e} * x * x * x) + ({c[1]:.6e} * x * x) + ({c[2]:.6e} * x) + {c[3]:.6e};
+    }}
+    """
+
+
+def select_dataset(args):
+    dataset, allow_raw, provisionable_only = args
+    result = select_model(dataset['values'], allow_raw, provisionable_only)
+    result.pop('params', None)
+    return dataset['name'], dataset['board'], result
+
+
+def select_fleet(datasets, allow_raw=False, workers=None, provisionable_only=False):
+    """Run select_model() on every dataset, in a process pool when there are many."""
+    jobs = [(d, allow_raw, provisionable_only) for d in datasets]
+    if len(jobs) >= POOL_THRESHOLD:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(select_dataset, jobs, chunksize=max(1, len(jobs) // 32)))
+    return [select_dataset(job) for job in jobs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cross-validate calibration models per board.")
+    parser.add_argument("paths", nargs="*", help="CSV files or glob patterns (default: tests/ folders)")
+    parser.add_argument("--store", action="store_true", help="read the sample store instead of CSVs")
+    parser.add_argument("--allow-raw", action="store_true", help="let the raw-ADC model win (needs firmware changes)")
+    parser.add_argument("--provisionable", action="store_true", help="only pick models the generic firmware can store")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default=os.path.join(SCRIPT_DIR, "reports", "model_selection.json"))
+    args = parser.parse_args()
+
+    datasets = load_store(SampleStore()) if args.store else load_csvs(args.paths or DEFAULT_GLOBS)
+    if not datasets:
+        print("No datasets found.")
+        return 1
+    started = time.perf_counter()
+    results = select_fleet(datasets, args.allow_raw, args.workers, args.provisionable)
+    elapsed = time.perf_counter() - started
+
+    names = list(MODEL_COST)
+    print(f"🧮 Model selection over {len(results)} datasets in {elapsed:.2f}s (held-out RMSE in mV)\n")
+    print(f"{'dataset':<40}{'n':>4}  " + "".join(f"{n:>11}" for n in names) + "   chosen")
+    chosen = {}
+    for name, board, result in results:
+        cells = "".join(f"{result['scores'][n]['cv_rmse'] * 1000:>11.1f}" if n in result['scores'] else f"{'-':>11}"
+                        for n in names)
+        print(f"{name:<40}{result['n']:>4}  {cells}   {result['model'] or '-'}")
+        chosen[result['model']] = chosen.get(result['model'], 0) + 1
+    print("\n📌 Chosen: " + ", ".join(f"{k}: {v}" for k, v in chosen.items()))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as file:
+        json.dump([{'name': n, 'board': b, **r} for n, b, r in results], file, indent=2)
+    print(f"💾 Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
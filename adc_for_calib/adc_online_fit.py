@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu May 22 09:37:15 2025
+
+@author: nichm
+
+Online calibration fit, updated after every point of a sweep.
+
+Recursive least squares on the cubic (in measured VIN mapped onto [-1, 1]
+over the operating range, for conditioning) gives the coefficients, their 95%
+confidence intervals and the a-priori error of each new point (its residual before it joins the fit, i.e.
+a held-out error for free). The fit counts as converged once the last few
+new points were all predicted within the target and the 95% confidence band
+of the curve is within the target over the whole operating range; sweeps
+can then stop early instead of running through every planned voltage.
+
+With a prior (mean and covariance of the coefficients, e.g. from the fleet),
+the same recursion is the Bayesian update and converges in a few points. The
+prior alone makes the curve band look tight, so with a prior it is the
+predictive band (curve plus reading noise) that has to be within the target.
+"""
+
+import numpy as np
+
+OPERATING_RANGE = (4.0, 15.0)  # V; the fit variable is measured VIN mapped onto [-1, 1] over this range
+TARGET_ERROR = 0.020           # V
+DIFFUSE_VARIANCE = 1e12        # Initial (scaled) coefficient variance without a prior
+# Two-sided 95% Student t quantiles by degrees of freedom
+T_95 = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262,
+        10: 2.228, 12: 2.179, 15: 2.131, 20: 2.086, 30: 2.042}
+
+
+def t_quantile(dof):
+    if dof is None:
+        return 1.96
+    keys = [k for k in T_95 if k <= dof]
+    return T_95[max(keys)] if dof <= 30 and keys else 1.96
+
+
+def to_unit(x, operating_range=OPERATING_RANGE):
+    low, high = operating_range
+    return (np.asarray(x, dtype=np.float64) - (low + high) / 2) / ((high - low) / 2)
+
+
+def basis(x, degree=3, operating_range=OPERATING_RANGE):
+    """Rows of u^degree ... 1 for scalar or array x, with u = x mapped onto [-1, 1] over the operating range."""
+    return to_unit(x, operating_range)[..., None] ** np.arange(degree, -1, -1)
+
+
+def compose(coeffs, inner):
+    """Coefficients of coeffs(inner(t)) for a linear inner polynomial, same length as coeffs."""
+    composed = np.poly1d(np.asarray(coeffs, dtype=np.float64))(np.poly1d(inner)).coeffs
+    return np.concatenate([np.zeros(len(coeffs) - len(composed)), composed])
+
+
+def unscale(theta, operating_range=OPERATING_RANGE):
+    """Basis coefficients (in u) -> np.polyval coefficients in volts."""
+    low, high = operating_range
+    return compose(theta, [2 / (high - low), -(low + high) / (high - low)])
+
+
+def scale(coeffs, operating_range=OPERATING_RANGE):
+    """np.polyval coefficients in volts -> basis coefficients (in u)."""
+    low, high = operating_range
+    return compose(coeffs, [(high - low) / 2, (low + high) / 2])
+
+
+class OnlineFit:
+    """Recursive least-squares polynomial fit with confidence intervals and a convergence test."""
+
+    def __init__(self, degree=3, target=TARGET_ERROR, prior_mean=None, prior_cov=None, noise=None,
+                 operating_range=OPERATING_RANGE, window=3):
+        """prior_mean/prior_cov are in the scaled basis (see scale()); noise is the known reading noise (V)."""
+        self.degree = degree
+        self.params = degree + 1
+        self.target = target
+        self.noise = noise
+        self.has_prior = prior_mean is not None
+        self.operating_range = operating_range
+        self.window = window
+        self.theta = np.zeros(self.params) if prior_mean is None else np.array(prior_mean, dtype=np.float64)
+        if prior_cov is not None:
+            # P is the coefficient covariance in units of the noise variance
+            self.P = np.array(prior_cov, dtype=np.float64) / (noise ** 2 if noise else 1.0)
+        else:
+            self.P = np.eye(self.params) * DIFFUSE_VARIANCE
+        self.n = 0
+        self.sse = 0.0
+        self.innovations = []
+        self.announced = False
+
+    def update(self, x, y):
+        """Add one point; returns its a-priori error (actual minus the prediction before the update)."""
+        h = basis(x, self.degree, self.operating_range)
+        innovation = float(y - h @ self.theta)
+        Ph = self.P @ h
+        denominator = 1.0 + h @ Ph
+        gain = Ph / denominator
+        self.theta = self.theta + gain * innovation
+        self.P = self.P - np.outer(gain, Ph)
+        self.P = (self.P + self.P.T) / 2
+        self.sse += innovation ** 2 / denominator
+        self.n += 1
+        self.innovations.append(innovation)
+        return innovation
+
+    @property
+    def coeffs(self):
+        return unscale(self.theta, self.operating_range)
+
+    @property
+    def dof(self):
+        return None if self.noise else self.n - self.params
+
+    def sigma(self):
+        """Reading noise: the prior's when known, else estimated from the residuals (None until n > params)."""
+        if self.noise:
+            return self.noise
+        return np.sqrt(self.sse / self.dof) if self.dof > 0 else None
+
+    def coeff_intervals(self):
+        """95% half-widths of the coefficients (np.polyval order, volts), or None while undetermined."""
+        sigma = self.sigma()
+        if sigma is None:
+            return None
+        return self.coeff_sd() * t_quantile(self.dof) * sigma
+
+    def coeff_sd(self):
+        """Standard deviations of the np.polyval coefficients per unit noise (P mapped through unscale())."""
+        jacobian = np.column_stack([unscale(np.eye(self.params)[i], self.operating_range) for i in range(self.params)])
+        return np.sqrt(np.diag(jacobian @ self.P @ jacobian.T))
+
+    def predict(self, x):
+        return basis(x, self.degree, self.operating_range) @ self.theta
+
+    def band(self, x):
+        """95% half-width of the fitted curve at x (confidence of the mean), or None while undetermined."""
+        sigma = self.sigma()
+        if sigma is None:
+            return None
+        h = basis(x, self.degree, self.operating_range)
+        return t_quantile(self.dof) * sigma * np.sqrt(np.einsum('...i,ij,...j->...', h, self.P, h))
+
+    def predictive_band(self, x):
+        """95% half-width for a new reading at x (curve uncertainty plus reading noise), or None."""
+        sigma = self.sigma()
+        if sigma is None:
+            return None
+        h = basis(x, self.degree, self.operating_range)
+        return t_quantile(self.dof) * sigma * np.sqrt(1.0 + np.einsum('...i,ij,...j->...', h, self.P, h))
+
+    def max_band(self, points=64):
+        grid = np.linspace(*self.operating_range, points)
+        band = self.band(grid)
+        return None if band is None else float(np.max(band))
+
+    def max_predictive_band(self, points=64):
+        grid = np.linspace(*self.operating_range, points)
+        band = self.predictive_band(grid)
+        return None if band is None else float(np.max(band))
+
+    def recent_errors(self):
+        """A-priori errors of the last window points that were predicted by a determined fit."""
+        first = 0 if self.has_prior else self.params
+        return np.abs(self.innovations[first:][-self.window:])
+
+    def converged(self):
+        recent = self.recent_errors()
+        band = self.max_predictive_band() if self.has_prior else self.max_band()
+        return len(recent) >= self.window and bool(np.all(recent <= self.target)) \
+            and band is not None and band <= self.target
+
+    def status(self):
+        """One line for the operator after each point."""
+        line = f"📈 n={self.n}"
+        if self.n > (0 if self.has_prior else self.params):
+            line += f", new point off by {self.innovations[-1] * 1000:+.1f} mV"
+        sigma = self.sigma()
+        if sigma is not None:
+            intervals = self.coeff_intervals()
+            coeffs = ", ".join(f"{c:.6f}±{i:.6f}" for c, i in zip(self.coeffs, intervals))
+            line += f", noise {sigma * 1000:.1f} mV, band ±{self.max_band() * 1000:.1f} mV, coeffs [{coeffs}]"
+        else:
+            line += f" (need {self.params + 1 - self.n} more point(s) for error bounds)"
+        return line
+
+    def report(self):
+        """Print status() and, once, the convergence notice. Returns True when converged."""
+        print(self.status())
+        converged = self.converged()
+        if converged and not self.announced:
+            print(f"✅ Fit converged: the last {self.window} points were predicted within ±{self.target * 1000:.0f} mV "
+                  f"and the curve is known to ±{self.max_band() * 1000:.1f} mV over "
+                  f"{self.operating_range[0]:g}-{self.operating_range[1]:g} V after {self.n} points.")
+        self.announced = self.announced or converged
+        return converged
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu May  8 14:12:40 2025
+
+@author: nichm
+
+Piecewise calibration with the fewest segments under an error bound.
+
+Replaces the fixed 8 V split of piecewise_fit() and the 30th/70th percentile
+splits of piecewise_advanced_fit(). The points are sorted by measured VIN,
+every contiguous run of points is fitted with a low-degree polynomial (all
+runs solved together, see adc_fleet_refit.batch_polyfit), and a dynamic
+program over the sorted points finds, for each segment count, the breakpoints
+that minimise the worst segment's max |error|. The smallest segment count whose
+max error is under the target wins, and the matching calibrateVIN() if/else
+chain is emitted. The bound holds on the calibration points; the
+cross-validation in adc_model_selection.py says how well it generalises.
+
+    python adc_piecewise_search.py ../adc_read_2/tests/sarq-0002.csv --target 0.02 --emit
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from adc_fleet_refit import batch_polyfit
+from adc_fleet_report import DEFAULT_GLOBS, load_csvs
+from adc_model_selection import clean_points, polyval_rows
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TARGET_ERROR = 0.020      # V
+MAX_SEGMENTS = 6
+BATCH_ROWS = 4096         # Segments fitted per batched solve (bounds memory for long sweeps)
+
+
+def segment_errors(x, y, degree=2, min_points=None):
+    """Max |residual| of a least-squares fit over every run x[i..j] (inf where the run is too short).
+
+    Runs may only start where x increases, so repeated readings of one setpoint stay together.
+    """
+    n = len(x)
+    min_points = degree + 2 if min_points is None else min_points
+    errors = np.full((n, n), np.inf)
+    coeffs = np.full((n, n, degree + 1), np.nan)
+    starts = np.flatnonzero(np.r_[True, np.diff(x) > 0])
+    ends = np.r_[starts[1:] - 1, n - 1]
+    pairs = np.array([(i, j) for i in starts for j in ends if j - i + 1 >= min_points], dtype=int).reshape(-1, 2)
+    index = np.arange(n)
+    for chunk in range(0, len(pairs), BATCH_ROWS):
+        i, j = pairs[chunk:chunk + BATCH_ROWS].T
+        mask = (index >= i[:, None]) & (index <= j[:, None])
+        bx = np.broadcast_to(x, mask.shape).copy()
+        by = np.broadcast_to(y, mask.shape).copy()
+        fitted, ok = batch_polyfit(bx, by, mask, degree)
+        residual = np.where(mask, np.abs(polyval_rows(np.nan_to_num(fitted), bx) - by), 0.0)
+        worst = np.where(ok, residual.max(axis=1), np.inf)
+        errors[i, j] = worst
+        coeffs[i, j] = fitted
+    return errors, coeffs
+
+
+def optimal_segments(errors, max_segments=MAX_SEGMENTS):
+    """best[k][j]: smallest worst-segment error covering points 0..j with k + 1 segments, plus back-pointers."""
+    n = len(errors)
+    best = np.full((max_segments, n), np.inf)
+    previous = np.full((max_segments, n), -1, dtype=int)
+    best[0] = errors[0]
+    for k in range(1, max_segments):
+        # Last segment i..j after k segments ending at i - 1
+        candidates = np.maximum(best[k - 1][:-1, None], errors[1:, :])   # (i - 1) x j, inf where i > j
+        start = np.argmin(candidates, axis=0)
+        best[k, 1:] = candidates[start, np.arange(n)][1:]
+        previous[k, 1:] = start[1:] + 1
+    return best, previous
+
+
+def search(x, y, target=TARGET_ERROR, degree=2, max_segments=MAX_SEGMENTS, min_points=None):
+    """Fewest segments with max error <= target (or the best max_segments can do). Returns a model dict."""
+    order = np.argsort(x, kind='stable')
+    x, y = np.asarray(x, float)[order], np.asarray(y, float)[order]
+    errors, coeffs = segment_errors(x, y, degree, min_points)
+    best, previous = optimal_segments(errors, max_segments)
+    final = best[:, -1]
+    if not np.isfinite(final).any():
+        return None
+    feasible = np.flatnonzero(final <= target)
+    k = int(feasible[0]) if len(feasible) else int(np.argmin(final))
+
+    bounds, j = [], len(x) - 1
+    for level in range(k, -1, -1):
+        i = previous[level, j] if level else 0
+        bounds.append((i, j))
+        j = i - 1
+    bounds.reverse()
+    segments = []
+    for n, (i, j) in enumerate(bounds):
+        # Split halfway between the last point of one segment and the first of the next
+        upper = (x[j] + x[j + 1]) / 2 if n < len(bounds) - 1 else None
+        segments.append({'upper': None if upper is None else float(upper), 'coeffs': [float(c) for c in coeffs[i, j]],
+                         'points': int(j - i + 1), 'max_error': float(errors[i, j])})
+    return {'degree': degree, 'target': target, 'met': bool(final[k] <= target), 'max_error': float(final[k]),
+            'segments': segments, 'ops': segment_ops(degree, len(segments))}
+
+
+def segment_ops(degree, segments):
+    """Worst-case float operations on the ESP32: compares down the chain plus one polynomial."""
+    multiplies = {0: 0, 1: 1, 2: 3, 3: 6}.get(degree, degree * (degree + 1) // 2)
+    return (segments - 1) + multiplies + degree
+
+
+def predict(model, x):
+    x = np.asarray(x, float)
+    result = np.polyval(model['segments'][-1]['coeffs'], x)
+    for segment in reversed(model['segments'][:-1]):
+        result = np.where(x < segment['upper'], np.polyval(segment['coeffs'], x), result)
+    return result
+
+
+def polynomial_source(coeffs):
+    degree = len(coeffs) - 1
+    terms = []
+    for power, c in zip(range(degree, -1, -1), coeffs):
+        terms.append(f"({c:.6f}{' * vin' * power})" if power else f"{c:.6f}")
+    return " + ".join(terms)
+
+
+def generate_piecewise_formula(model):
+    """calibrateVIN() as an if/else chain over the segments."""
+    lines = ["", "    float calibrateVIN(float vin) {"]
+    for n, segment in enumerate(model['segments']):
+        body = f"return {polynomial_source(segment['coeffs'])};"
+        if segment['upper'] is None:
+            if n:
+                lines.append("        }")
+            lines.append(f"        {body}")
+        else:
+            keyword = "if" if n == 0 else "} else if"
+            lines.append(f"        {keyword} (vin < {segment['upper']:.4f}) {{")
+            lines.append(f"            {body}")
+    lines.append("    }")
+    return "\n".join(lines) + "\n    "
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fewest-segment piecewise calibration under a max-error target.")
+    parser.add_argument("paths", nargs="*", help="CSV files or glob patterns (default: tests/ folders)")
+    parser.add_argument("--target", type=float, default=TARGET_ERROR, help="max |error| in V (default 0.020)")
+    parser.add_argument("--degree", type=int, default=2, help="polynomial degree per segment")
+    parser.add_argument("--max-segments", type=int, default=MAX_SEGMENTS)
+    parser.add_argument("--min-points", type=int, default=None, help="points per segment (default degree + 2)")
+    parser.add_argument("--emit", action="store_true", help="print the calibrateVIN() source for each dataset")
+    parser.add_argument("--output", default=os.path.join(SCRIPT_DIR, "reports", "piecewise_search.json"))
+    args = parser.parse_args()
+
+    datasets = load_csvs(args.paths or DEFAULT_GLOBS)
+    if not datasets:
+        print("No datasets found.")
+        return 1
+    results = []
+    for dataset in datasets:
+        x, _, y = clean_points(dataset['values'])
+        model = search(x, y, args.target, args.degree, args.max_segments, args.min_points)
+        results.append({'name': dataset['name'], 'board': dataset['board'], 'model': model})
+        if model is None:
+            print(f"❌ {dataset['name']}: not enough points for degree {args.degree} segments")
+            continue
+        status = "✅" if model['met'] else "⚠️"
+        splits = ", ".join(f"{s['upper']:.2f}" for s in model['segments'][:-1]) or "none"
+        print(f"{status} {dataset['name']:<40} {len(model['segments'])} segment(s), max error "
+              f"{model['max_error'] * 1000:.1f} mV, splits at {splits} V, {model['ops']} ops")
+        if args.emit:
+            print(generate_piecewise_formula(model))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"💾 Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
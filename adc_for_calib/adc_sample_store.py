@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Apr 29 13:26:09 2025
+
+@author: nichm
+
+Sample store for calibration and evaluation data.
+
+All samples of all boards go into one append-only column file per field
+(columns/<field>.bin, a typed NumPy array each, memory-mapped for reading),
+so a query reads only the columns it asks for. index.json lists every
+session: board, kind (calib/eval), firmware coefficient version, fitted
+coefficients and the row ranges holding its samples, so a fleet query is a
+scan of memmaps instead of parsing hundreds of small CSVs.
+
+Several processes may write to one store (e.g. the rig and a single-board
+session): every write takes store.lock, re-reads the index and appends at
+the end of every column. The session column is authoritative: rows not yet
+in the index (it is only rewritten every INDEX_EVERY rows, on session
+updates and on close()) are taken in by the next writer or reader that opens
+the store, and rows only partly written by a crash (shorter columns, a
+partial value) are cut off. A store written by the earlier row-major layout
+(samples.bin) is split into columns when it is opened.
+
+Import the existing CSVs and list what is stored:
+    python adc_sample_store.py import tests/*.csv ../adc_read_2/tests/*.csv
+    python adc_sample_store.py summary
+"""
+
+import csv
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from adc_checkpoint import write_json_atomic
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+STORE_DIR = os.path.join(SCRIPT_DIR, "sample_store")
+INDEX_EVERY = 64      # Appended rows between index.json rewrites
+
+KINDS = {'calib': 0, 'eval': 1}
+SAMPLE_DTYPE = np.dtype([
+    ('raw_adc', '<f4'),          # NaN when not logged (calibration rows)
+    ('cal_voltage', '<f4'),      # esp_adc_cal voltage in V
+    ('calculated_vin', '<f8'),
+    ('calibrated_vin', '<f8'),
+    ('actual_input', '<f8'),
+    ('timestamp', '<f8'),        # Unix time of the sample (file time for imported rows)
+    ('board', '<u4'),
+    ('session', '<u4'),
+    ('firmware_version', '<i4'),  # Coefficient version on the board, -1 if unknown
+    ('kind', '<u1'),
+])
+SAMPLE_FIELDS = ('raw_adc', 'cal_voltage', 'calculated_vin', 'calibrated_vin', 'actual_input')
+
+CALIB_HEADER = ["Measured VIN", "Actual VIN"]
+EVAL_HEADER = ["Raw ADC", "ESP ADC Cal Raw Voltage", "Calculated VIN", "Calibrated VIN", "Actual Input", "Difference"]
+COEFFS_LABEL = "Cubic Fit Coefficients:"
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on path, shared by every process using the store (blocks until free)."""
+    with open(path, 'a+b') as file:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        else:
+            file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # LK_LOCK gives up after 10 s
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def add_range(entry, start, stop):
+    """Extend the session's row ranges (and count) by rows start:stop."""
+    ranges = entry['ranges']
+    if ranges and ranges[-1][1] == start:
+        ranges[-1][1] = stop
+    else:
+        ranges.append([start, stop])
+    entry['count'] += stop - start
+
+
+class SampleStore:
+    """Append-only sample records plus a JSON index of sessions."""
+
+    def __init__(self, root=STORE_DIR):
+        self.root = root
+        self.column_dir = os.path.join(root, "columns")
+        self.index_path = os.path.join(root, "index.json")
+        self.lock_path = os.path.join(root, "store.lock")
+        self.lock = threading.Lock()
+        self.unindexed = 0
+        self.column_files = {}  # Append handles, opened on the first append and kept until close()
+        os.makedirs(self.column_dir, exist_ok=True)
+        self.index = {'rows': 0, 'next_session': 1, 'sessions': {}}
+        with self._locked():
+            self._split_row_file()
+            self._load()
+
+    @property
+    def rows(self):
+        return self.index['rows']
+
+    @contextmanager
+    def _locked(self):
+        with self.lock, file_lock(self.lock_path):
+            yield
+
+    def column_path(self, field):
+        return os.path.join(self.column_dir, f"{field}.bin")
+
+    def _data_rows(self):
+        """Rows present in every column (a crash mid-append can leave some columns longer)."""
+        paths = [self.column_path(f) for f in SAMPLE_DTYPE.names]
+        return min(os.path.getsize(p) // SAMPLE_DTYPE[f].itemsize if os.path.exists(p) else 0
+                   for p, f in zip(paths, SAMPLE_DTYPE.names))
+
+    def _split_row_file(self):
+        """Move the records of a row-major samples.bin into the column files (lock held)."""
+        row_path = os.path.join(self.root, "samples.bin")
+        if not os.path.exists(row_path) or self._data_rows():
+            return
+        rows = os.path.getsize(row_path) // SAMPLE_DTYPE.itemsize
+        data = np.memmap(row_path, dtype=SAMPLE_DTYPE, mode='r', shape=(rows,)) if rows else None
+        for field in SAMPLE_DTYPE.names:
+            with open(self.column_path(field), 'wb') as file:
+                if rows:
+                    file.write(np.ascontiguousarray(data[field]).tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+        del data
+        os.remove(row_path)
+        print(f"🗄️ Split {rows} rows of {row_path} into {self.column_dir}")
+
+    def _load(self):
+        """Re-read the index and take in the records appended since it was written (lock held)."""
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as file:
+                self.index = json.load(file)
+        indexed, total = self.index['rows'], self._data_rows()
+        if total > indexed:
+            tail = np.array(self.column('session', total)[indexed:])
+            starts = np.concatenate([[0], np.flatnonzero(np.diff(tail)) + 1])
+            stops = np.append(starts[1:], len(tail))
+            for start, stop in zip(starts, stops):
+                entry = self.index['sessions'].get(str(int(tail[start])))
+                if entry is not None:
+                    add_range(entry, indexed + int(start), indexed + int(stop))
+            self.index['rows'] = total
+        self.unindexed = 0
+
+    def _save_index(self):
+        write_json_atomic(self.index_path, self.index)
+        self.unindexed = 0
+
+    def _index_appended(self):
+        """Re-read the index (other writers may have changed it) and write it with every appended row (lock held)."""
+        self._load()
+        self._save_index()
+
+    def refresh(self):
+        """Pick up sessions and samples written by other processes since the store was opened."""
+        with self._locked():
+            self._load()
+
+    def close(self):
+        """Write the rows appended since the last index update into index.json and close the column files."""
+        with self._locked():
+            if self.unindexed:
+                self._index_appended()
+            for file in self.column_files.values():
+                file.close()
+            self.column_files = {}
+
+    def new_session(self, board, kind, firmware_version=None, coeffs=None, source=None, started=None):
+        """Register a session and return its id."""
+        with self._locked():
+            self._load()
+            session_id = self.index['next_session']
+            self.index['next_session'] += 1
+            self.index['sessions'][str(session_id)] = {
+                'board': int(board),
+                'kind': kind,
+                'firmware_version': firmware_version,
+                'coeffs': None if coeffs is None else [float(c) for c in coeffs],
+                'source': source,
+                'started': started or time.time(),
+                'ranges': [],
+                'count': 0,
+            }
+            self._save_index()
+        return session_id
+
+    def session(self, session_id):
+        return self.index['sessions'][str(session_id)]
+
+    def update_session(self, session_id, **fields):
+        """Record e.g. coeffs=... and firmware_version=... once they are known."""
+        if 'coeffs' in fields and fields['coeffs'] is not None:
+            fields['coeffs'] = [float(c) for c in fields['coeffs']]
+        self.update_sessions({session_id: fields})
+
+    def update_sessions(self, updates):
+        """Apply {session id: fields} for many sessions with a single index write."""
+        with self._locked():
+            self._load()
+            for session_id, fields in updates.items():
+                self.session(session_id).update(fields)
+            self._save_index()
+
+    def append(self, session_id, rows, timestamps=None):
+        """Append rows of (raw ADC, cal voltage, calculated VIN, calibrated VIN, actual input); None -> NaN."""
+        rows = [[np.nan if v is None else v for v in row] for row in rows]
+        if not rows:
+            return 0
+        records = np.zeros(len(rows), dtype=SAMPLE_DTYPE)
+        values = np.asarray(rows, dtype=np.float64).reshape(len(rows), len(SAMPLE_FIELDS))
+        for i, field in enumerate(SAMPLE_FIELDS):
+            records[field] = values[:, i]
+        records['timestamp'] = time.time() if timestamps is None else timestamps
+        records['session'] = int(session_id)
+
+        with self._locked():
+            # Every append (even one cut short by a crash) starts with the first column, so its size is
+            # enough to tell whether another writer appended since we last looked
+            first = SAMPLE_DTYPE.names[0]
+            size = os.path.getsize(self.column_path(first)) if os.path.exists(self.column_path(first)) else 0
+            if str(session_id) not in self.index['sessions'] or size != self.index['rows'] * SAMPLE_DTYPE[first].itemsize:
+                self._load()
+            entry = self.session(session_id)
+            records['board'] = entry['board']
+            version = entry['firmware_version']
+            records['firmware_version'] = -1 if version is None else version
+            records['kind'] = KINDS[entry['kind']]
+
+            start = self.index['rows']
+            if not self.column_files:
+                self.column_files = {f: open(self.column_path(f), 'ab') for f in SAMPLE_DTYPE.names}
+            for field, file in self.column_files.items():
+                # Cut off whatever a crash mid-append left past the last complete row
+                file.truncate(start * SAMPLE_DTYPE[field].itemsize)
+                file.write(np.ascontiguousarray(records[field]).tobytes())
+                file.flush()
+                if self.unindexed + len(records) >= INDEX_EVERY:
+                    os.fsync(file.fileno())
+            add_range(entry, start, start + len(records))
+            self.index['rows'] = start + len(records)
+            self.unindexed += len(records)
+            if self.unindexed >= INDEX_EVERY:
+                self._index_appended()
+        return len(records)
+
+    def column(self, field, rows=None):
+        """One field of every stored sample as a read-only memory map (empty array when the store is empty)."""
+        rows = self.rows if rows is None else rows
+        if rows == 0:
+            return np.zeros(0, dtype=SAMPLE_DTYPE[field])
+        return np.memmap(self.column_path(field), dtype=SAMPLE_DTYPE[field], mode='r', shape=(rows,))
+
+    def sessions(self, board=None, kind=None):
+        """(session id, entry) pairs matching the filters, oldest first."""
+        return [(int(sid), entry) for sid, entry in self.index['sessions'].items()
+                if (board is None or entry['board'] == int(board)) and (kind is None or entry['kind'] == kind)]
+
+    def boards(self):
+        return sorted({entry['board'] for entry in self.index['sessions'].values()})
+
+    def query(self, board=None, kind=None, session=None, fields=None):
+        """Samples of the matching sessions, gathered through the index row ranges.
+
+        Only the columns in fields (default: all) are read; the result is a record array of those fields.
+        """
+        fields = list(SAMPLE_DTYPE.names if fields is None else fields)
+        if session is not None:
+            selected = [(int(session), self.session(session))]
+        else:
+            selected = self.sessions(board, kind)
+        ranges = [r for _, entry in selected for r in entry['ranges']]
+        result = np.zeros(sum(stop - start for start, stop in ranges), dtype=[(f, SAMPLE_DTYPE[f]) for f in fields])
+        for field in fields:
+            column = self.column(field)
+            if ranges:
+                result[field] = np.concatenate([column[start:stop] for start, stop in ranges])
+        return result
+
+    def latest_session(self, board, kind):
+        found = self.sessions(board, kind)
+        return found[-1] if found else None
+
+
+def board_from_filename(path):
+    match = re.search(r"-(\d+)\.csv$", os.path.basename(path))
+    return int(match.group(1)) if match else None
+
+
+def read_csv_session(path):
+    """Parse a calib/eval CSV into (kind, rows, coeffs). The trailing coefficients row is split off."""
+    rows, coeffs = [], None
+    with open(path, newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader, None)
+        if header == CALIB_HEADER:
+            kind = 'calib'
+        elif header == EVAL_HEADER:
+            kind = 'eval'
+        else:
+            raise ValueError(f"Unknown CSV header {header}")
+        for row in reader:
+            if not row:
+                continue
+            if row[0] == COEFFS_LABEL:
+                coeffs = [float(v) for v in row[1:5]]
+                continue
+            try:
+                values = [float(v) for v in row]
+            except ValueError:
+                continue
+            if kind == 'calib':
+                rows.append([None, None, values[0], None, values[1]])
+            else:
+                rows.append(values[:5])
+    return kind, rows, coeffs
+
+
+def import_csv(store, path):
+    """Import one legacy CSV as a session. Returns the session id, or None if it was already imported."""
+    source = os.path.abspath(path)
+    if any(entry['source'] == source for _, entry in store.sessions()):
+        return None
+    board = board_from_filename(path)
+    if board is None:
+        raise ValueError(f"No board number in file name {path}")
+    kind, rows, coeffs = read_csv_session(path)
+    started = os.path.getmtime(path)
+    session_id = store.new_session(board, kind, coeffs=coeffs, source=source, started=started)
+    store.append(session_id, rows, timestamps=started)
+    return session_id
+
+
+def print_summary(store):
+    print(f"🗄️ {store.rows} samples, {len(store.index['sessions'])} sessions, {len(store.boards())} boards in {store.root}")
+    for board in store.boards():
+        for session_id, entry in store.sessions(board):
+            rows = store.query(session=session_id, fields=('calculated_vin', 'calibrated_vin', 'actual_input'))
+            error = rows['actual_input'] - (rows['calibrated_vin'] if entry['kind'] == 'eval' else rows['calculated_vin'])
+            coeffs = "fitted" if entry['coeffs'] else "-"
+            print(f"   board {board:04d} session {session_id:<4} {entry['kind']:<5} {entry['count']:>5} rows  "
+                  f"mean |err| {np.nanmean(np.abs(error)):.3f}V  coeffs {coeffs}")
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ("import", "summary"):
+        print("Usage: python adc_sample_store.py import <csv files...> | summary")
+        return
+    store = SampleStore()
+    if sys.argv[1] == "import":
+        for path in sys.argv[2:]:
+            try:
+                session_id = import_csv(store, path)
+            except (ValueError, OSError) as e:
+                print(f"⚠️ Skipping {path}: {e}")
+                continue
+            if session_id is None:
+                print(f"   {path}: already imported")
+            else:
+                print(f"✅ {path} -> session {session_id} ({store.session(session_id)['count']} rows)")
+        store.close()
+    print_summary(store)
+
+
+if __name__ == "__main__":
+    main()
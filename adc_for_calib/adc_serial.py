@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Jun  5 09:12:40 2025
+
+@author: nichm
+
+Serial helpers shared by the calibration scripts.
+
+wait_until_ready() probes a freshly opened port until the firmware answers
+with a reading, instead of sleeping a fixed time after every connect. Each
+script passes its own parse_serial_data(), so the probe accepts exactly the
+replies that script can read.
+"""
+
+import time
+
+
+def wait_until_ready(ser, parse, probe=b'a', timeout=15.0, probe_interval=1.5):
+    """Probe the board until parse() accepts a reply. Returns the connect-to-ready latency or None."""
+    start = time.monotonic()
+    read_timeout = ser.timeout
+    ser.timeout = 0.1
+    try:
+        while time.monotonic() - start < timeout:
+            ser.reset_input_buffer()
+            ser.write(probe)
+            probe_deadline = time.monotonic() + probe_interval
+            while time.monotonic() < probe_deadline:
+                line = ser.readline().decode('utf-8', errors='replace').strip()
+                if line and parse(line) is not None:
+                    ser.reset_input_buffer()
+                    return time.monotonic() - start
+        return None
+    finally:
+        ser.timeout = read_timeout
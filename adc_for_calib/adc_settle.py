@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Apr 18 11:02:36 2025
+
+@author: nichm
+
+Automatic capture of calibration points from a live stream.
+
+The latest window of streamed VIN samples is checked after every few new
+samples. A point is recorded as soon as the window has settled (rolling
+standard deviation and drift below threshold), then nothing is captured
+until the level steps away to the next supply voltage. When the next
+voltage is within the step threshold of the last one no step can be seen,
+so the next plateau is instead a full window of samples taken after the
+operator was asked for it. If no point is captured within point_timeout
+seconds of asking, the capture stops rather than waiting forever.
+"""
+
+import time
+
+import numpy as np
+
+from adc_stream import window_stats
+
+
+def settle_metrics(values):
+    """Standard deviation and first-half/second-half drift of a window."""
+    half = len(values) // 2
+    std = float(np.std(values, ddof=1)) if len(values) > 1 else 0.0
+    drift = abs(float(np.mean(values[half:])) - float(np.mean(values[:half]))) if half else 0.0
+    return std, drift
+
+
+class SettleDetector:
+    """Rolling-variance plateau and step detector for a VIN stream (all thresholds in volts)."""
+
+    def __init__(self, window=128, std_threshold=0.02, drift_threshold=0.01, step_threshold=0.1, step_samples=16):
+        self.window = window
+        self.std_threshold = std_threshold
+        self.drift_threshold = drift_threshold
+        self.step_threshold = step_threshold
+        self.step_samples = step_samples
+        self.settled = False
+        self.level = None
+
+    def rearm(self):
+        """Forget the current plateau: the next settled window counts as a new one, without a step."""
+        self.settled = False
+        self.level = None
+
+    def update(self, values):
+        """Feed the newest window of values. Returns 'settled' once per plateau, 'step' when the level moves away, else None."""
+        if len(values) == 0:
+            return None
+        if self.settled:
+            recent = float(np.mean(values[-self.step_samples:]))
+            if abs(recent - self.level) > self.step_threshold:
+                self.settled = False
+                return 'step'
+            return None
+
+        if len(values) < self.window:
+            return None
+        std, drift = settle_metrics(values[-self.window:])
+        if std < self.std_threshold and drift < self.drift_threshold:
+            self.settled = True
+            self.level = float(np.mean(values[-self.window:]))
+            return 'settled'
+        return None
+
+
+def auto_capture(reader, next_actual, on_point, detector=None, hop=16, point_timeout=120.0):
+    """Record a point every time the stream settles on a new level.
+
+    next_actual() returns the actual input voltage for the upcoming point, or
+    None when the sweep is done. on_point(stats, actual) logs each capture.
+    Stops when no point is captured within point_timeout seconds of asking for it.
+    Returns the number of points captured.
+    """
+    detector = detector or SettleDetector()
+    captured = 0
+    actual = next_actual()
+    mark = reader.ring.total
+    asked, asked_at = mark, time.monotonic()
+    try:
+        while actual is not None:
+            if reader.wait_for(hop, mark=mark) is None:
+                print("❌ Stream stalled. Stopping automatic capture.")
+                break
+            mark = reader.ring.total
+            if time.monotonic() - asked_at > point_timeout:
+                print(f"❌ No new plateau within {point_timeout:g}s of asking for {actual}V. Stopping automatic capture.")
+                break
+            if mark - asked < detector.window and detector.level is None:
+                continue  # Only samples taken after the request may make up a plateau without a step
+            window = reader.ring.latest(detector.window)
+            event = detector.update(window['vin'])
+
+            if event == 'settled':
+                stats = window_stats(window)
+                on_point(stats, actual)
+                captured += 1
+                previous, actual = actual, next_actual()
+                asked, asked_at = mark, time.monotonic()
+                if actual is not None and abs(actual - previous) <= detector.step_threshold:
+                    # Too close to the last level for a step to show
+                    detector.rearm()
+            elif event == 'step':
+                print("↕️ Step detected, waiting for the reading to settle...")
+    except KeyboardInterrupt:
+        print("Automatic capture stopped.")
+    return captured
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Apr 17 09:40:12 2025
+
+@author: nichm
+
+Continuous streaming acquisition for adc_for_calib.ino.
+
+The board is put in streaming mode ('s<rate>') and sends binary frames
+continuously. A background thread decodes them into a preallocated NumPy
+ring buffer, and each capture point is the mean/median/stddev over a window
+of fresh samples instead of one noisy reading.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+from adc_frame_protocol import RECORD_DTYPE, FrameDecoder
+
+STAT_FIELDS = ('raw_adc', 'adc_cal_mv', 'vin', 'calibrated_vin')
+
+
+class SampleRingBuffer:
+    """Fixed-size ring buffer of sample records; the oldest samples are overwritten."""
+
+    def __init__(self, capacity=8192):
+        self.data = np.zeros(capacity, dtype=RECORD_DTYPE)
+        self.capacity = capacity
+        self.total = 0  # Samples written since creation
+        self.lock = threading.Lock()
+
+    def extend(self, records):
+        """Append a structured array of records."""
+        n = len(records)
+        if n == 0:
+            return
+        if n > self.capacity:
+            records = records[-self.capacity:]
+        with self.lock:
+            start = (self.total + n - len(records)) % self.capacity
+            first = min(len(records), self.capacity - start)
+            self.data[start:start + first] = records[:first]
+            self.data[:len(records) - first] = records[first:]
+            self.total += n
+
+    def latest(self, n):
+        """Copy of the newest n records, oldest first."""
+        with self.lock:
+            n = min(n, self.total, self.capacity)
+            end = self.total % self.capacity
+            idx = np.arange(end - n, end) % self.capacity
+            return self.data[idx]
+
+    def since(self, mark, limit=None):
+        """Records written after the given total count (oldest first)."""
+        n = self.total - mark
+        if limit is not None:
+            n = min(n, limit)
+        return self.latest(n)
+
+
+def window_stats(records, fields=STAT_FIELDS):
+    """Mean, median and standard deviation of each field over a window of records."""
+    stats = {'n': len(records)}
+    for field in fields:
+        values = records[field].astype(np.float64)
+        stats[field] = {
+            'mean': float(np.mean(values)) if len(values) else float('nan'),
+            'median': float(np.median(values)) if len(values) else float('nan'),
+            'std': float(np.std(values, ddof=1)) if len(values) > 1 else 0.0,
+        }
+    return stats
+
+
+class StreamReader:
+    """Background reader that keeps a ring buffer filled from a streaming board."""
+
+    def __init__(self, ser, rate_hz=200, capacity=8192):
+        self.ser = ser
+        self.rate_hz = rate_hz
+        self.ring = SampleRingBuffer(capacity)
+        self.decoder = FrameDecoder()
+        self.thread = None
+        self.running = False
+        self.new_data = threading.Condition()
+
+    def start(self):
+        """Put the board in streaming mode and start the reader thread."""
+        self.ser.reset_input_buffer()
+        self.ser.write(f"s{int(self.rate_hz)}\n".encode())
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=f"stream-{self.ser.port}", daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self):
+        read_timeout = self.ser.timeout
+        self.ser.timeout = 0.05
+        try:
+            while self.running:
+                chunk = self.ser.read(max(1, self.ser.in_waiting))
+                if chunk and self.decoder.feed(chunk):
+                    self.ring.extend(self.decoder.records())
+                    self.decoder.clear()
+                    with self.new_data:
+                        self.new_data.notify_all()
+        finally:
+            self.ser.timeout = read_timeout
+
+    def stop(self):
+        """Stop streaming and give the port back to request/response use."""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.ser.write(b'x')
+        time.sleep(0.05)
+        self.ser.reset_input_buffer()
+
+    def wait_for(self, n, timeout=None, mark=None):
+        """Block until n samples newer than mark (default: now) arrived. Returns them, or None on timeout."""
+        mark = self.ring.total if mark is None else mark
+        if timeout is None:
+            timeout = 2.0 + 2.0 * n / self.rate_hz
+        deadline = time.monotonic() + timeout
+        with self.new_data:
+            while self.ring.total - mark < n:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.running:
+                    return None
+                self.new_data.wait(remaining)
+        return self.ring.since(mark, n)
+
+    def capture(self, n=256, timeout=None):
+        """Collect n fresh samples and return their window statistics, or None if the stream stalled."""
+        records = self.wait_for(n, timeout)
+        if records is None:
+            return None
+        return window_stats(records)
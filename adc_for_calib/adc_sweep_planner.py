@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon May 26 10:12:44 2025
+
+@author: nichm
+
+Adaptive sweep planning: which voltage to calibrate at next.
+
+The first points are the D-optimal design for the polynomial over the
+operating range (the Gauss-Lobatto points, for a cubic -1, -0.447, 0.447, 1
+mapped onto 4-15 V); with a prior (adc_online_fit.OnlineFit with a fleet
+prior) they are skipped. After that each set-point is where the current
+fit's prediction variance h'Ph is largest, which is the point that adds the
+most to det(X'X) (greedy D-optimal), skipping anything closer than
+MIN_SPACING to a voltage already taken so repeats are never suggested. The
+fit runs on measured VIN while the operator (or supply) sets the actual
+input, so candidates are mapped through a straight line fitted to the
+points so far.
+
+Replaying a logged sweep in the planner's order (nearest unused logged point
+to each suggestion) against the logged order shows how close each gets to
+the fit of all points after the first few bench points:
+
+    python adc_sweep_planner.py tests/sarq_*.csv ../adc_read_2/tests/sarq-*.csv
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from adc_fleet_report import load_csvs
+from adc_model_selection import clean_points
+from adc_online_fit import OPERATING_RANGE, OnlineFit, basis
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_GLOBS = [
+    os.path.join(SCRIPT_DIR, "tests", "sarq_calib-*.csv"),
+    os.path.join(SCRIPT_DIR, "tests", "sarq_eval-*.csv"),
+    os.path.join(SCRIPT_DIR, "..", "adc_read_2", "tests", "sarq-*.csv"),
+]
+MIN_SPACING = 0.5     # V; no set-point closer than this to one already taken
+STEP = 0.1            # V; resolution of the suggested set-points
+MAX_POINTS = 16       # Adaptive sweeps stop here even if the fit has not converged
+MAX_RETRIES = 3       # Attempts at one set-point before it is skipped
+MAX_FAILURES = 6      # Failed attempts over the whole sweep before it is aborted
+
+
+def seed_points(degree=3, operating_range=OPERATING_RANGE):
+    """D-optimal design for a polynomial of this degree: -1, the roots of P_degree'(u), 1, mapped to volts."""
+    inner = np.polynomial.legendre.Legendre.basis(degree).deriv().roots() if degree > 1 else []
+    u = np.concatenate([[-1.0], np.sort(np.real(inner)), [1.0]])
+    low, high = operating_range
+    return list(np.round((low + high) / 2 + u * (high - low) / 2, 2))
+
+
+def actual_to_measured(measured, actual):
+    """Line mapping an actual input to the measured VIN the board will report (identity until 2 voltages)."""
+    actual = np.asarray(actual, dtype=np.float64)
+    if len(np.unique(np.round(actual, 3))) < 2:
+        return lambda v: np.asarray(v, dtype=np.float64)
+    slope, offset = np.polyfit(actual, np.asarray(measured, dtype=np.float64), 1)
+    return lambda v: slope * np.asarray(v, dtype=np.float64) + offset
+
+
+def is_free(setpoint, actual, min_spacing=MIN_SPACING):
+    return not len(actual) or np.min(np.abs(np.asarray(actual) - setpoint)) >= min_spacing
+
+
+def next_setpoint(fit, measured, actual, min_spacing=MIN_SPACING, step=STEP, taken=None):
+    """The next actual input to set, or None when every voltage in range is already covered.
+
+    taken are the voltages to keep min_spacing from (default: the actual inputs so far).
+    """
+    taken = np.asarray(actual if taken is None else taken, dtype=np.float64)
+    if not fit.has_prior:
+        for seed in seed_points(fit.degree, fit.operating_range):
+            if is_free(seed, taken, min_spacing):
+                return float(seed)
+    low, high = fit.operating_range
+    candidates = np.round(np.arange(low, high + step / 2, step), 2)
+    if len(taken):
+        candidates = candidates[np.min(np.abs(candidates[:, None] - taken[None, :]), axis=1) >= min_spacing]
+    if not len(candidates):
+        return None
+    h = basis(actual_to_measured(measured, actual)(candidates), fit.degree, fit.operating_range)
+    variance = np.einsum('ij,jk,ik->i', h, fit.P, h)
+    return float(candidates[np.argmax(variance)])
+
+
+def adaptive_plan(fit, measured, actual, max_points=MAX_POINTS, min_spacing=MIN_SPACING,
+                  max_retries=MAX_RETRIES, max_failures=MAX_FAILURES):
+    """Set-points for a sweep, chosen one at a time from the fit as measured/actual grow.
+
+    The lists are read again before every suggestion, so the caller must log each point (and
+    update the fit) before asking for the next one, as run_sweep() and auto_capture() do. A
+    set-point that yields no point is retried max_retries times and then skipped; after
+    max_failures failed attempts in total the sweep is aborted (e.g. the board stopped answering).
+    """
+    skipped = []
+    failures = 0
+    while len(actual) < max_points:
+        if fit.converged():
+            print(f"⏹️ Fit converged after {fit.n} points.")
+            return
+        setpoint = next_setpoint(fit, measured, actual, min_spacing, taken=list(actual) + skipped)
+        if setpoint is None:
+            print(f"⏹️ Every voltage in range is within {min_spacing} V of a point already taken.")
+            return
+        for _ in range(max_retries):
+            points = len(actual)
+            yield setpoint
+            if len(actual) > points:
+                break
+            failures += 1
+            if failures >= max_failures:
+                print(f"❌ {failures} attempts gave no reading. Aborting the sweep.")
+                return
+        else:
+            print(f"⚠️ No reading at {setpoint:g}V after {max_retries} attempts, skipping it.")
+            skipped.append(setpoint)
+    print(f"⏹️ Reached {max_points} points.")
+
+
+def replay(x, y, order, reference, operating_range=OPERATING_RANGE):
+    """Max deviation from the reference curve over the range after each point of the order."""
+    grid = np.linspace(*operating_range, 64)
+    fit = OnlineFit(operating_range=operating_range)
+    deviations = []
+    for i in order:
+        fit.update(x[i], y[i])
+        deviations.append(float(np.max(np.abs(fit.predict(grid) - reference))) if fit.n >= fit.params else np.inf)
+    return deviations
+
+
+def planner_order(x, y, operating_range=OPERATING_RANGE, min_spacing=MIN_SPACING, fit=None):
+    """Logged points in the order the planner would take them (nearest unused point to each suggestion).
+
+    fit is updated along the way (default: a fresh OnlineFit without a prior).
+    """
+    fit = OnlineFit(operating_range=operating_range) if fit is None else fit
+    unused = list(range(len(x)))
+    order, measured, actual, taken = [], [], [], []
+    while unused:
+        setpoint = next_setpoint(fit, measured, actual, min_spacing, taken=taken)
+        if setpoint is None:
+            # The logged sweep is denser than min_spacing: take the rest by largest variance
+            setpoint = next_setpoint(fit, measured, actual, 0.0, taken=taken)
+        i = min(unused, key=lambda k: abs(y[k] - setpoint))
+        unused.remove(i)
+        order.append(i)
+        fit.update(x[i], y[i])
+        measured.append(x[i])
+        actual.append(y[i])
+        taken.append(setpoint)
+    return order
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the adaptive sweep order with the logged one on sweep logs.")
+    parser.add_argument("paths", nargs="*", help="calibration/eval CSVs (default: reference sweep logs)")
+    parser.add_argument("--points", type=int, nargs="+", default=[5, 6, 8, 10], help="sweep lengths to compare")
+    parser.add_argument("--min-spacing", type=float, default=MIN_SPACING)
+    args = parser.parse_args()
+
+    datasets = load_csvs(args.paths or DEFAULT_GLOBS)
+    if not datasets:
+        print("No datasets found.")
+        return 1
+
+    print(f"Seed points: {', '.join(f'{v:g}' for v in seed_points())} V")
+    for dataset in datasets:
+        x, _, y = clean_points(dataset['values'])
+        if len(x) < 6:
+            print(f"❌ {dataset['name']}: only {len(x)} usable points")
+            continue
+        reference = np.polyval(np.polyfit(x, y, 3), np.linspace(*OPERATING_RANGE, 64))
+        order = planner_order(x, y, min_spacing=args.min_spacing)
+        logged = replay(x, y, range(len(x)), reference)
+        planned = replay(x, y, order, reference)
+        repeats = len(y) - len(np.unique(np.round(y, 1)))
+        print(f"📋 {dataset['name']}: {len(x)} points ({repeats} repeated), max deviation from the fit of all points:")
+        for k in args.points:
+            if k <= len(x):
+                print(f"   after {k:>2} points: logged order {logged[k - 1] * 1000:>9.1f} mV, "
+                      f"planned {planned[k - 1] * 1000:>7.1f} mV")
+        print(f"   planned order: {', '.join(f'{y[i]:.2f}' for i in order[:10])}{' ...' if len(order) > 10 else ''}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Apr 24 09:31:44 2025
+
+@author: nichm
+
+Per-stage timing traces for calibration sessions.
+
+Every traced stage (serial setup, operator input, serial reads, fit, .ino
+update, compile, upload, ...) is written as one JSON line with its start/end
+timestamps, duration, board number and port. Tracing is off until
+tracer.open() is called; span() is then cheap enough to leave in place.
+
+Summarize a batch of sessions into per-stage histograms:
+    python adc_trace.py traces/
+"""
+
+import glob
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TRACE_DIR = os.path.join(SCRIPT_DIR, "traces")
+
+
+class Tracer:
+    """Writes stage spans as JSON lines. Context (board, port) can be bound per process and per thread."""
+
+    def __init__(self):
+        self.file = None
+        self.path = None
+        self.lock = threading.Lock()
+        self.context = {}
+        self.local = threading.local()
+
+    def open(self, path, **context):
+        """Start a trace file (appending) with the given default context."""
+        self.close()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'a', buffering=1)
+        self.path = path
+        self.context = dict(context)
+        return path
+
+    def bind(self, **context):
+        """Add context to every following span (board=..., port=...)."""
+        self.context.update(context)
+
+    @contextmanager
+    def bound(self, **context):
+        """Add context to the spans of the current thread only (one board per worker thread)."""
+        previous = getattr(self.local, 'context', {})
+        self.local.context = {**previous, **context}
+        try:
+            yield
+        finally:
+            self.local.context = previous
+
+    def write(self, record):
+        if self.file is None:
+            return
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+
+    @contextmanager
+    def span(self, stage, **fields):
+        """Time a block. The yielded dict can be filled with extra fields (e.g. ok=False)."""
+        if self.file is None:
+            yield fields
+            return
+        start = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield fields
+        except BaseException as e:
+            fields.setdefault('ok', False)
+            fields['error'] = type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - t0
+            record = {'stage': stage, **self.context, **getattr(self.local, 'context', {})}
+            record.update(start=round(start, 6), end=round(start + duration, 6), duration=round(duration, 6))
+            record.update(fields)
+            self.write(record)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+
+
+tracer = Tracer()
+span = tracer.span
+
+
+def session_trace_path(board_no, trace_dir=TRACE_DIR):
+    """Trace file name for one board session."""
+    return os.path.join(trace_dir, f"trace-{board_no}-{time.strftime('%Y%m%d-%H%M%S')}.jsonl")
+
+
+def load_spans(paths):
+    """Read spans from trace files and/or directories of trace files."""
+    spans = []
+    for path in paths:
+        files = sorted(glob.glob(os.path.join(path, "*.jsonl"))) if os.path.isdir(path) else [path]
+        for filename in files:
+            with open(filename) as file:
+                for line in file:
+                    try:
+                        spans.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue  # Truncated last line of an interrupted session
+    return spans
+
+
+def histogram(durations, bins=8):
+    """Log-spaced histogram of durations in seconds, as (upper edge, count) pairs."""
+    durations = np.asarray(durations)
+    low = max(float(durations.min()), 1e-4)
+    high = max(float(durations.max()), low * 1.001)
+    edges = np.geomspace(low, high, bins + 1)
+    counts, _ = np.histogram(np.clip(durations, low, high), edges)
+    return list(zip(edges[1:], counts))
+
+
+def summarize(spans):
+    """Per-stage count, total, share of traced time and duration percentiles."""
+    stages = {}
+    for record in spans:
+        stages.setdefault(record['stage'], []).append(record['duration'])
+    total = sum(sum(d) for d in stages.values())
+    summary = {}
+    for stage, durations in sorted(stages.items(), key=lambda item: -sum(item[1])):
+        d = np.asarray(durations)
+        summary[stage] = {
+            'count': len(d),
+            'total': float(d.sum()),
+            'share': float(d.sum() / total) if total else 0.0,
+            'p50': float(np.percentile(d, 50)),
+            'p90': float(np.percentile(d, 90)),
+            'max': float(d.max()),
+            'histogram': histogram(d),
+        }
+    return summary
+
+
+def print_summary(spans, width=40):
+    boards = {(r.get('board'), r.get('port')) for r in spans}
+    failed = sum(1 for r in spans if r.get('ok') is False)
+    print(f"📊 {len(spans)} spans from {len(boards)} board session(s), {failed} failed")
+    print(f"\n{'stage':<16}{'count':>7}{'total s':>10}{'share':>8}{'p50 s':>9}{'p90 s':>9}{'max s':>9}")
+    summary = summarize(spans)
+    for stage, s in summary.items():
+        print(f"{stage:<16}{s['count']:>7}{s['total']:>10.1f}{s['share']:>8.1%}{s['p50']:>9.3f}{s['p90']:>9.3f}{s['max']:>9.3f}")
+
+    for stage, s in summary.items():
+        print(f"\n{stage}")
+        peak = max(count for _, count in s['histogram']) or 1
+        for edge, count in s['histogram']:
+            print(f"  <= {edge:9.3f}s |{'#' * int(round(width * count / peak)):<{width}}| {count}")
+
+
+def main():
+    paths = sys.argv[1:] or [TRACE_DIR]
+    spans = load_spans(paths)
+    if not spans:
+        print(f"No trace spans found in {', '.join(paths)}")
+        return
+    print_summary(spans)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Jun  4 14:02:51 2025
+
+@author: nichm
+
+Tests for the simulated boards' analog front end (adc_board_simulator.py).
+
+    python -m pytest test_board_simulator.py
+"""
+
+import os
+
+import numpy as np
+
+from adc_board_simulator import BoardProfile, VirtualBoard
+from adc_esp_adc_cal import parse_characterization, raw_to_voltage
+from adc_fleet_report import load_csv
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SARQ_0002 = os.path.join(SCRIPT_DIR, "..", "adc_read_2", "tests", "sarq-0002.csv")
+
+
+def test_samples_agree_with_the_reported_characterization():
+    board = VirtualBoard(BoardProfile.from_csv(SARQ_0002), seed=1).start()
+    try:
+        chars = parse_characterization(board._characterization_line().decode())
+        assert chars == board.profile.characterization
+        for vin in np.linspace(1.0, 16.0, 31):
+            board.set_input_voltage(vin)
+            raw, mv, _, _ = board.sample()
+            assert mv == raw_to_voltage(raw, chars)
+    finally:
+        board.stop()
+
+
+def test_profile_reproduces_the_logged_millivolts():
+    # Board 0002 logged esp_adc_cal with Vref 1128: every row is matched exactly
+    values = load_csv(SARQ_0002)['values']
+    profile = BoardProfile.from_csv(SARQ_0002)
+    assert [profile.adc_cal_mv(raw) for raw in values[:, 0]] == list(np.round(values[:, 1] * 1000.0))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun  3 15:10:52 2025
+
+@author: nichm
+
+Tests for per-board sketch copies and the build directories they compile in
+(adc_build_cache.py). arduino-cli itself is not run.
+
+    python -m pytest test_build_cache.py
+"""
+
+import os
+
+import adc_build_cache
+from adc_build_cache import board_sketch, build_sketch, sketch_hash, upload_many
+
+FQBN = "esp32:esp32:esp32"
+
+
+def make_sketch(root):
+    sketch_dir = root / "adc_for_calib"
+    sketch_dir.mkdir()
+    (sketch_dir / "adc_for_calib.ino").write_text("double calCoeffs[4] = {0, 0, 1, 0};\n")
+    (sketch_dir / "notes.txt").write_text("not a source file\n")
+    return str(sketch_dir / "adc_for_calib.ino")
+
+
+def test_board_sketch_keeps_the_sketch_name(tmp_path):
+    ino = make_sketch(tmp_path)
+    copy = board_sketch(ino, "0007", root=str(tmp_path / "board_sketches"))
+    assert copy == str(tmp_path / "board_sketches" / "0007" / "adc_for_calib" / "adc_for_calib.ino")
+    assert os.listdir(os.path.dirname(copy)) == ["adc_for_calib.ino"]
+    assert sketch_hash(copy, FQBN) == sketch_hash(ino, FQBN)
+
+
+def test_board_sketch_starts_clean(tmp_path):
+    ino = make_sketch(tmp_path)
+    root = str(tmp_path / "board_sketches")
+    copy = board_sketch(ino, "0007", root=root)
+    with open(os.path.join(os.path.dirname(copy), "vin_lut.h"), 'w') as file:
+        file.write("#define USE_VIN_LUT\n")
+    assert os.listdir(os.path.dirname(board_sketch(ino, "0007", root=root))) == ["adc_for_calib.ino"]
+
+
+def test_board_copies_share_one_build_directory(tmp_path, monkeypatch):
+    commands = []
+
+    def compile_stub(cmd, **kwargs):
+        commands.append(cmd)
+        output_dir = cmd[cmd.index("--output-dir") + 1]
+        os.makedirs(output_dir)
+        open(os.path.join(output_dir, "adc_for_calib.ino.bin"), 'w').close()
+        return adc_build_cache.subprocess.CompletedProcess(cmd, 0, "", "")
+
+    monkeypatch.setattr(adc_build_cache.subprocess, "run", compile_stub)
+    ino = make_sketch(tmp_path)
+    cache_dir = str(tmp_path / "cache")
+    for board in ("0001", "0002"):
+        copy = board_sketch(ino, board, root=str(tmp_path / "board_sketches"))
+        with open(copy, 'a') as file:
+            file.write(f"// board {board}\n")
+        assert build_sketch(copy, FQBN, cache_dir)
+    build_paths = {cmd[cmd.index("--build-path") + 1] for cmd in commands}
+    assert len(commands) == 2 and len(build_paths) == 1
+    # The shared sketch compiles in the same directory too
+    build_sketch(ino, FQBN, cache_dir)
+    assert {cmd[cmd.index("--build-path") + 1] for cmd in commands} == build_paths
+
+
+def test_upload_many_takes_one_folder_per_port(tmp_path, monkeypatch):
+    uploads = []
+
+    def upload_stub(output_dir, board_fqbn, port, log_dir):
+        uploads.append((port, output_dir))
+        return port != "COM4", 1.0
+
+    monkeypatch.setattr(adc_build_cache, "upload_sketch", upload_stub)
+    results = upload_many({"COM3": "out/a", "COM4": "out/b"}, FQBN, ["COM3", "COM4"], cache_dir=str(tmp_path))
+    assert sorted(uploads) == [("COM3", "out/a"), ("COM4", "out/b")]
+    assert results == {"COM3": (True, 1.0), "COM4": (False, 1.0)}
+    uploads.clear()
+    upload_many("out/generic", FQBN, ["COM3", "COM4"], cache_dir=str(tmp_path))
+    assert sorted(uploads) == [("COM3", "out/generic"), ("COM4", "out/generic")]
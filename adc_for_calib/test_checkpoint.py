@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Jun  5 10:48:52 2025
+
+@author: nichm
+
+Tests for saving and resuming calibration checkpoints (adc_checkpoint.py).
+
+    python -m pytest test_checkpoint.py
+"""
+
+import json
+import os
+
+import pytest
+
+from adc_checkpoint import Checkpoint, checkpoint_path, write_json_atomic
+
+
+def test_round_trip_and_resume(tmp_path):
+    checkpoint = Checkpoint(7, str(tmp_path))
+    checkpoint.update(port="/dev/ttyUSB0", coeff_version=3, sweep_plan=[5.0, 9.0, 12.0, 15.0])
+    checkpoint.record_point(4.91, 5.0)
+    checkpoint.record_point(8.84, 9.0)
+
+    resumed = Checkpoint.load(7, str(tmp_path))
+    assert resumed.state == checkpoint.state
+    assert resumed.points == 2 and resumed['coeff_version'] == 3
+    assert resumed.remaining_plan() == [12.0, 15.0]
+    assert "2 point(s), sweep 2/4" in resumed.describe()
+
+    # The resumed session carries on where the first one stopped
+    resumed.record_point(11.78, 12.0)
+    assert Checkpoint.load(7, str(tmp_path))['actual_vin'] == [5.0, 9.0, 12.0]
+
+
+def test_missing_or_cleared_checkpoint(tmp_path):
+    assert Checkpoint.load(7, str(tmp_path)) is None
+    checkpoint = Checkpoint(7, str(tmp_path))
+    checkpoint.record_point(4.91, 5.0)
+    checkpoint.clear()
+    checkpoint.clear()  # Already gone: no error
+    assert Checkpoint.load(7, str(tmp_path)) is None
+
+
+def test_unreadable_checkpoint_is_ignored(tmp_path):
+    with open(checkpoint_path(7, str(tmp_path)), 'w') as file:
+        file.write('{"measured_vin": [4.9')  # Left by a writer that did not use write_json_atomic()
+    assert Checkpoint.load(7, str(tmp_path)) is None
+
+
+def test_failed_write_keeps_the_previous_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "state.json")
+    write_json_atomic(path, {'points': 1})
+
+    def crash(*args, **kwargs):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(os, "replace", crash)
+    with pytest.raises(KeyboardInterrupt):
+        write_json_atomic(path, {'points': 2})
+
+    with open(path) as file:
+        assert json.load(file) == {'points': 1}
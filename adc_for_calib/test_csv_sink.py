@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Jun  2 09:41:22 2025
+
+@author: nichm
+
+Tests for CsvSink and read_rows() resume handling (adc_csv_sink.py).
+
+    python -m pytest test_csv_sink.py
+"""
+
+from adc_csv_sink import CsvSink, read_rows
+
+HEADERS = ["Measured VIN", "Actual VIN"]
+
+
+def lines(path):
+    with open(path, newline='') as file:
+        return file.read().splitlines()
+
+
+def test_new_sink_writes_header_and_rows(tmp_path):
+    path = tmp_path / "sarq_calib-0001.csv"
+    with CsvSink(str(path), HEADERS, flush_every=2) as sink:
+        sink.write([4.8, 5.0])
+        sink.write_many([[7.0, 7.1], [9.2, 9.3]])
+        assert not sink.resumed
+    assert read_rows(str(path), HEADERS) == [["4.8", "5.0"], ["7.0", "7.1"], ["9.2", "9.3"]]
+
+
+def test_read_rows_needs_matching_header(tmp_path):
+    path = tmp_path / "other.csv"
+    path.write_bytes(b"A,B\r\n1,2\r\n")
+    assert read_rows(str(path), HEADERS) is None
+    assert read_rows(str(tmp_path / "missing.csv"), HEADERS) is None
+
+
+def test_without_resume_the_file_starts_over(tmp_path):
+    path = tmp_path / "sarq_calib-0001.csv"
+    path.write_bytes(b"Measured VIN,Actual VIN\r\n4.8,5.0\r\n")
+    with CsvSink(str(path), HEADERS):
+        pass
+    assert lines(path) == ["Measured VIN,Actual VIN"]
+
+
+def test_resume_trims_partial_row_and_coefficients_block(tmp_path):
+    path = tmp_path / "sarq_calib-0001.csv"
+    path.write_bytes(b"Measured VIN,Actual VIN\r\n4.8,5.0\r\n7.0,7.1\r\n\r\n"
+                     b"Cubic Fit Coefficients:,0.1,0.2,0.3,0.4\r\n9.2,9.")
+    with CsvSink(str(path), HEADERS, resume=True) as sink:
+        assert sink.resumed
+        assert sink.resumed_rows == [["4.8", "5.0"], ["7.0", "7.1"]]
+        sink.write([9.2, 9.3])
+    # The new row follows the logged ones, so a later resume sees all of them
+    assert read_rows(str(path), HEADERS) == [["4.8", "5.0"], ["7.0", "7.1"], ["9.2", "9.3"]]
+    assert lines(path)[-1] == "9.2,9.3"
+
+
+def test_resume_of_a_file_cut_mid_row(tmp_path):
+    path = tmp_path / "sarq_calib-0001.csv"
+    path.write_bytes(b"Measured VIN,Actual VIN\r\n4.8,5.0\r\n7.0,7")
+    with CsvSink(str(path), HEADERS, resume=True) as sink:
+        assert sink.resumed_rows == [["4.8", "5.0"]]
+        sink.write([7.0, 7.1])
+    assert read_rows(str(path), HEADERS) == [["4.8", "5.0"], ["7.0", "7.1"]]
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun  3 11:15:42 2025
+
+@author: nichm
+
+Tests for the host model of esp_adc_cal_raw_to_voltage() (adc_esp_adc_cal.py).
+
+    python -m pytest test_esp_adc_cal.py
+"""
+
+import os
+
+import numpy as np
+
+from adc_esp_adc_cal import (
+    cached_characterization,
+    characterize_vref,
+    estimate_characterization,
+    forget_unsupported,
+    get_characterization,
+    parse_characterization,
+    raw_domain_fit,
+    raw_to_voltage,
+)
+from adc_fleet_report import load_csv
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SARQ_0002 = os.path.join(SCRIPT_DIR, "..", "adc_read_2", "tests", "sarq-0002.csv")
+EVAL_0004 = os.path.join(SCRIPT_DIR, "tests", "sarq_eval-0004.csv")
+
+# (raw, mV) logged by board 0002 (Vref 1128): linear range, the blend step above 2880, and the LUT
+BOARD_0002_POINTS = [(910, 894), (1954, 1756), (2869, 2512), (2952, 2564), (3040, 2624), (3431, 2854), (3827, 3042)]
+
+
+def test_default_vref_characterization():
+    chars = characterize_vref()
+    assert chars == {'type': 2, 'vref': 1100, 'coeff_a': 52798, 'coeff_b': 142}
+    # coeff_a * raw / 65536 rounded, plus coeff_b, below code 2880; blend and LUT above
+    assert list(raw_to_voltage([0, 1000, 2879, 2880, 2944, 3500, 4095], chars)) == \
+        [142, 948, 2461, 2462, 2502, 2857, 3138]
+
+
+def test_reproduces_logged_readings():
+    chars = characterize_vref(1128)
+    raw, mv = np.array(BOARD_0002_POINTS).T
+    assert list(raw_to_voltage(raw, chars)) == list(mv)
+
+
+def test_estimate_recovers_the_vref():
+    values = load_csv(SARQ_0002)['values']
+    chars = estimate_characterization(values[:, 0], values[:, 1] * 1000.0)
+    assert chars == characterize_vref(1128)
+
+
+def test_parse_characterization():
+    line = "ADC Characterization: type 1 | vref 1121 | coeff_a 53911 | coeff_b 150"
+    assert parse_characterization(line) == {'type': 1, 'vref': 1121, 'coeff_a': 53911, 'coeff_b': 150}
+    assert parse_characterization("VIN: 12.000") is None
+
+
+class FakeSerial:
+    """Answers 'e' with the given line; an empty line is a read timeout."""
+
+    def __init__(self, line=b""):
+        self.line = line
+        self.writes = 0
+
+    def reset_input_buffer(self):
+        pass
+
+    def write(self, data):
+        self.writes += 1
+
+    def readline(self):
+        return self.line
+
+
+def test_characterization_is_read_once_per_board(tmp_path):
+    path = str(tmp_path / "chars.json")
+    ser = FakeSerial(b"ADC Characterization: type 2 | vref 1100 | coeff_a 52798 | coeff_b 142\r\n")
+    assert get_characterization(ser, "0007", path) == characterize_vref()
+    assert get_characterization(ser, "0007", path) == characterize_vref()
+    assert ser.writes == 1
+
+
+def test_firmware_without_e_is_asked_once_until_reflashed(tmp_path):
+    path = str(tmp_path / "chars.json")
+    old = FakeSerial()
+    assert get_characterization(old, "0007", path) is None
+    assert get_characterization(old, "0007", path) is None
+    assert old.writes == 1 and cached_characterization("0007", path) is None
+    forget_unsupported("0007", path)
+    new = FakeSerial(b"ADC Characterization: type 2 | vref 1100 | coeff_a 52798 | coeff_b 142\r\n")
+    assert get_characterization(new, "0007", path) == characterize_vref()
+
+
+def test_raw_domain_fit_uses_every_good_row():
+    dataset = load_csv(EVAL_0004)
+    (coeffs, ok, metrics), cleaned = raw_domain_fit([dataset], [characterize_vref()])
+    assert ok[0] and len(cleaned[0]['values']) == 20
+    assert metrics['rms'][0] < 0.03
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Jun  5 11:24:03 2025
+
+@author: nichm
+
+Tests for the host emulation of the firmware VIN pipeline (adc_firmware_emulator.py).
+
+    python -m pytest test_firmware_emulator.py
+"""
+
+import numpy as np
+import pytest
+
+from adc_firmware_emulator import (
+    DEFAULT_GLOBS,
+    arduino_float_str,
+    calculate_vin,
+    calibrate_vin,
+    check_dataset,
+    logged_coeffs,
+    round_coeffs,
+)
+from adc_fleet_report import load_csvs
+
+DATASETS = load_csvs(DEFAULT_GLOBS)
+
+
+@pytest.mark.parametrize("dataset", DATASETS, ids=[d['name'] for d in DATASETS])
+def test_reproduces_every_logged_row(dataset):
+    coeffs, rounding = logged_coeffs(dataset)
+    assert len(dataset['values']) > 0
+    assert check_dataset(dataset, coeffs, rounding) == []
+
+
+def test_other_coefficients_do_not_reproduce_the_log():
+    dataset = next(d for d in DATASETS if d['name'].startswith("adc_read_2"))
+    coeffs, _ = logged_coeffs(dataset)
+    assert len(check_dataset(dataset, np.array(coeffs) * 1.001, 'exact')) > 0
+
+
+@pytest.mark.parametrize("value, digits, text", [
+    (12.3456, 3, "12.346"), (0.0005, 3, "0.001"), (-1.25, 2, "-1.25"), (7.0, 0, "7"), (2.9995, 3, "3.000"),
+])
+def test_arduino_float_str(value, digits, text):
+    assert arduino_float_str(value, digits) == text
+
+
+def test_coefficient_rounding():
+    coeffs = [0.00044253520242194854, -0.007642874827068902, 1.0404718535282347, 0.01860516433504883]
+    assert list(round_coeffs(coeffs, 'flash')) == [0.000443, -0.007643, 1.040472, 0.018605]
+    assert list(round_coeffs(coeffs, 'provision')) == [float(f"{c:.10g}") for c in coeffs]
+    assert list(round_coeffs(coeffs, 'exact')) == coeffs
+
+
+def test_stacked_coefficient_sets_match_single_sets():
+    vin = calculate_vin(np.array([900, 1500, 2100, 2600]))
+    assert vin.dtype == np.float32
+    sets = np.array([[0.000443, -0.007643, 1.040472, 0.018605], [0.00121, -0.0298, 1.228, -0.627]])
+    stacked = calibrate_vin(sets, vin)
+    for row, coeffs in zip(stacked, sets):
+        assert np.array_equal(row, calibrate_vin(coeffs, vin))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun  3 10:04:17 2025
+
+@author: nichm
+
+Tests for the fleet prior (adc_fleet_prior.py) on the reference sweep logs.
+
+    python -m pytest test_fleet_prior.py
+"""
+
+import numpy as np
+import pytest
+
+from adc_fleet_prior import (
+    COVERAGE,
+    DEFAULT_GLOBS,
+    MIN_BOARDS,
+    choose_inflation,
+    learn_prior,
+    map_fit,
+    prior_fit,
+    usable,
+    validate,
+)
+from adc_fleet_report import load_csvs
+from adc_online_fit import scale, unscale
+
+
+@pytest.fixture(scope="module")
+def datasets():
+    return usable(load_csvs(DEFAULT_GLOBS))
+
+
+def test_usable_keeps_every_reference_log(datasets):
+    # sarq_eval-0004 has four typos; the 20 good rows are enough to learn from
+    assert len(datasets) == 6
+    assert min(len(d['values']) for d in datasets) == 20
+
+
+def test_learn_prior(datasets):
+    prior = learn_prior(datasets)
+    assert len(prior['boards']) == len(datasets)
+    assert np.all(np.linalg.eigvalsh(prior['cov']) > 0)
+    assert 0.01 < prior['noise'] < 0.1
+    assert learn_prior(datasets[:MIN_BOARDS - 1]) is None
+
+
+def test_prior_fit_starts_at_the_mean_and_follows_the_data(datasets):
+    prior = learn_prior(datasets)
+    x = np.linspace(4.0, 15.0, 12)
+    assert np.allclose(prior_fit(prior).predict(x), np.polyval(unscale(prior['mean']), x))
+    target = np.poly1d([0.0004, -0.01, 1.1, 0.2])
+    fit = map_fit(prior, np.repeat(x, 20), np.repeat(target(x), 20))
+    assert np.max(np.abs(fit.predict(x) - target(x))) < 0.01
+    assert np.all(fit.predictive_band(x) < prior_fit(prior).predictive_band(x))
+
+
+def test_every_board_is_within_the_prior(datasets):
+    prior = learn_prior(datasets)
+    sd = np.sqrt(np.diag(prior['cov']))
+    for dataset in datasets:
+        values = dataset['values']
+        theta = scale(np.polyfit(values[:, 2], values[:, 4], 3))
+        assert np.all(np.abs(theta - prior['mean']) < 3 * sd)
+
+
+def test_leave_one_board_out_bounds_cover_the_held_out_points(datasets):
+    inflation = choose_inflation(datasets)
+    rows = validate(datasets, points=(4,), inflation=inflation)
+    assert len(rows) == len(datasets)
+    covered = sum(row[4]['coverage'] * row['n'] for row in rows) / sum(row['n'] for row in rows)
+    assert covered >= COVERAGE
+    assert all(row[4]['coverage'] >= 0.8 for row in rows)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Jun  5 11:06:14 2025
+
+@author: nichm
+
+Tests for the batched fleet refit (adc_fleet_refit.py) against per-board np.polyfit.
+
+    python -m pytest test_fleet_refit.py
+"""
+
+import numpy as np
+
+from adc_fleet_refit import batch_polyfit, pack, refit
+from adc_fleet_report import DEFAULT_GLOBS, load_csvs
+
+
+def dataset(x, y, name="board"):
+    values = np.full((len(x), 5), np.nan)
+    values[:, 2] = x
+    values[:, 4] = y
+    return {'name': name, 'board': None, 'values': values, 'coeffs': None}
+
+
+def test_batch_equals_polyfit_per_board():
+    rng = np.random.default_rng(5)
+    datasets = []
+    for n in (6, 11, 24):  # Ragged: padded rows must not change any fit
+        x = np.sort(rng.uniform(4.0, 15.0, n))
+        y = 0.0004 * x ** 3 - 0.01 * x ** 2 + 1.05 * x + 0.2 + rng.normal(0, 0.01, n)
+        datasets.append(dataset(x, y))
+    for degree in (1, 2, 3):
+        coeffs, ok = batch_polyfit(*pack(datasets), degree)
+        assert ok.all()
+        for i, d in enumerate(datasets):
+            expected = np.polyfit(d['values'][:, 2], d['values'][:, 4], degree)
+            assert np.allclose(coeffs[i], expected, rtol=1e-8, atol=1e-10)
+
+
+def test_reference_logs_match_polyfit():
+    datasets = load_csvs(DEFAULT_GLOBS)
+    coeffs, ok, metrics = refit(datasets)
+    for i, d in enumerate(datasets):
+        keep = np.isfinite(d['values'][:, 2]) & np.isfinite(d['values'][:, 4])
+        assert ok[i]
+        assert np.allclose(coeffs[i], np.polyfit(d['values'][keep, 2], d['values'][keep, 4], 3), rtol=1e-8, atol=1e-10)
+        assert metrics['n'][i] == np.count_nonzero(keep)
+
+
+def test_too_few_points_are_not_ok():
+    coeffs, ok = batch_polyfit(*pack([dataset([5.0, 9.0, 12.0], [5.1, 9.1, 12.2]),
+                                      dataset([5.0, 5.0, 5.0, 5.0], [5.1, 5.1, 5.1, 5.1])]), 3)
+    assert not ok.any() and np.isnan(coeffs).all()
+
+
+def test_gross_errors_are_dropped_before_the_refit():
+    x = np.linspace(4.0, 15.0, 12)
+    y = 1.02 * x + 0.1
+    y[5] += 8.0  # A typo in the actual input
+    coeffs, ok, metrics = refit([dataset(x, y)], degree=1, gross_error=1.0)
+    assert metrics['dropped'][0] == 1
+    assert np.allclose(coeffs[0], [1.02, 0.1])
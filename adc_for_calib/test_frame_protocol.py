@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Jun  2 09:14:05 2025
+
+@author: nichm
+
+Tests for the COBS/CRC sample frames (adc_frame_protocol.py).
+
+    python -m pytest test_frame_protocol.py
+"""
+
+import numpy as np
+import pytest
+
+from adc_frame_protocol import (
+    FRAME_DELIMITER,
+    FrameDecoder,
+    FrameError,
+    cobs_decode,
+    cobs_encode,
+    decode_frame,
+    encode_frame,
+)
+
+
+@pytest.mark.parametrize("data", [b"", b"\x00", b"\x00\x00", b"abc", b"a\x00b\x00", bytes(range(256)), b"\x01" * 600])
+def test_cobs_round_trip(data):
+    encoded = cobs_encode(data)
+    assert FRAME_DELIMITER not in encoded
+    assert cobs_decode(encoded) == data
+
+
+def test_frame_round_trip():
+    frame = encode_frame(7, 2048, 1234, 12.5, 12.25)
+    assert frame.endswith(FRAME_DELIMITER) and FRAME_DELIMITER not in frame[:-1]
+    assert decode_frame(frame[:-1]) == (7, 2048, 1234, 12.5, 12.25)
+
+
+def test_corrupted_frame_is_rejected():
+    frame = bytearray(encode_frame(1, 100, 200, 3.0, 3.5)[:-1])
+    frame[5] ^= 0x01
+    with pytest.raises(FrameError):
+        decode_frame(bytes(frame))
+    with pytest.raises(FrameError):
+        decode_frame(frame[:-3])
+
+
+def test_decoder_splits_chunks_and_counts_errors():
+    frames = [encode_frame(seq, seq, 10 * seq, seq / 2, seq / 4) for seq in (0, 1, 2, 4)]
+    bad = bytearray(frames[2])
+    bad[3] ^= 0xFF
+    stream = b"".join([frames[0], frames[1], bytes(bad), frames[3]])
+    decoder = FrameDecoder()
+    # Byte-by-byte feeding keeps partial frames between calls
+    added = sum(decoder.feed(stream[i:i + 1]) for i in range(len(stream)))
+    records = decoder.records()
+    assert added == 3
+    assert list(records['seq']) == [0, 1, 4]
+    assert np.allclose(records['vin'], [0.0, 0.5, 2.0])
+    assert decoder.corrupted == 1
+    assert decoder.dropped == 2  # 2 is corrupted, 3 never arrived
+
+
+def test_records_view_survives_more_frames():
+    decoder = FrameDecoder()
+    decoder.feed(encode_frame(0, 1, 2, 3.0, 4.0))
+    view = decoder.records()
+    decoder.feed(encode_frame(1, 5, 6, 7.0, 8.0))
+    assert len(view) == 1 and view['raw_adc'][0] == 1
+    assert list(decoder.records()['raw_adc']) == [1, 5]
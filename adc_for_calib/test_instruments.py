@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Jun  5 12:15:30 2025
+
+@author: nichm
+
+Tests for the SCPI supply/meter backends (adc_instruments.py) against fake transports.
+
+    python -m pytest test_instruments.py
+"""
+
+import socket
+import threading
+
+import pytest
+
+from adc_instruments import (
+    ScpiMeter,
+    ScpiSupply,
+    SimulatedSupply,
+    TcpTransport,
+    open_supply,
+    open_transport,
+    run_sweep,
+)
+
+
+class FakeTransport:
+    """Records every command; queries are answered from a {command: reply} table."""
+
+    def __init__(self, replies=None):
+        self.replies = replies or {}
+        self.sent = []
+        self.closed = False
+
+    def write(self, command):
+        self.sent.append(command)
+
+    def query(self, command):
+        self.write(command)
+        return self.replies[command]
+
+    def close(self):
+        self.closed = True
+
+
+def test_supply_commands():
+    transport = FakeTransport({"*IDN?": "ACME,PSU-30,123,1.0", "MEAS:VOLT?": "+1.20034E+01"})
+    supply = ScpiSupply(transport, settle_time=0.0)
+    assert supply.identify() == "ACME,PSU-30,123,1.0"
+    supply.set_voltage(12)
+    assert supply.measure_voltage() == 12.0034
+    supply.output(False)
+    supply.close()
+    assert transport.sent == ["*IDN?", "VOLT 12.0000", "OUTP ON", "MEAS:VOLT?", "OUTP OFF"]
+    assert transport.closed
+
+
+def test_meter_reads_the_true_voltage():
+    supply_link, meter_link = FakeTransport(), FakeTransport({"MEAS:VOLT:DC?": "11.98765"})
+    supply = ScpiSupply(supply_link, meter=ScpiMeter(meter_link))
+    supply.set_voltage(4.56789)
+    assert supply.measure_voltage() == 11.98765
+    assert supply_link.sent == ["VOLT 4.5679", "OUTP ON"]  # No readback query to the supply
+    assert meter_link.sent == ["MEAS:VOLT:DC?"]
+    supply.close()
+    assert supply_link.closed and meter_link.closed
+
+
+def test_sweep_switches_the_output_off():
+    transport = FakeTransport({"MEAS:VOLT?": "5.001"})
+    captured = []
+
+    def capture(actual):
+        captured.append(actual)
+        return actual if len(captured) == 1 else None  # The board misses the second point
+
+    assert run_sweep(ScpiSupply(transport, settle_time=0.0), [5.0, 9.0], capture) == 1
+    assert captured == [5.001, 5.001]
+    assert transport.sent == ["VOLT 5.0000", "OUTP ON", "MEAS:VOLT?", "VOLT 9.0000", "OUTP ON", "MEAS:VOLT?",
+                              "OUTP OFF"]
+
+
+def test_simulated_supply_drives_listeners():
+    supply = SimulatedSupply(gain_error=0.0, offset=0.01, noise=0.0, seed=1)
+    seen = []
+    supply.attach(seen.append)
+    supply.set_voltage(9.0)
+    assert supply.measure_voltage() == 9.01
+    supply.close()
+    assert seen == [0.0, 9.01, 0.0]
+
+
+def test_tcp_transport_line_protocol():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    received = []
+
+    def serve():
+        conn, _ = server.accept()
+        with conn, conn.makefile('rb') as lines:
+            for line in lines:
+                received.append(line)
+                if line.endswith(b"?\n"):
+                    conn.sendall(b"7.5000\r\n")
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+
+    transport = TcpTransport("127.0.0.1", server.getsockname()[1])
+    supply = ScpiSupply(transport, settle_time=0.0)
+    supply.set_voltage(7.5)
+    assert supply.measure_voltage() == 7.5
+    supply.close()
+    thread.join(2)
+    server.close()
+    assert received == [b"VOLT 7.5000\n", b"OUTP ON\n", b"MEAS:VOLT?\n"]
+
+
+@pytest.mark.parametrize("spec", ["tcp:", "serial:", "gpib:5", "usb"])
+def test_bad_specs(spec):
+    with pytest.raises(ValueError):
+        open_transport(spec)
+
+
+def test_sim_supply_has_no_meter_spec():
+    with pytest.raises(ValueError):
+        open_supply("sim", meter_spec="tcp:10.0.0.2")
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun  3 13:48:09 2025
+
+@author: nichm
+
+Tests for the raw ADC -> VIN lookup table (adc_lut_codegen.py).
+
+    python -m pytest test_lut_codegen.py
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from adc_fleet_report import load_csv
+from adc_lut_codegen import CODES, build_table, choose_shift, direct_curve, generate_lut_source, lookup
+from adc_model_selection import clean_mask
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope="module")
+def curve():
+    return 4.0 + 11.5 * (CODES / 4095.0) + 0.3 * (CODES / 4095.0) ** 3
+
+
+def test_shift_zero_is_one_entry_per_code(curve):
+    table = build_table(curve, 0)
+    assert len(table) == 4097
+    assert np.array_equal(lookup(table, 0, CODES), table[:-1])
+    assert "((1 << VIN_LUT_SHIFT) >> 1)" in generate_lut_source(table, 0)
+
+
+@pytest.mark.parametrize("shift", [1, 2, 3, 4])
+def test_lookup_interpolates_between_entries(curve, shift):
+    table = build_table(curve, shift)
+    assert len(table) == (4096 >> shift) + 1
+    points = np.arange(0, 4096, 1 << shift)
+    assert np.array_equal(lookup(table, shift, points), table[:-1])
+    assert np.max(np.abs(lookup(table, shift, CODES) - curve * 1000.0)) < 1.0
+
+
+def test_choose_shift_takes_the_smallest_table_within_the_bound(curve):
+    shift, reports = choose_shift(curve, max_error_mv=1.0)
+    assert all(r['max_error_mv'] <= 1.0 for r in reports if r['shift'] <= shift)
+    assert all(r['max_error_mv'] > 1.0 for r in reports if r['shift'] > shift)
+
+
+def test_direct_curve_covers_the_whole_sweep():
+    values = load_csv(os.path.join(SCRIPT_DIR, "tests", "sarq_eval-0004.csv"))['values']
+    keep = clean_mask(values)
+    error = direct_curve(values)[values[keep, 0].astype(int)] - values[keep, 4]
+    assert np.max(np.abs(error)) < 0.05
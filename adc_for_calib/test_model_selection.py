@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun  3 09:22:51 2025
+
+@author: nichm
+
+Tests for the data-entry slip filter and model selection (adc_model_selection.py).
+
+    python -m pytest test_model_selection.py
+"""
+
+import csv
+import json
+import os
+
+import numpy as np
+
+from adc_fleet_report import load_csv
+from adc_model_selection import MODEL_LABEL, clean_mask, fit_model, model_row, predict_model, select_model
+from adc_sample_store import CALIB_HEADER
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+EVAL_0004 = os.path.join(SCRIPT_DIR, "tests", "sarq_eval-0004.csv")
+TYPOS = [0.97, 60.0, 0.01, 0.63]   # Actual inputs mistyped in sarq_eval-0004.csv
+
+
+def test_slips_do_not_skew_the_filter():
+    values = load_csv(EVAL_0004)['values']
+    keep = clean_mask(values)
+    assert np.count_nonzero(keep) == 20
+    assert sorted(values[~keep, 4]) == sorted(TYPOS)
+    # The good rows span the whole sweep, not just the low-voltage end
+    assert values[keep, 4].max() > 15.0
+
+
+def test_clean_rows_are_kept():
+    x = np.linspace(4.0, 15.0, 12)
+    values = np.column_stack([x * 270, x / 4.8, x, x, 1.02 * x + 0.01 * x ** 2])
+    assert clean_mask(values).all()
+
+
+def test_select_model_uses_every_good_row():
+    result = select_model(load_csv(EVAL_0004)['values'])
+    assert result['n'] == 20
+    assert result['scores'][result['model']]['cv_rmse'] < 0.05
+
+
+def test_model_row_records_the_flashed_model(tmp_path):
+    x = np.linspace(4.0, 15.0, 12)
+    y = np.where(x < 9.0, 1.02 * x, 9.18 + 1.05 * (x - 9.0))
+    model = {'model': 'piecewise', 'params': fit_model('piecewise', x, y)}
+    path = tmp_path / "sarq_calib-0007.csv"
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerows([CALIB_HEADER] + [[m, a] for m, a in zip(x, y)] + [[], model_row(model)])
+
+    with open(path, newline='') as file:
+        label, name, params = list(csv.reader(file))[-1]
+    assert (label, name) == (MODEL_LABEL, 'piecewise')
+    assert np.allclose(predict_model(name, json.loads(params), x), predict_model(name, model['params'], x))
+    # The calibration rows still load, without a cubic the model never had
+    dataset = load_csv(str(path))
+    assert len(dataset['values']) == 12 and dataset['coeffs'] is None
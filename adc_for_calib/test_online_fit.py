@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Jun  5 11:52:48 2025
+
+@author: nichm
+
+Tests for the recursive least-squares sweep fit (adc_online_fit.py) against batch least squares.
+
+    python -m pytest test_online_fit.py
+"""
+
+import numpy as np
+
+from adc_online_fit import OnlineFit, basis, scale, t_quantile, unscale
+
+TRUE_COEFFS = [0.0004, -0.009, 1.06, 0.15]
+
+
+def sweep(n, noise, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.linspace(4.5, 14.5, n)
+    return x, np.polyval(TRUE_COEFFS, x) + rng.normal(0, noise, n)
+
+
+def online(x, y, **options):
+    fit = OnlineFit(**options)
+    for xi, yi in zip(x, y):
+        fit.update(xi, yi)
+    return fit
+
+
+def test_rls_matches_batch_least_squares():
+    x, y = sweep(12, 0.005)
+    fit = online(x, y)
+    batch = np.polyfit(x, y, 3)
+    # Same curve to within round-off of the diffuse start (a few µV against mV-level readings)
+    grid = np.linspace(4.0, 15.0, 50)
+    assert np.max(np.abs(fit.predict(grid) - np.polyval(batch, grid))) < 1e-5
+    assert np.allclose(fit.coeffs, batch, rtol=1e-4)
+
+    residual = y - np.polyval(batch, x)
+    sigma = np.sqrt(residual @ residual / (len(x) - 4))
+    assert np.isclose(fit.sigma(), sigma, rtol=1e-4)
+
+    # Intervals and curve band from the batch covariance sigma^2 (X'X)^-1
+    vander = np.vander(x, 4)
+    cov = np.linalg.inv(vander.T @ vander)
+    t = t_quantile(len(x) - 4)
+    assert np.allclose(fit.coeff_intervals(), t * sigma * np.sqrt(np.diag(cov)), rtol=1e-4)
+    rows = np.vander(grid, 4)
+    assert np.allclose(fit.band(grid), t * sigma * np.sqrt(np.einsum('ij,jk,ik->i', rows, cov, rows)), rtol=1e-4)
+
+
+def test_a_priori_errors_are_held_out_residuals():
+    x, y = sweep(8, 0.005)
+    fit = online(x[:-1], y[:-1])
+    previous = np.polyfit(x[:-1], y[:-1], 3)
+    assert np.isclose(fit.update(x[-1], y[-1]), y[-1] - np.polyval(previous, x[-1]), atol=1e-5)
+
+
+def test_no_bounds_until_the_cubic_is_overdetermined():
+    x, y = sweep(4, 0.005)
+    fit = online(x, y)
+    assert fit.sigma() is None and fit.coeff_intervals() is None and fit.band(10.0) is None
+    assert not fit.converged() and "more point(s)" in fit.status()
+    fit.update(9.7, np.polyval(TRUE_COEFFS, 9.7))
+    assert fit.sigma() is not None
+
+
+def test_converges_on_a_quiet_sweep_only():
+    x, y = sweep(16, 0.002)
+    fit = OnlineFit()
+    converged_at = None
+    for i, (xi, yi) in enumerate(zip(x, y)):
+        fit.update(xi, yi)
+        if converged_at is None and fit.converged():
+            converged_at = i + 1
+    assert converged_at is not None and converged_at < 16
+    assert fit.max_band() <= fit.target
+
+    x, y = sweep(16, 0.050)
+    assert not online(x, y).converged()
+
+
+def test_prior_update_is_the_bayesian_posterior():
+    x, y = sweep(3, 0.01)
+    mean = scale([0.0003, -0.008, 1.05, 0.1])
+    prior_cov = np.diag([1e-4, 1e-3, 1e-2, 1e-2])
+    fit = online(x, y, prior_mean=mean, prior_cov=prior_cov, noise=0.01)
+
+    h = basis(x)
+    precision = np.linalg.inv(prior_cov) + h.T @ h / 0.01 ** 2
+    posterior = np.linalg.solve(precision, np.linalg.solve(prior_cov, mean) + h.T @ y / 0.01 ** 2)
+    assert np.allclose(fit.theta, posterior, rtol=1e-8, atol=1e-10)
+    assert np.allclose(fit.coeffs, unscale(posterior))
+    assert fit.sigma() == 0.01 and fit.dof is None
+
+
+def test_band_covers_the_true_curve_95_percent_of_the_time():
+    grid = np.array([5.0, 9.5, 14.0])
+    covered = []
+    for seed in range(400):
+        x, y = sweep(10, 0.01, seed)
+        fit = online(x, y)
+        covered.append(np.abs(fit.predict(grid) - np.polyval(TRUE_COEFFS, grid)) <= fit.band(grid))
+    assert 0.92 <= np.mean(covered) <= 0.98
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Jun  2 10:31:16 2025
+
+@author: nichm
+
+Tests for the piecewise segment search (adc_piecewise_search.py).
+
+    python -m pytest test_piecewise_search.py
+"""
+
+import itertools
+import os
+
+import numpy as np
+
+from adc_fleet_report import load_csv
+from adc_model_selection import clean_points
+from adc_piecewise_search import optimal_segments, predict, search, segment_errors
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_kinked_line_needs_two_segments():
+    x = np.linspace(4.0, 15.0, 23)
+    y = np.where(x < 8.0, 1.1 * x, 8.8 + 0.9 * (x - 8.0))
+    model = search(x[::-1], y[::-1], target=1e-6, degree=1)
+    assert model['met'] and len(model['segments']) == 2
+    assert 7.5 < model['segments'][0]['upper'] < 8.5
+    assert np.allclose(predict(model, x), y)
+
+
+def test_single_segment_when_one_fits():
+    x = np.linspace(4.0, 15.0, 12)
+    model = search(x, 0.01 * x ** 2 + x, target=1e-6, degree=2)
+    assert len(model['segments']) == 1 and model['segments'][0]['upper'] is None
+
+
+def test_dp_matches_brute_force():
+    rng = np.random.default_rng(3)
+    x = np.sort(rng.uniform(4.0, 15.0, 14))
+    y = x + 0.05 * np.sin(3 * x) + rng.normal(0, 0.01, len(x))
+    errors, _ = segment_errors(x, y, degree=1)
+    best, _ = optimal_segments(errors, max_segments=3)
+    n = len(x)
+    for k in range(3):
+        brute = min(max(errors[i, j] for i, j in zip((0,) + cuts, tuple(c - 1 for c in cuts) + (n - 1,)))
+                    for cuts in itertools.combinations(range(1, n), k))
+        assert np.isclose(best[k, -1], brute)
+
+
+def test_repeated_setpoints_stay_in_one_segment():
+    x = np.repeat(np.linspace(4.0, 15.0, 8), 2)
+    y = np.where(x < 9.0, x, 2 * x - 9.0)
+    model = search(x, y, target=1e-6, degree=1, min_points=2)
+    uppers = [s['upper'] for s in model['segments'][:-1]]
+    assert all(not np.any(np.isclose(x, upper)) for upper in uppers)
+    assert np.allclose(predict(model, x), y)
+
+
+def test_logged_sweep_with_typos():
+    # sarq_eval-0004: 20 good rows over 4.6-15.2 V and 4 mistyped actual inputs
+    x, _, y = clean_points(load_csv(os.path.join(SCRIPT_DIR, "tests", "sarq_eval-0004.csv"))['values'])
+    model = search(x, y)
+    assert model['met'] and sum(s['points'] for s in model['segments']) == 20
+    assert [round(s['upper'], 2) for s in model['segments'][:-1]] == [11.66]
+    assert np.max(np.abs(predict(model, x) - y)) <= model['max_error'] + 1e-9
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Jun  2 10:07:38 2025
+
+@author: nichm
+
+Tests for SampleStore append/query, its column files and several writers on one store
+(adc_sample_store.py).
+
+    python -m pytest test_sample_store.py
+"""
+
+import json
+import os
+
+import numpy as np
+
+from adc_sample_store import INDEX_EVERY, SAMPLE_DTYPE, SampleStore
+
+
+def eval_rows(n, offset=0.0):
+    return [[2000 + i, 1.5, 10.0 + offset + i, 10.1 + offset + i, 10.2 + offset + i] for i in range(n)]
+
+
+def test_append_and_query(tmp_path):
+    store = SampleStore(str(tmp_path))
+    calib = store.new_session(7, 'calib')
+    evaluation = store.new_session(7, 'eval', firmware_version=3)
+    other = store.new_session(8, 'eval')
+    store.append(calib, [[None, None, 4.8, None, 5.0], [None, None, 7.0, None, 7.1]])
+    store.append(evaluation, eval_rows(3))
+    store.append(other, eval_rows(2, offset=100.0))
+    store.append(evaluation, eval_rows(1, offset=50.0))
+
+    assert store.rows == 8 and store.boards() == [7, 8]
+    rows = store.query(session=evaluation)
+    assert list(rows['calculated_vin']) == [10.0, 11.0, 12.0, 60.0]
+    assert set(rows['firmware_version']) == {3}
+    assert store.session(evaluation)['ranges'] == [[2, 5], [7, 8]]
+    assert np.isnan(store.query(session=calib)['raw_adc']).all()
+    assert len(store.query(board=7)) == 6
+    assert len(store.query(kind='eval')) == 6
+    assert list(store.query(board=8)['board']) == [8, 8]
+    assert store.latest_session(7, 'eval')[0] == evaluation
+
+
+def test_rows_reach_a_new_instance_without_close(tmp_path):
+    store = SampleStore(str(tmp_path))
+    session = store.new_session(1, 'eval')
+    store.append(session, eval_rows(5))
+    # Fewer than INDEX_EVERY rows: index.json still lists none of them
+    assert store.unindexed == 5
+    reader = SampleStore(str(tmp_path))
+    assert reader.session(session)['count'] == 5
+    assert list(reader.query(session=session)['raw_adc']) == [2000, 2001, 2002, 2003, 2004]
+
+
+def test_index_written_every_index_every_rows_and_on_close(tmp_path):
+    store = SampleStore(str(tmp_path))
+    session = store.new_session(1, 'eval')
+    store.append(session, eval_rows(INDEX_EVERY))
+    assert store.unindexed == 0
+    store.append(session, eval_rows(2))
+    store.close()
+    assert store.unindexed == 0
+    with open(os.path.join(str(tmp_path), "index.json")) as file:
+        assert '"rows": %d' % (INDEX_EVERY + 2) in file.read()
+
+
+def test_two_writers_share_the_store(tmp_path):
+    first, second = SampleStore(str(tmp_path)), SampleStore(str(tmp_path))
+    a = first.new_session(1, 'eval')
+    b = second.new_session(2, 'eval')
+    assert a != b
+    first.append(a, eval_rows(2))
+    second.append(b, eval_rows(3, offset=100.0))
+    first.append(a, eval_rows(1, offset=50.0))
+    first.close()
+    second.close()
+
+    store = SampleStore(str(tmp_path))
+    assert store.rows == 6
+    assert list(store.query(session=a)['calculated_vin']) == [10.0, 11.0, 60.0]
+    assert list(store.query(session=b)['calculated_vin']) == [110.0, 111.0, 112.0]
+
+
+def test_partial_record_is_ignored_and_cut(tmp_path):
+    store = SampleStore(str(tmp_path))
+    session = store.new_session(1, 'eval')
+    store.append(session, eval_rows(2))
+    # Crash mid-append: one column got the new row, another half a value
+    with open(store.column_path('raw_adc'), 'ab') as file:
+        file.write(b"\x01" * SAMPLE_DTYPE['raw_adc'].itemsize)
+    with open(store.column_path('actual_input'), 'ab') as file:
+        file.write(b"\x01" * 3)
+
+    reader = SampleStore(str(tmp_path))
+    assert reader.rows == 2
+    reader.append(session, eval_rows(1, offset=50.0))
+    for field in SAMPLE_DTYPE.names:
+        assert os.path.getsize(store.column_path(field)) == 3 * SAMPLE_DTYPE[field].itemsize
+    assert list(reader.query(session=session)['calculated_vin']) == [10.0, 11.0, 60.0]
+
+
+def test_query_reads_only_the_requested_columns(tmp_path):
+    store = SampleStore(str(tmp_path))
+    session = store.new_session(1, 'eval')
+    store.append(session, eval_rows(3))
+    os.remove(store.column_path('raw_adc'))  # Never opened below
+    rows = store.query(session=session, fields=['calculated_vin', 'actual_input'])
+    assert rows.dtype.names == ('calculated_vin', 'actual_input')
+    assert list(rows['actual_input']) == [10.2, 11.2, 12.2]
+
+
+def test_row_major_store_is_split_into_columns(tmp_path):
+    records = np.zeros(3, dtype=SAMPLE_DTYPE)
+    records['calculated_vin'] = [4.8, 7.0, 9.2]
+    records['session'] = 1
+    records['board'] = 4
+    (tmp_path / "samples.bin").write_bytes(records.tobytes())
+    (tmp_path / "index.json").write_text(json.dumps({'rows': 3, 'next_session': 2, 'sessions': {'1': {
+        'board': 4, 'kind': 'calib', 'firmware_version': None, 'coeffs': None, 'source': None, 'started': 0,
+        'ranges': [[0, 3]], 'count': 3}}}))
+
+    store = SampleStore(str(tmp_path))
+    assert not (tmp_path / "samples.bin").exists()
+    assert list(store.query(board=4)['calculated_vin']) == [4.8, 7.0, 9.2]
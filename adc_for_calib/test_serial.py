@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Jun  5 09:40:11 2025
+
+@author: nichm
+
+Tests for the connect-time readiness probe (adc_serial.py).
+
+    python -m pytest test_serial.py
+"""
+
+from adc_serial import wait_until_ready
+
+
+class BootingSerial:
+    """Replies to the probe only after boot_probes probes; everything before is boot noise."""
+
+    def __init__(self, boot_probes=2):
+        self.boot_probes = boot_probes
+        self.probes = 0
+        self.timeout = 2
+        self.lines = []
+
+    def reset_input_buffer(self):
+        self.lines = []
+
+    def write(self, data):
+        self.probes += 1
+        self.lines = [b"rst:0x1 (POWERON_RESET)\r\n"]
+        if self.probes > self.boot_probes:
+            self.lines.append(b"VIN: 12.000\r\n")
+
+    def readline(self):
+        return self.lines.pop(0) if self.lines else b""
+
+
+def parse(line):
+    return float(line[5:]) if line.startswith("VIN: ") else None
+
+
+def test_ready_once_the_firmware_answers():
+    ser = BootingSerial(boot_probes=2)
+    assert wait_until_ready(ser, parse, probe_interval=0.01) is not None
+    assert ser.probes == 3
+    assert ser.timeout == 2  # The caller's read timeout is restored
+
+
+def test_silent_board_times_out():
+    ser = BootingSerial(boot_probes=1000)
+    assert wait_until_ready(ser, parse, timeout=0.05, probe_interval=0.01) is None
+    assert ser.timeout == 2
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Jun  4 09:18:26 2025
+
+@author: nichm
+
+Tests for plateau/step detection and automatic capture on synthetic streams
+(adc_settle.py).
+
+    python -m pytest test_settle.py
+"""
+
+import numpy as np
+
+from adc_frame_protocol import RECORD_DTYPE
+from adc_settle import SettleDetector, auto_capture, settle_metrics
+from adc_stream import SampleRingBuffer
+
+
+class SyntheticReader:
+    """Stands in for adc_stream.StreamReader: each wait_for() streams n more samples at the current level."""
+
+    def __init__(self, noise=0.003, ramp=40, seed=0):
+        self.ring = SampleRingBuffer(1024)
+        self.rng = np.random.default_rng(seed)
+        self.noise = noise
+        self.ramp = ramp          # Samples the supply takes to reach a new level
+        self.level = 0.0
+        self.target = 0.0
+        self.stalled = False
+
+    def set_level(self, vin):
+        self.target = vin
+
+    def wait_for(self, n, timeout=None, mark=None):
+        if self.stalled:
+            return None
+        records = np.zeros(n, dtype=RECORD_DTYPE)
+        for i in range(n):
+            self.level += np.clip(self.target - self.level, -abs(self.target) / self.ramp - 0.1,
+                                  abs(self.target) / self.ramp + 0.1)
+            records['vin'][i] = self.level + self.rng.normal(0, self.noise)
+        self.ring.extend(records)
+        return records
+
+
+def run(reader, plan, **options):
+    points = []
+    setpoints = iter(plan)
+
+    def next_actual():
+        actual = next(setpoints, None)
+        if actual is not None:
+            reader.set_level(actual * 0.98)  # The operator sets the supply; the board reads 2% low
+        return actual
+
+    count = auto_capture(reader, next_actual, lambda stats, actual: points.append((stats['vin']['mean'], actual)),
+                         **options)
+    return count, points
+
+
+def test_settle_metrics():
+    assert settle_metrics(np.full(10, 5.0)) == (0.0, 0.0)
+    std, drift = settle_metrics(np.r_[np.zeros(5), np.ones(5)])
+    assert drift == 1.0 and std > 0.5
+
+
+def test_detector_plateau_then_step():
+    detector = SettleDetector(window=32, step_samples=8)
+    assert detector.update(np.full(16, 5.0)) is None          # Window not full yet
+    assert detector.update(np.full(32, 5.0)) == 'settled'
+    assert detector.update(np.full(32, 5.0)) is None          # Once per plateau
+    assert detector.update(np.r_[np.full(24, 5.0), np.full(8, 5.05)]) is None
+    assert detector.update(np.r_[np.full(24, 5.0), np.full(8, 6.0)]) == 'step'
+    assert detector.update(np.linspace(5.0, 6.0, 32)) is None  # Still moving
+    assert detector.update(np.full(32, 6.0)) == 'settled'
+
+
+def test_detector_rejects_noise():
+    detector = SettleDetector(window=64)
+    noisy = 5.0 + np.random.default_rng(1).normal(0, 0.05, 64)
+    assert detector.update(noisy) is None
+
+
+def test_auto_capture_follows_the_sweep():
+    count, points = run(SyntheticReader(), [5.0, 9.0, 12.0])
+    assert count == 3
+    assert [actual for _, actual in points] == [5.0, 9.0, 12.0]
+    assert np.allclose([vin for vin, _ in points], [4.9, 8.82, 11.76], atol=0.005)
+
+
+def test_auto_capture_next_level_within_the_step_threshold():
+    # 9.0 -> 9.05 V moves the reading by less than the step threshold: no step is ever seen
+    count, points = run(SyntheticReader(), [9.0, 9.05, 12.0], point_timeout=5.0)
+    assert count == 3
+    assert np.allclose([vin for vin, _ in points], [8.82, 8.869, 11.76], atol=0.005)
+
+
+def test_auto_capture_times_out_without_a_new_level():
+    reader = SyntheticReader()
+    points = []
+    setpoints = iter([5.0, 9.0])
+
+    def next_actual():
+        actual = next(setpoints, None)
+        if actual == 5.0:
+            reader.set_level(4.9)  # The operator never moves on to 9 V
+        return actual
+
+    count = auto_capture(reader, next_actual, lambda stats, actual: points.append(actual), point_timeout=0.2)
+    assert count == 1 and points == [5.0]
+
+
+def test_auto_capture_stops_when_the_stream_stalls():
+    reader = SyntheticReader()
+    reader.stalled = True
+    assert run(reader, [5.0])[0] == 0
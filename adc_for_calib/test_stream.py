@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Jun  5 10:21:37 2025
+
+@author: nichm
+
+Tests for the sample ring buffer and the streaming reader (adc_stream.py).
+
+    python -m pytest test_stream.py
+"""
+
+import threading
+
+import numpy as np
+
+from adc_frame_protocol import RECORD_DTYPE, encode_frame
+from adc_stream import SampleRingBuffer, StreamReader, window_stats
+
+
+def records(start, n):
+    block = np.zeros(n, dtype=RECORD_DTYPE)
+    block['seq'] = np.arange(start, start + n)
+    return block
+
+
+def test_ring_wraps_around_keeping_the_newest():
+    ring = SampleRingBuffer(8)
+    ring.extend(records(0, 5))
+    ring.extend(records(5, 6))  # Crosses the end of the buffer
+    assert ring.total == 11
+    assert list(ring.latest(8)['seq']) == list(range(3, 11))
+    assert list(ring.latest(3)['seq']) == [8, 9, 10]
+    assert list(ring.latest(100)['seq']) == list(range(3, 11))
+
+
+def test_ring_block_larger_than_capacity():
+    ring = SampleRingBuffer(8)
+    ring.extend(records(0, 3))
+    ring.extend(records(3, 21))
+    assert ring.total == 24
+    assert list(ring.latest(8)['seq']) == list(range(16, 24))
+    ring.extend(records(24, 2))
+    assert list(ring.latest(8)['seq']) == list(range(18, 26))
+
+
+def test_since_mark_across_the_wrap():
+    ring = SampleRingBuffer(8)
+    ring.extend(records(0, 6))
+    mark = ring.total
+    ring.extend(records(6, 5))
+    assert list(ring.since(mark)['seq']) == [6, 7, 8, 9, 10]
+    assert list(ring.since(mark, limit=2)['seq']) == [9, 10]  # The newest of them
+    assert len(ring.since(ring.total)) == 0
+
+
+def test_window_stats():
+    block = records(0, 4)
+    block['vin'] = [1.0, 2.0, 3.0, 10.0]
+    stats = window_stats(block, fields=('vin',))
+    assert stats['n'] == 4
+    assert stats['vin']['mean'] == 4.0 and stats['vin']['median'] == 2.5
+    assert np.isclose(stats['vin']['std'], np.std([1.0, 2.0, 3.0, 10.0], ddof=1))
+
+
+class StreamingSerial:
+    """Streams encoded frames of a constant reading once 's<rate>' was written; 'x' stops it."""
+
+    def __init__(self):
+        self.port = "fake"
+        self.timeout = 2
+        self.streaming = threading.Event()
+        self.seq = 0
+
+    @property
+    def in_waiting(self):
+        return 0
+
+    def reset_input_buffer(self):
+        pass
+
+    def write(self, data):
+        if data.startswith(b's'):
+            self.streaming.set()
+        elif data == b'x':
+            self.streaming.clear()
+
+    def read(self, n):
+        if not self.streaming.wait(self.timeout):
+            return b""
+        chunk = b"".join(encode_frame(self.seq + i, 2000, 1800, 12.5, 12.0) for i in range(16))
+        self.seq += 16
+        return chunk
+
+
+def test_stream_reader_captures_fresh_samples():
+    reader = StreamReader(StreamingSerial(), rate_hz=1000, capacity=64).start()
+    try:
+        stats = reader.capture(100)  # More than the ring holds: wait_for() returns the newest 64
+        assert stats['n'] == 64
+        assert stats['vin']['mean'] == 12.5 and stats['raw_adc']['std'] == 0.0
+    finally:
+        reader.stop()
+    assert not reader.ser.streaming.is_set()
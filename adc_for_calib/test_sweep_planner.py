@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun  3 14:26:33 2025
+
+@author: nichm
+
+Tests for the adaptive sweep planner (adc_sweep_planner.py).
+
+    python -m pytest test_sweep_planner.py
+"""
+
+import os
+
+import numpy as np
+
+from adc_fleet_report import load_csv
+from adc_model_selection import clean_points
+from adc_online_fit import OnlineFit
+from adc_sweep_planner import MIN_SPACING, adaptive_plan, next_setpoint, planner_order, replay, seed_points
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_seed_points_are_the_cubic_d_optimal_design():
+    assert seed_points() == [4.0, 7.04, 11.96, 15.0]
+
+
+def test_next_setpoint_keeps_its_distance():
+    fit = OnlineFit()
+    measured, actual = [], []
+    for _ in range(12):
+        setpoint = next_setpoint(fit, measured, actual)
+        assert not actual or np.min(np.abs(np.array(actual) - setpoint)) >= MIN_SPACING
+        fit.update(setpoint * 0.98, setpoint)
+        measured.append(setpoint * 0.98)
+        actual.append(setpoint)
+    assert actual[:4] == seed_points()
+
+
+def test_adaptive_plan_skips_a_failing_setpoint():
+    fit = OnlineFit()
+    measured, actual, asked = [], [], []
+    for setpoint in adaptive_plan(fit, measured, actual, max_points=6, max_retries=2):
+        asked.append(setpoint)
+        if setpoint == 7.04:
+            continue   # No reading at this voltage
+        fit.update(setpoint, setpoint)
+        measured.append(setpoint)
+        actual.append(setpoint)
+    assert asked[:3] == [4.0, 7.04, 7.04]
+    assert 7.04 not in actual and len(actual) == 6
+
+
+def test_planned_order_on_a_logged_sweep():
+    # sarq_eval-0004 after its 4 mistyped rows are dropped: 20 points over 4.6-15.2 V
+    x, _, y = clean_points(load_csv(os.path.join(SCRIPT_DIR, "tests", "sarq_eval-0004.csv"))['values'])
+    order = planner_order(x, y)
+    assert sorted(order) == list(range(len(x)))
+    assert [round(y[i], 2) for i in order[:4]] == [4.63, 6.59, 12.09, 15.23]
+    reference = np.polyval(np.polyfit(x, y, 3), np.linspace(4.0, 15.0, 64))
+    planned = replay(x, y, order, reference)
+    logged = replay(x, y, range(len(x)), reference)
+    assert planned[9] < 0.025 and planned[9] < logged[9]
@@ -44,16 +44,45 @@ def list_serial_ports():
             return filtered_ports[int(choice) - 1]
         print("Invalid selection. Try again.")
 
-def setup_serial(port, baudrate=115200):
+def setup_serial(port, baudrate=115200, reset=False):
     try:
-        ser = serial.Serial(port, baudrate, timeout=2, dsrdtr=False, rtscts=False)
-        time.sleep(2)  # Allow time for the connection
-        print(f"Connected to {port}")
-        return ser
+        ser = serial.Serial(None, baudrate, timeout=2, dsrdtr=False, rtscts=False)
+        ser.port = port
+        if not reset:
+            # Keep DTR/RTS released so opening the port does not reboot the ESP32
+            ser.dtr = False
+            ser.rts = False
+        ser.open()
     except serial.SerialException as e:
         print(f"Error: {e}")
         return None
 
+    latency = wait_until_ready(ser)
+    if latency is None:
+        print(f"❌ {port} opened but the board did not answer.")
+        ser.close()
+        return None
+    print(f"Connected to {port} (ready in {latency:.2f}s)")
+    return ser
+
+def wait_until_ready(ser, probe=b'a', timeout=15.0, probe_interval=1.5):
+    start = time.monotonic()
+    read_timeout = ser.timeout
+    ser.timeout = 0.1
+    try:
+        while time.monotonic() - start < timeout:
+            ser.reset_input_buffer()
+            ser.write(probe)
+            probe_deadline = time.monotonic() + probe_interval
+            while time.monotonic() < probe_deadline:
+                line = ser.readline().decode('utf-8', errors='replace').strip()
+                if line and parse_serial_data(line) is not None:
+                    ser.reset_input_buffer()
+                    return time.monotonic() - start
+        return None
+    finally:
+        ser.timeout = read_timeout
+
 def parse_serial_data(line):
     match = re.search(r"Raw ADC: (\d+) \| ESP ADC Cal Raw to Voltage: ([\d.]+) \| Calculated VIN: ([\d.]+) \| Calibrated VIN: ([\d.]+)", line)
     if match: